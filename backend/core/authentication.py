@@ -1,14 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-from .models import User
+from .models import AuthToken
+
+
+class TokenCache:
+    """
+    Small in-process LRU of token hash -> AuthToken (with its user), so most
+    requests skip the database. Entries live for at most ``ttl`` seconds and
+    never past the token's own expiry; logout invalidates them right away in
+    this process, other processes drop them within ``ttl``.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_hash):
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                return None
+            auth_token, cached_until = entry
+            if cached_until < time.monotonic() or auth_token.is_expired():
+                del self._entries[key_hash]
+                return None
+            self._entries.move_to_end(key_hash)
+            return auth_token
+
+    def set(self, auth_token):
+        with self._lock:
+            self._entries[auth_token.key_hash] = (auth_token, time.monotonic() + self.ttl)
+            self._entries.move_to_end(auth_token.key_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key_hash):
+        with self._lock:
+            self._entries.pop(key_hash, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key_hash in [key for key, (auth_token, _) in self._entries.items()
+                             if auth_token.user_id == user_id]:
+                del self._entries[key_hash]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache(
+    ttl=settings.AUTH_TOKEN_CACHE_TTL,
+    max_entries=settings.AUTH_TOKEN_CACHE_MAX_ENTRIES,
+)
+
 
 class TokenAuthentication(BaseAuthentication):
     def authenticate(self, request):
         token = request.headers.get('Authorization')
         if not token:
             return None
-        try:
-            user = User.objects.get(token=token)
-        except User.DoesNotExist:
-            raise AuthenticationFailed('Invalid token')
-        return (user, None)
+        key_hash = AuthToken.hash_key(token)
+        auth_token = token_cache.get(key_hash)
+        if auth_token is None:
+            try:
+                auth_token = AuthToken.objects.select_related('user').get(
+                    key_hash=key_hash, expires_at__gt=timezone.now())
+            except AuthToken.DoesNotExist:
+                raise AuthenticationFailed('Invalid token')
+            token_cache.set(auth_token)
+        return (auth_token.user, auth_token)
+
+    async def aauthenticate(self, request):
+        # Same lookup as authenticate(), for the async views
+        token = request.headers.get('Authorization')
+        if not token:
+            return None
+        key_hash = AuthToken.hash_key(token)
+        auth_token = token_cache.get(key_hash)
+        if auth_token is None:
+            try:
+                auth_token = await AuthToken.objects.select_related('user').aget(
+                    key_hash=key_hash, expires_at__gt=timezone.now())
+            except AuthToken.DoesNotExist:
+                raise AuthenticationFailed('Invalid token')
+            token_cache.set(auth_token)
+        return (auth_token.user, auth_token)
@@ -1,9 +1,9 @@
 from dotenv import load_dotenv
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.output_parsers import PydanticOutputParser
 from langchain_core.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate
-from typing import List, Any
+from typing import Any, Dict, Iterator, List
 from pydantic import BaseModel, Field
+from .llm import get_chain
+from .structured_output import StructuredChain
 
 
 class Character(BaseModel):
@@ -17,52 +17,66 @@ class Characters(BaseModel):
     characters: List[Character]
 
 
-# Langchain libraries:
-
-# Custom types:
 load_dotenv()
 
 
+CHARACTER_PROMPT = """
+        Based on the user_queries and genre and the interview answer, generate the characters information
+        user_queries: {input}
+        genre: {genre}
+        ---
+        Here is the interview which I answered: {interview_questions_and_answers}
+        - If the interview question do not contain the appearance of the character, it is consider user let you to decide the answer
+        ---
+        Output format: {format_instructions}
+        """
+
+
+def build_characters_chain():
+    system_message_prompt = SystemMessagePromptTemplate.from_template(
+        CHARACTER_PROMPT
+    )
+    chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt])
+    return StructuredChain(chat_prompt, Characters, model="gpt-4o", temperature=0)
+
+
 class CharacterGenerator:
     def __init__(self, input: str, genre: str, interview_questions_and_answers: Any):
         self.input = input
         self.genre = genre
         self.interview_questions_and_answers = interview_questions_and_answers
 
-        # Create a prompt
-        prompt_content = """
-            Based on the user_queries and genre and the interview answer, generate the characters information
-            user_queries: {input}
-            genre: {genre}
-            ---
-            Here is the interview which I answered: {interview_questions_and_answers}
-            - If the interview question do not contain the appearance of the character, it is consider user let you to decide the answer
-            ---
-            Output format: {format_instructions}
-            """
-
-        system_message_prompt = SystemMessagePromptTemplate.from_template(
-            prompt_content
-        )
-        self.chat_prompt = ChatPromptTemplate.from_messages(
-            [system_message_prompt])
-
-        # Create an output parser
-        self.parser = PydanticOutputParser(pydantic_object=Characters)
-
-        # Set up the chain
-        self.outline_chain = self.chat_prompt | ChatOpenAI(
-            temperature=0, model="gpt-4o") | self.parser
+        # The prompt, parser and model are shared by every request
+        self.outline_chain = get_chain("characters", build_characters_chain)
+
+    def _chain_inputs(self) -> dict:
+        return {
+            "input": self.input,
+            "genre": self.genre,
+            "interview_questions_and_answers": self.interview_questions_and_answers,
+        }
 
     def generate_character(self) -> Any:
         print("Generating the Characters...\n---")
-        result = self.outline_chain.invoke(
-            {
-                "input": self.input,
-                "genre": self.genre,
-                "interview_questions_and_answers": self.interview_questions_and_answers,
-                "format_instructions": self.parser.get_format_instructions(),
-            }
-        )
+        result = self.outline_chain.invoke(self._chain_inputs())
         print("Finished generating the characters!\n---")
         return result
+
+    async def agenerate_character(self) -> Any:
+        print("Generating the Characters...\n---")
+        result = await self.outline_chain.ainvoke(self._chain_inputs())
+        print("Finished generating the characters!\n---")
+        return result
+
+    def stream_characters(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yields a ``character`` event as soon as each character is written,
+        then a ``characters`` event with all of them.
+        """
+        print("Streaming the Characters...\n---")
+        for result in self.outline_chain.stream(self._chain_inputs(), "characters"):
+            if isinstance(result, Characters):
+                yield {"event": "characters", "result": result}
+            else:
+                yield {"event": "character", "character": result}
+        print("Finished streaming the characters!\n---")
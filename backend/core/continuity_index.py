@@ -0,0 +1,177 @@
+import re
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Collection, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import Embeddings
+
+from .tokens import count_tokens
+
+# Passages of a story for the chapter being written to look back on.
+#
+# StoryMemory keeps a synopsis and the end of the previous chapter; facts
+# from further back (what a character looked like, what was promised in
+# chapter 2) get lost in it. The generators add every finished chapter, split
+# into passages, and the characters' descriptions to a ContinuityIndex, and
+# each new chapter's prompt gets the few passages most similar to what it is
+# about. Vectors are hashed word and character n-grams, so indexing needs no
+# model or network and costs a few milliseconds a chapter; any langchain
+# Embeddings can be passed instead.
+
+DEFAULT_CONTINUITY_INDEX = {
+    'ENABLED': True,
+    'TOP_K': 4,
+    'MAX_TOKENS': 600,  # for all the passages of one prompt
+    'PASSAGE_CHARS': 600,
+    'DIMENSIONS': 1024,
+}
+
+WORD = re.compile(r"\w+")
+# Too common to say what a passage is about
+STOP_WORDS = frozenset("""
+a an and are as at be been but by for from had has have he her him his i if in into is it its
+me my no not of on or our she so than that the their them then there they this to was we were
+what when where which while who will with you your
+""".split())
+
+
+@lru_cache(maxsize=50_000)
+def _hashed_word(word: str, dimensions: int, ngram_range: Tuple[int, int],
+                 word_weight: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Buckets and signed weights of a word and of its character n-grams."""
+    low, high = ngram_range
+    padded = f" {word} "
+    features = [(word, word_weight)] + [
+        (padded[start:start + n], 1.0)
+        for n in range(low, min(high, len(padded)) + 1)
+        for start in range(len(padded) - n + 1)
+    ]
+    buckets, weights = [], []
+    for feature, weight in features:
+        hashed = zlib.crc32(feature.encode('utf-8'))
+        buckets.append(hashed % dimensions)
+        # The top bit picks the sign, so collisions tend to cancel out
+        weights.append(weight if hashed & 0x80000000 else -weight)
+    return np.array(buckets), np.array(weights, dtype=np.float32)
+
+
+class HashedNgramEmbeddings(Embeddings):
+    """
+    Bag of words and character 3-5 grams, hashed into ``dimensions`` signed
+    buckets, log-scaled and normalised to unit length. Texts sharing names
+    and word stems (``dragon`` / ``dragons``) come out similar.
+    """
+
+    def __init__(self, dimensions: int = 1024, ngram_range: Tuple[int, int] = (3, 5), word_weight: float = 2.0):
+        self.dimensions = dimensions
+        self.ngram_range = ngram_range
+        self.word_weight = word_weight
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        counts = Counter(word for word in WORD.findall(text.lower()) if word not in STOP_WORDS)
+        for word, count in counts.items():
+            buckets, weights = _hashed_word(word, self.dimensions, self.ngram_range, self.word_weight)
+            np.add.at(vector, buckets, weights * count)
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+@dataclass
+class Passage:
+    source: str  # e.g. "Chapter 3" or "Character: Mira"
+    text: str
+
+
+def chapter_source(number: int) -> str:
+    return f"Chapter {number}"
+
+
+def character_source(name: str) -> str:
+    return f"Character: {name}"
+
+
+class ContinuityIndex:
+    """In-memory vector index of one story's passages."""
+
+    def __init__(self, embeddings: Optional[Embeddings] = None, top_k: int = 4,
+                 max_tokens: int = 600, passage_chars: int = 600):
+        self.embeddings = embeddings or HashedNgramEmbeddings()
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=passage_chars, chunk_overlap=0)
+        self.passages: List[Passage] = []
+        self._vectors: List[List[float]] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def add(self, source: str, texts: List[str]) -> None:
+        texts = [text for text in texts if text.strip()]
+        if not texts:
+            return
+        self.passages += [Passage(source, text) for text in texts]
+        self._vectors += self.embeddings.embed_documents(texts)
+        self._matrix = None
+
+    def add_chapter(self, number: int, text: str) -> None:
+        self.add(chapter_source(number), self.splitter.split_text(text))
+
+    def add_characters(self, characters: Any) -> None:
+        for character in getattr(characters, 'characters', []):
+            self.add(character_source(character.name),
+                     [f"{character.name}. {character.appearance} {character.biography}"])
+
+    def search(self, query: str, skip: Collection[str] = ()) -> List[Passage]:
+        """
+        The passages most similar to ``query``, best first: at most
+        ``top_k`` of them and ``max_tokens`` in all, none from the sources
+        in ``skip`` (e.g. the chapter already in the prompt).
+        """
+        if not self.passages or not query.strip():
+            return []
+        if self._matrix is None:
+            self._matrix = np.asarray(self._vectors, dtype=np.float32)
+        scores = self._matrix @ np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        found, budget = [], self.max_tokens
+        for index in np.argsort(-scores):
+            if len(found) >= self.top_k or scores[index] <= 0:
+                break
+            passage = self.passages[index]
+            if passage.source in skip:
+                continue
+            tokens = count_tokens(passage.text)
+            if tokens > budget:
+                continue
+            found.append(passage)
+            budget -= tokens
+        return found
+
+    def recall(self, query: str, skip: Collection[str] = ()) -> str:
+        """``search`` rendered for a prompt, or "" if nothing relevant was found."""
+        return "\n".join(
+            f"- ({passage.source}) {' '.join(passage.text.split())}"
+            for passage in self.search(query, skip)
+        )
+
+
+def build_continuity_index() -> Optional[ContinuityIndex]:
+    options = {**DEFAULT_CONTINUITY_INDEX, **getattr(settings, 'CONTINUITY_INDEX', {})}
+    if not options['ENABLED']:
+        return None
+    return ContinuityIndex(
+        embeddings=HashedNgramEmbeddings(dimensions=options['DIMENSIONS']),
+        top_k=options['TOP_K'],
+        max_tokens=options['MAX_TOKENS'],
+        passage_chars=options['PASSAGE_CHARS'],
+    )
@@ -0,0 +1,199 @@
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+from typing import Any, List, Optional, Sequence, Tuple
+
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from PIL import Image
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Offline stand-in for ChatOpenAI used by the benchmark commands.
+
+    Cycles through ``responses`` and waits ``latency`` seconds per call,
+    blocking in the sync path and awaiting in the async path, the same way
+    a remote model call would.
+
+    ``routes`` are ``(marker, response)`` pairs tried before ``responses``:
+    the first response whose marker appears in the prompt is returned, so a
+    single model can answer every chain of the pipeline. Calls report
+    ``prompt_tokens`` and ``completion_tokens`` as their usage, or about one
+    token per four characters when those are not set.
+    """
+
+    responses: List[str]
+    latency: float = 0.0
+    routes: Sequence[Tuple[str, str]] = ()
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    i: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _pick_response(self, prompt: str) -> str:
+        for marker, response in self.routes:
+            if marker in prompt:
+                return response
+        response = self.responses[self.i % len(self.responses)]
+        self.i += 1
+        return response
+
+    def _next_response(self, messages: List[BaseMessage]) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        response = self._pick_response(prompt)
+        prompt_tokens = self.prompt_tokens if self.prompt_tokens is not None else len(prompt) // 4
+        completion_tokens = (self.completion_tokens if self.completion_tokens is not None
+                             else len(response) // 4)
+        message = AIMessage(content=response, usage_metadata={
+            'input_tokens': prompt_tokens,
+            'output_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        return self._next_response(messages)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._next_response(messages)
+
+
+def fake_png(size: int = 1024) -> bytes:
+    """A ``size`` x ``size`` PNG, the same shape DALL-E returns."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), (120, 90, 200)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def fake_image_transport(latency: float = 0.0, image: Optional[bytes] = None) -> httpx.MockTransport:
+    """
+    httpx transport answering the OpenAI images endpoint with ``image``
+    (inline, as with ``response_format="b64_json"``) after ``latency`` seconds.
+    """
+    body = json.dumps({
+        'created': int(time.time()),
+        'data': [{'b64_json': base64.b64encode(image or fake_png()).decode('ascii')}],
+    }).encode('utf-8')
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        time.sleep(latency)
+        if not request.url.path.endswith('/images/generations'):
+            return httpx.Response(404, json={'error': {'message': 'Not faked'}})
+        return httpx.Response(200, content=body, headers={'Content-Type': 'application/json'})
+
+    return httpx.MockTransport(handler)
+
+
+def fake_chat_completion(content: str, model: str = "gpt-4o") -> dict:
+    """Body of a chat completions response, as the OpenAI API sends it."""
+    return {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                     'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20},
+    }
+
+
+class FakeRateLimitedAPI:
+    """
+    Stand-in for the OpenAI API that answers the first ``failures`` calls
+    with 429 Too Many Requests (with ``retry_after`` as Retry-After), then
+    with ``content`` for chat completions and an image for image generations.
+    Counts the calls and the most that were in flight at once.
+    """
+
+    def __init__(self, failures: int = 0, content: str = "A fake answer", latency: float = 0.0,
+                 retry_after: float = 0.0):
+        self.failures = failures
+        self.content = content
+        self.latency = latency
+        self.retry_after = retry_after
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._image = None
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.calls += 1
+            failing = self.calls <= self.failures
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if failing:
+                return httpx.Response(429, headers={'Retry-After': str(self.retry_after)},
+                                      json={'error': {'message': 'Rate limit reached', 'type': 'requests'}})
+            if request.url.path.endswith('/images/generations'):
+                self._image = self._image or base64.b64encode(fake_png(64)).decode('ascii')
+                return httpx.Response(200, json={'created': int(time.time()), 'data': [{'b64_json': self._image}]})
+            return httpx.Response(200, json=fake_chat_completion(self.content))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handler)
+
+
+class FakeLlama:
+    """
+    Stand-in for ``llama_cpp.Llama`` that streams ``words`` words per answer.
+
+    Records the last message of every prompt it is asked to answer, in
+    order, and how many words were read from its streams. Clear ``gate`` to
+    hold the next answer until it is set again; ``started`` is set once an
+    answer has begun.
+    """
+
+    def __init__(self, words: int = 3, **kwargs: Any):
+        self.words = words
+        self.prompts: List[str] = []
+        self.words_read = 0
+        self.n_tokens = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.started = threading.Event()
+
+    def set_cache(self, cache: Any) -> None:
+        pass
+
+    def create_chat_completion(self, messages: List[dict], stream: bool = False, **kwargs: Any):
+        self.prompts.append(messages[-1]['content'])
+        self.started.set()
+        self.gate.wait(5)
+
+        def chunks():
+            for _ in range(self.words):
+                self.words_read += 1
+                self.n_tokens += 1
+                yield {'choices': [{'delta': {'content': "word "}}]}
+
+        return chunks()
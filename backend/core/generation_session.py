@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+from .characters_generation import Characters
+from .expert_interview_chain import InterviewQuestions
+from .models import GenerationSession, Story, User
+from .story_outline_generation import parse_outline
+
+# Server-side state of the story generation chat.
+#
+# Each step stores its structured output on the story's GenerationSession, as
+# the compact model_dump() of the pydantic object, and the following steps
+# load it back by story id. Clients only send the story id and their new
+# input. Requests from clients that still send the earlier results back are
+# served from the request body for anything the session does not have yet.
+
+
+@dataclass
+class GenerationState:
+    topic: str
+    questions: List[str]
+    interview_data: List[str]
+    outline: Any  # StoriesOutline or ActsOutline, or the nested list sent by older clients
+    characters: Any  # Characters, or the nested list sent by older clients
+
+
+def load_session(story: Story, author: Optional[User] = None) -> Optional[GenerationSession]:
+    """The story's session; with ``author``, only if the story is theirs."""
+    sessions = GenerationSession.objects.filter(story=story)
+    if author is not None:
+        sessions = sessions.filter(story__author=author)
+    return sessions.first()
+
+
+def load_state(story: Story, data: Optional[dict] = None, author: Optional[User] = None) -> GenerationState:
+    """Inputs for the next generation step of ``story``, as seen by ``author``."""
+    data = data or {}
+    session = load_session(story, author) or GenerationSession(story=story)
+    legacy_questions = data.get('interview_questions') or []
+    questions = legacy_questions
+    if session.interview_questions:
+        questions = [
+            q.question for q in InterviewQuestions.model_validate(session.interview_questions).questions
+        ]
+    return GenerationState(
+        topic=session.topic or data.get('topic', ''),
+        questions=questions,
+        interview_data=session.interview_data or legacy_questions,
+        outline=(parse_outline(session.outline)
+                 if session.outline else data.get('outline_result', '')),
+        characters=(Characters.model_validate(session.characters)
+                    if session.characters else data.get('character_result', '')),
+    )
+
+
+def store_step(story: Story, **fields) -> None:
+    """
+    Save the results of a step. Pydantic results are stored as their
+    ``model_dump()``; starting a new interview clears the later results.
+    """
+    fields = {
+        name: value.model_dump(exclude_none=True) if hasattr(value, 'model_dump') else value
+        for name, value in fields.items()
+    }
+    if 'interview_questions' in fields:
+        fields.update(interview_data=None, outline=None, characters=None)
+    GenerationSession.objects.update_or_create(story=story, defaults=fields)
@@ -0,0 +1,97 @@
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from django.utils import timezone
+from PIL import Image
+
+from .models import Character, Story
+
+logger = logging.getLogger(__name__)
+
+# Smaller WebP renditions stored next to each story/character image
+RENDITIONS = {
+    'thumbnail': (256, 256),
+    'medium': (512, 512),
+}
+WEBP_QUALITY = 80
+
+# Renditions are created off the request path on a small pool of threads
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-derivatives')
+
+
+def derivative_name(name: str, rendition: str) -> str:
+    """``story_images/foo.png`` -> ``story_images/foo.thumbnail.webp``"""
+    root, _ = os.path.splitext(name)
+    return f"{root}.{rendition}.webp"
+
+
+def has_derivatives(instance) -> bool:
+    # Uploads never overwrite an existing name, so renditions recorded for
+    # the image's current name are never stale.
+    return bool(instance.image) and instance.image_renditions == instance.image.name
+
+
+def derivative_url(instance, rendition: str):
+    """
+    URL of a rendition of ``instance.image``, or of the original image if
+    the renditions have not been created yet. Never touches the storage.
+    """
+    if not instance.image:
+        return None
+    if has_derivatives(instance):
+        return instance.image.storage.url(derivative_name(instance.image.name, rendition))
+    return instance.image.url
+
+
+def create_derivatives(field_file) -> None:
+    storage = field_file.storage
+    with storage.open(field_file.name, 'rb') as original:
+        image = Image.open(original)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+
+    for rendition, size in RENDITIONS.items():
+        resized = image.copy()
+        resized.thumbnail(size, Image.LANCZOS)
+        buffer = BytesIO()
+        resized.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=4)
+
+        name = derivative_name(field_file.name, rendition)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def record_derivatives(instance) -> None:
+    """Mark the renditions of ``instance.image`` as created."""
+    name = instance.image.name
+    # Unless the image changed meanwhile; the story's listings are
+    # revalidated with Story.last_update, which now has to move on
+    if isinstance(instance, Story):
+        Story.objects.filter(pk=instance.pk, image=name).update(
+            image_renditions=name, last_update=timezone.now())
+    elif Character.objects.filter(pk=instance.pk, image=name).update(image_renditions=name):
+        Story.objects.filter(pk=instance.story_id).update(last_update=timezone.now())
+    instance.image_renditions = name
+
+
+def _create_derivatives_for(model, pk) -> None:
+    close_old_connections()
+    try:
+        instance = model.objects.filter(pk=pk).first()
+        if instance is not None and instance.image:
+            create_derivatives(instance.image)
+            record_derivatives(instance)
+    except Exception:
+        logger.exception("Could not create image renditions for %s %s", model.__name__, pk)
+    finally:
+        close_old_connections()
+
+
+def schedule_derivatives(instance) -> Future:
+    return _executor.submit(_create_derivatives_for, type(instance), instance.pk)
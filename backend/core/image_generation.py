@@ -0,0 +1,84 @@
+import base64
+import tempfile
+
+from django.core.files import File
+
+from .llm import get_async_http_client, get_async_openai_client, get_http_client, get_openai_client
+from .tracing import trace_image_call
+
+# Images are written to a spooled temporary file that moves to disk past this
+# size, so a worker never holds more than this much of an image in memory.
+SPOOL_MAX_SIZE = 256 * 1024
+# Bytes of base64 decoded at a time (a multiple of 4 so slices stay aligned)
+B64_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+IMAGE_OPTIONS = {
+    'model': "dall-e-3",
+    'size': "1024x1024",
+    'quality': "standard",
+    'n': 1,
+    # Return the image inline instead of a URL that needs a second request
+    'response_format': "b64_json",
+}
+
+
+def _spooled_file():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+
+def decode_b64_image(b64_data: str) -> File:
+    """Decode a base64 image into a file, one slice at a time."""
+    spooled = _spooled_file()
+    for start in range(0, len(b64_data), B64_CHUNK_SIZE):
+        spooled.write(base64.b64decode(b64_data[start:start + B64_CHUNK_SIZE]))
+    spooled.seek(0)
+    return File(spooled)
+
+
+def download_image(image_url: str) -> File:
+    spooled = _spooled_file()
+    with get_http_client().stream('GET', image_url) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+            spooled.write(chunk)
+    spooled.seek(0)
+    return File(spooled)
+
+
+async def adownload_image(image_url: str) -> File:
+    spooled = _spooled_file()
+    async with get_async_http_client().stream('GET', image_url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            spooled.write(chunk)
+    spooled.seek(0)
+    return File(spooled)
+
+
+def generate_image(prompt: str) -> File:
+    with trace_image_call(IMAGE_OPTIONS['model']):
+        response = get_openai_client().images.generate(prompt=prompt, **IMAGE_OPTIONS)
+        image = response.data[0]
+        if image.b64_json:
+            return decode_b64_image(image.b64_json)
+        return download_image(image.url)
+
+
+async def agenerate_image(prompt: str) -> File:
+    with trace_image_call(IMAGE_OPTIONS['model']):
+        response = await get_async_openai_client().images.generate(prompt=prompt, **IMAGE_OPTIONS)
+        image = response.data[0]
+        if image.b64_json:
+            return decode_b64_image(image.b64_json)
+        return await adownload_image(image.url)
+
+
+def save_image(instance, image_name: str, image_file: File, update_fields=()) -> None:
+    """
+    Stream ``image_file`` into the instance's storage and write the row once,
+    updating ``image`` together with any other changed ``update_fields``.
+    """
+    with image_file:
+        instance.image.save(image_name, image_file, save=False)
+    instance.save(update_fields=['image', *update_fields])
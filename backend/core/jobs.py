@@ -0,0 +1,173 @@
+import json
+import logging
+import threading
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .generation_session import load_state
+from .llm_scheduler import BULK, llm_priority
+from .models import GenerationJob, Story, User
+from .pipeline import run_outline_step, run_character_step, run_chapter_step
+from .story_generation import SEQUENTIAL
+from .story_outline_generation import DEFAULT_CHAPTERS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GENERATION_JOBS = {
+    'HEARTBEAT_INTERVAL': 30,  # seconds between the heartbeats of a running job
+    'STALE_AFTER': 5 * 60,  # seconds without a heartbeat before a job is requeued
+    'MAX_ATTEMPTS': 3,  # claims of a job before it is failed instead
+}
+
+# Which pipeline step each /chat/ step number maps to
+JOB_STEPS = {
+    2: GenerationJob.STEP_OUTLINE,
+    3: GenerationJob.STEP_CHARACTERS,
+    4: GenerationJob.STEP_CHAPTERS,
+}
+
+
+def enqueue_job(story: Story, step: str, payload: dict, requested_by: Optional[User] = None) -> GenerationJob:
+    return GenerationJob.objects.create(story=story, step=step, payload=payload, requested_by=requested_by)
+
+
+def _settings() -> dict:
+    return {**DEFAULT_GENERATION_JOBS, **getattr(settings, 'GENERATION_JOBS', {})}
+
+
+def requeue_stale_jobs(stale_after: timedelta) -> None:
+    """
+    Put back in the queue the running jobs whose heartbeat stopped more than
+    ``stale_after`` ago (their worker died), or fail them once they have been
+    tried MAX_ATTEMPTS times.
+    """
+    now = timezone.now()
+    stale = GenerationJob.objects.filter(
+        Q(heartbeat_at__lt=now - stale_after)
+        # Claimed before jobs had a heartbeat
+        | Q(heartbeat_at__isnull=True, started_at__lt=now - stale_after),
+        status=GenerationJob.STATUS_RUNNING,
+    )
+    stale.filter(attempts__gte=_settings()['MAX_ATTEMPTS']).update(
+        status=GenerationJob.STATUS_FAILED,
+        error="Generation failed (the worker running it stopped)",
+        finished_at=now,
+    )
+    stale.update(status=GenerationJob.STATUS_PENDING)
+
+
+def claim_next_job(stale_after: Optional[timedelta] = None) -> Optional[GenerationJob]:
+    """
+    Claim the oldest pending job for this worker, or return None if the
+    queue is empty.
+
+    Stale jobs (see ``requeue_stale_jobs``; ``stale_after`` defaults to
+    GENERATION_JOBS['STALE_AFTER']) are requeued first. Claiming is a
+    conditional UPDATE, so several workers can poll the same table without a
+    broker and without two of them running the same job.
+    """
+    if stale_after is None:
+        stale_after = timedelta(seconds=_settings()['STALE_AFTER'])
+    requeue_stale_jobs(stale_after)
+
+    while True:
+        job = (
+            GenerationJob.objects.filter(status=GenerationJob.STATUS_PENDING)
+            .order_by('created_at', 'id')
+            .first()
+        )
+        if job is None:
+            return None
+
+        started_at = timezone.now()
+        claimed = GenerationJob.objects.filter(
+            id=job.id, status=GenerationJob.STATUS_PENDING
+        ).update(
+            status=GenerationJob.STATUS_RUNNING,
+            started_at=started_at,
+            heartbeat_at=started_at,
+            attempts=job.attempts + 1,
+        )
+        if claimed:
+            job.status = GenerationJob.STATUS_RUNNING
+            job.started_at = job.heartbeat_at = started_at
+            job.attempts += 1
+            return job
+        # Another worker got there first, try the next one
+
+
+def execute_step(job: GenerationJob) -> dict:
+    story = job.story
+    payload = job.payload
+    if job.requested_by_id is not None and job.requested_by_id != story.author_id:
+        raise PermissionDenied(f"Story {story.pk} does not belong to the user who queued the job")
+    # Results of the earlier steps, as of when the job runs
+    state = load_state(story, payload, author=job.requested_by)
+    if job.step == GenerationJob.STEP_OUTLINE:
+        # Jobs queued before the generation session existed carry the
+        # answered questions as interview_questions
+        interview_data = payload.get('interview_data', payload.get('interview_questions'))
+        return run_outline_step(story, state.topic, interview_data,
+                                payload.get('chapters', DEFAULT_CHAPTERS))
+    if job.step == GenerationJob.STEP_CHARACTERS:
+        return run_character_step(
+            story, state.topic, state.interview_data, state.outline)
+    if job.step == GenerationJob.STEP_CHAPTERS:
+        return run_chapter_step(
+            story, state.topic, state.interview_data,
+            state.outline, state.characters,
+            mode=payload.get('generation_mode', SEQUENTIAL))
+    raise ValueError(f"Unknown generation step: {job.step}")
+
+
+def _claim(job: GenerationJob):
+    """This worker's claim on ``job``: it is lost once the job is requeued."""
+    return GenerationJob.objects.filter(
+        id=job.id, status=GenerationJob.STATUS_RUNNING, attempts=job.attempts)
+
+
+def _beat(job: GenerationJob, stopped: threading.Event) -> None:
+    interval = _settings()['HEARTBEAT_INTERVAL']
+    try:
+        while not stopped.wait(interval):
+            if not _claim(job).update(heartbeat_at=timezone.now()):
+                return
+    finally:
+        close_old_connections()
+
+
+def run_job(job: GenerationJob) -> GenerationJob:
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=_beat, args=(job, stopped), name=f"job-{job.id}-heartbeat", daemon=True)
+    heartbeat.start()
+    try:
+        # Requests a user is waiting on go to the API first
+        with llm_priority(BULK):
+            result = execute_step(job)
+    except Exception as e:
+        # The traceback goes to the log; clients only get what kind of error
+        logger.exception("Generation job %s failed", job.id)
+        job.status = GenerationJob.STATUS_FAILED
+        job.error = f"Generation failed ({type(e).__name__})"
+    else:
+        # Store the result exactly as the /chat/ endpoint would return it
+        job.result = json.loads(json.dumps(result, cls=JSONEncoder))
+        job.status = GenerationJob.STATUS_SUCCEEDED
+        job.error = ''
+    finally:
+        stopped.set()
+        heartbeat.join()
+    job.finished_at = timezone.now()
+    # Only while the claim holds: a requeued job belongs to another worker now
+    if not _claim(job).update(status=job.status, result=job.result, error=job.error,
+                              finished_at=job.finished_at):
+        logger.warning("Generation job %s was requeued while it ran, dropping this result", job.id)
+        job.refresh_from_db()
+    return job
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+from django.conf import settings
+from dotenv import load_dotenv
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_openai.chat_models import ChatOpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from .llm_cache import get_llm_cache
+from .llm_scheduler import AsyncScheduledTransport, ScheduledTransport, reset_scheduler, scheduler_enabled
+from .tracing import LLMTracingHandler, arecord_http_response, record_http_response
+
+load_dotenv()
+
+# Process-level registry of model clients and compiled chains.
+#
+# Building a ChatOpenAI, a prompt template or an output parser is not free,
+# and every client owns its own HTTP connection pool. Everything here is built
+# once per process and shared by all requests, so the generator classes only
+# hold their per-request inputs and connections to the API are kept alive.
+#
+# httpx async clients are tied to the event loop they were first used on, so
+# anything used from async code is registered per event loop.
+#
+# Chat models come from the provider set in LLM_PROVIDER: the OpenAI API, or
+# a local model served by llama.cpp (core/local_llm.py), for all the models
+# the chains ask for or only those listed in MODELS.
+
+DEFAULT_HTTP_POOL = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,  # seconds
+    'TIMEOUT': 600.0,  # seconds, image and long chapter calls are slow
+}
+
+DEFAULT_LLM_PROVIDER = {
+    'BACKEND': 'openai',  # or 'llama_cpp'
+    'MODELS': None,  # model names the backend serves; None for all of them
+}
+
+_lock = threading.RLock()
+_sync_registry: Dict[Any, Any] = {}
+_loop_registries: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Any, Any]]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _pool_settings() -> Dict[str, Any]:
+    return {**DEFAULT_HTTP_POOL, **getattr(settings, 'LLM_HTTP_POOL', {})}
+
+
+def _current_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _registry() -> Dict[Any, Any]:
+    loop = _current_loop()
+    if loop is None:
+        return _sync_registry
+    with _lock:
+        return _loop_registries.setdefault(loop, {})
+
+
+def _get_or_build(key: Any, builder: Callable[[], Any]) -> Any:
+    registry = _registry()
+    with _lock:
+        if key not in registry:
+            registry[key] = builder()
+        return registry[key]
+
+
+def clear_registry() -> None:
+    """Drop every shared client and chain (used by tests and benchmarks)."""
+    with _lock:
+        _sync_registry.clear()
+        _loop_registries.clear()
+    reset_scheduler()
+
+
+def _pool_limits() -> httpx.Limits:
+    pool = _pool_settings()
+    return httpx.Limits(
+        max_connections=pool['MAX_CONNECTIONS'],
+        max_keepalive_connections=pool['MAX_KEEPALIVE_CONNECTIONS'],
+        keepalive_expiry=pool['KEEPALIVE_EXPIRY'],
+    )
+
+
+def _max_retries() -> int:
+    # The scheduler retries rate-limited and failed calls itself
+    return 0 if scheduler_enabled() else 2
+
+
+def get_http_client() -> httpx.Client:
+    def build():
+        return httpx.Client(
+            # Every API call waits for its turn in core/llm_scheduler.py
+            transport=ScheduledTransport(httpx.HTTPTransport(limits=_pool_limits())),
+            timeout=_pool_settings()['TIMEOUT'],
+            follow_redirects=True,
+            event_hooks={'response': [record_http_response]},
+        )
+    # The sync client is safe to share across threads and event loops
+    with _lock:
+        if 'http_client' not in _sync_registry:
+            _sync_registry['http_client'] = build()
+        return _sync_registry['http_client']
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    def build():
+        return httpx.AsyncClient(
+            transport=AsyncScheduledTransport(httpx.AsyncHTTPTransport(limits=_pool_limits())),
+            timeout=_pool_settings()['TIMEOUT'],
+            follow_redirects=True,
+            event_hooks={'response': [arecord_http_response]},
+        )
+    return _get_or_build('async_http_client', build)
+
+
+def _openai_chat_model(model: str, temperature: float) -> ChatOpenAI:
+    kwargs = {
+        'model': model,
+        'temperature': temperature,
+        'cache': get_llm_cache(),
+        'http_client': get_http_client(),
+        'max_retries': _max_retries(),
+        'callbacks': [LLMTracingHandler(model)],
+        # Report token usage for streamed responses too
+        'stream_usage': True,
+    }
+    if _current_loop() is not None:
+        kwargs['http_async_client'] = get_async_http_client()
+    return ChatOpenAI(**kwargs)
+
+
+def _llama_cpp_chat_model(model: str, temperature: float) -> BaseChatModel:
+    # Imported here so the OpenAI backend never needs llama.cpp
+    from .local_llm import ChatLocalLlama
+
+    return ChatLocalLlama(model_name=model, temperature=temperature, cache=get_llm_cache(),
+                          callbacks=[LLMTracingHandler(model)])
+
+
+PROVIDERS: Dict[str, Callable[[str, float], BaseChatModel]] = {
+    'openai': _openai_chat_model,
+    'llama_cpp': _llama_cpp_chat_model,
+}
+
+
+def _provider_settings() -> Dict[str, Any]:
+    return {**DEFAULT_LLM_PROVIDER, **getattr(settings, 'LLM_PROVIDER', {})}
+
+
+def get_provider(model: str) -> str:
+    options = _provider_settings()
+    if options['MODELS'] is not None and model not in options['MODELS']:
+        return 'openai'
+    return options['BACKEND']
+
+
+def get_chat_model(model: str = "gpt-3.5-turbo", temperature: float = 0.7) -> BaseChatModel:
+    """Shared chat model for ``model`` at ``temperature``, from its provider."""
+    provider = get_provider(model)
+    return _get_or_build(('chat_model', provider, model, temperature),
+                         lambda: PROVIDERS[provider](model, temperature))
+
+
+def get_chain(name: str, builder: Callable[[], Any]) -> Any:
+    """
+    Shared runnable registered under ``name``, built on first use. Chains
+    must not hold per-request state; pass that in when invoking them.
+    """
+    return _get_or_build(('chain', name), builder)
+
+
+def get_openai_client() -> OpenAI:
+    return _get_or_build('openai_client', lambda: OpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'), http_client=get_http_client(), max_retries=_max_retries()))
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    return _get_or_build('async_openai_client', lambda: AsyncOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'), http_client=get_async_http_client(),
+        max_retries=_max_retries()))
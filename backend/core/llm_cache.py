@@ -0,0 +1,224 @@
+import hashlib
+import json
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+from django.conf import settings
+from django.utils import timezone
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+# Defaults for the LLM_CACHE setting
+DEFAULT_CACHE_SETTINGS = {
+    'ENABLED': True,
+    'MEMORY_MAX_ENTRIES': 512,
+    'DATABASE': True,
+    'DATABASE_MAX_ENTRIES': 10000,
+    'TTL': 7 * 24 * 60 * 60,  # seconds
+}
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    """
+    Hash of the model configuration (model name, temperature, ...) and the
+    fully rendered prompt.
+    """
+    return hashlib.sha256(f"{llm_string}\x00{prompt}".encode()).hexdigest()
+
+
+def is_deterministic(llm_string: str) -> bool:
+    # llm_string is the serialized model followed by '---' and the call params
+    try:
+        model = json.loads(llm_string.split('---', 1)[0])
+    except ValueError:
+        return False
+    return model.get('kwargs', {}).get('temperature') == 0
+
+
+class MemoryTier:
+    """In-process LRU tier with per-entry expiry."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class DatabaseTier:
+    """Persistent tier stored in the LLMCacheEntry table."""
+
+    # Check the table size every this many writes rather than on each one
+    EVICTION_INTERVAL = 50
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._writes = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        from .models import LLMCacheEntry
+
+        entry = LLMCacheEntry.objects.filter(
+            key=key, expires_at__gt=timezone.now()
+        ).values_list('value', flat=True).first()
+        return entry
+
+    def set(self, key: str, value: str) -> None:
+        from .models import LLMCacheEntry
+
+        LLMCacheEntry.objects.update_or_create(
+            key=key,
+            defaults={
+                'value': value,
+                'expires_at': timezone.now() + timedelta(seconds=self.ttl),
+            },
+        )
+        self._writes += 1
+        if self._writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        from .models import LLMCacheEntry
+
+        deleted, _ = LLMCacheEntry.objects.filter(
+            expires_at__lte=timezone.now()).delete()
+        overflow = LLMCacheEntry.objects.count() - self.max_entries
+        if overflow > 0:
+            oldest = LLMCacheEntry.objects.order_by(
+                'created_at').values_list('id', flat=True)[:overflow]
+            extra, _ = LLMCacheEntry.objects.filter(id__in=list(oldest)).delete()
+            deleted += extra
+        self.evictions += deleted
+
+    def clear(self) -> None:
+        from .models import LLMCacheEntry
+
+        LLMCacheEntry.objects.all().delete()
+
+
+class LLMResponseCache(BaseCache):
+    """
+    Content-addressed cache for chat model responses.
+
+    Lookups go through the tiers in order (memory first, then database) and a
+    hit in a slower tier is copied into the faster ones. Only deterministic
+    (``temperature=0``) calls are cached; anything else is always a miss.
+    """
+
+    def __init__(self, tiers: Sequence[Any]):
+        self.tiers = list(tiers)
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {'hits': 0, 'misses': 0, 'writes': 0, 'skipped': 0}
+        self._tier_hits = [0] * len(self.tiers)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        if not is_deterministic(llm_string):
+            self._count('skipped')
+            return None
+
+        key = cache_key(prompt, llm_string)
+        for index, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is None:
+                continue
+            for faster in self.tiers[:index]:
+                faster.set(key, value)
+            with self._lock:
+                self._counters['hits'] += 1
+                self._tier_hits[index] += 1
+            with warnings.catch_warnings():
+                # langchain_core.load.loads is marked beta
+                warnings.simplefilter('ignore')
+                generations = loads(value)
+            for generation in generations:
+                # Lets callbacks (see core.tracing) tell cache hits from API calls
+                generation.generation_info = {**(generation.generation_info or {}), 'cached': True}
+            return generations
+
+        self._count('misses')
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if not is_deterministic(llm_string):
+            return
+        key = cache_key(prompt, llm_string)
+        value = dumps(return_val)
+        for tier in self.tiers:
+            tier.set(key, value)
+        self._count('writes')
+
+    def clear(self, **kwargs: Any) -> None:
+        for tier in self.tiers:
+            tier.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['tiers'] = [
+                {
+                    'tier': type(tier).__name__,
+                    'hits': hits,
+                    'evictions': getattr(tier, 'evictions', 0),
+                }
+                for tier, hits in zip(self.tiers, self._tier_hits)
+            ]
+        return stats
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """
+    Return the process-wide response cache configured by the ``LLM_CACHE``
+    setting, or None when caching is disabled.
+    """
+    global _llm_cache
+    config = {**DEFAULT_CACHE_SETTINGS, **getattr(settings, 'LLM_CACHE', {})}
+    if not config['ENABLED']:
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            tiers: List[Any] = [MemoryTier(config['MEMORY_MAX_ENTRIES'], config['TTL'])]
+            if config['DATABASE']:
+                tiers.append(DatabaseTier(config['DATABASE_MAX_ENTRIES'], config['TTL']))
+            _llm_cache = LLMResponseCache(tiers)
+    return _llm_cache
@@ -0,0 +1,393 @@
+import asyncio
+import contextvars
+import itertools
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from django.conf import settings
+
+from .tokens import count_tokens
+from .tracing import RETRYABLE_STATUSES, record_http_response
+
+# Every OpenAI API call (chat completions and image generations) goes
+# through one scheduler per process, at the HTTP transport of the shared
+# clients in core/llm.py.
+#
+# A call waits for a free slot (at most MAX_CONCURRENCY calls at a time) and
+# for its model's token buckets: requests and tokens per minute, the way the
+# API counts them. Waiting calls are served by priority, then in order:
+# the steps a user is waiting on (INTERACTIVE) go before the generation jobs
+# and prefetches (BULK). A call answered with 429 or a 5xx is retried after
+# a jittered exponential delay (or the Retry-After the API sent), and a 429
+# pauses the whole model for that long, so the calls queued behind it do not
+# hit the limit too.
+
+INTERACTIVE = 0
+BULK = 1
+
+DEFAULT_LLM_SCHEDULER = {
+    'ENABLED': True,
+    'MAX_CONCURRENCY': 16,
+    'MAX_RETRIES': 5,
+    'BASE_DELAY': 1.0,  # seconds before the first retry, doubled for each next one
+    'MAX_DELAY': 60.0,  # seconds
+    # Tokens a chat call is counted for when it does not set max_tokens
+    'COMPLETION_TOKENS': 1000,
+    # {'gpt-4o': {'RPM': 500, 'TPM': 30000}}; models not listed are not limited
+    'LIMITS': {},
+}
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar('llm_priority', default=INTERACTIVE)
+_lock = threading.Lock()
+_scheduler: Optional["LLMScheduler"] = None
+
+
+def _settings() -> Dict[str, Any]:
+    return {**DEFAULT_LLM_SCHEDULER, **getattr(settings, 'LLM_SCHEDULER', {})}
+
+
+def scheduler_enabled() -> bool:
+    return bool(_settings()['ENABLED'])
+
+
+@contextmanager
+def llm_priority(priority: int) -> Iterator[None]:
+    """Schedule the API calls made inside the block at ``priority``."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class TokenBucket:
+    """``per_minute`` units a minute, in bursts of up to a minute's worth."""
+
+    def __init__(self, per_minute: Optional[float]):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if self.capacity is not None:
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` can be taken, 0 if it can be now."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.capacity is None:
+            return 0.0
+        self._refill(now)
+        # A call bigger than the bucket goes once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60 / self.capacity
+
+    def take(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.available -= min(amount, self.capacity)
+
+    def pause(self, seconds: float, now: float) -> None:
+        self._refill(now)
+        self.paused_until = max(self.paused_until, now + seconds)
+        if self.capacity is not None:
+            self.available = 0.0
+
+
+class _Waiter:
+    def __init__(self, priority: int, order: int, model: str, tokens: int, wake: Callable[[], None]):
+        self.key = (priority, order)
+        self.model = model
+        self.tokens = tokens
+        self.wake = wake
+        self.granted = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.key < other.key
+
+
+class Slot:
+    """A granted call; ``release`` it once its response is read."""
+
+    def __init__(self, scheduler: "LLMScheduler"):
+        self.scheduler = scheduler
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler._release()
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrency: int, limits: Dict[str, Dict[str, Optional[int]]]):
+        self.max_concurrency = max_concurrency
+        self.limits = limits
+        self.active = 0
+        self._lock = threading.Lock()
+        self._waiters: List[_Waiter] = []
+        self._order = itertools.count()
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+
+    def _model_buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            limit = self.limits.get(model, {})
+            buckets = self._buckets[model] = (TokenBucket(limit.get('RPM')), TokenBucket(limit.get('TPM')))
+        return buckets
+
+    def _dispatch(self) -> Optional[float]:
+        """
+        Grant what the slots and buckets allow, in priority order. Returns
+        the seconds until a bucket could let the next waiter through, None
+        if only a released slot can. Called with the lock held.
+        """
+        now = time.monotonic()
+        blocked, next_check = set(), None
+        for waiter in sorted(self._waiters):
+            if self.active >= self.max_concurrency:
+                break
+            # Later waiters for a model must not overtake one that is waiting
+            if waiter.model in blocked:
+                continue
+            requests, tokens = self._model_buckets(waiter.model)
+            wait = max(requests.wait_time(1, now), tokens.wait_time(waiter.tokens, now))
+            if wait > 0:
+                blocked.add(waiter.model)
+                next_check = wait if next_check is None else min(next_check, wait)
+                continue
+            requests.take(1)
+            tokens.take(waiter.tokens)
+            self.active += 1
+            self._waiters.remove(waiter)
+            waiter.granted = True
+            waiter.wake()
+        return next_check
+
+    def _enqueue(self, model: str, tokens: int, priority: int, wake: Callable[[], None]) -> Tuple[_Waiter, Optional[float]]:
+        waiter = _Waiter(priority, next(self._order), model, tokens, wake)
+        with self._lock:
+            self._waiters.append(waiter)
+            return waiter, self._dispatch()
+
+    def acquire(self, model: str, tokens: int = 0, priority: Optional[int] = None) -> Slot:
+        """Block until a call to ``model`` using ``tokens`` may be made."""
+        event = threading.Event()
+        waiter, wait = self._enqueue(
+            model, tokens, current_priority() if priority is None else priority, event.set)
+        while not waiter.granted:
+            event.wait(wait)
+            with self._lock:
+                if not waiter.granted:
+                    wait = self._dispatch()
+        return Slot(self)
+
+    async def aacquire(self, model: str, tokens: int = 0, priority: Optional[int] = None) -> Slot:
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter, wait = self._enqueue(
+            model, tokens, current_priority() if priority is None else priority,
+            lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while not waiter.granted:
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                with self._lock:
+                    if not waiter.granted:
+                        wait = self._dispatch()
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        return Slot(self)
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        # Granted just as the caller gave up
+        self._release()
+
+    def _release(self) -> None:
+        with self._lock:
+            self.active -= 1
+            self._dispatch()
+
+    def pause(self, model: str, seconds: float) -> None:
+        """Let no call to ``model`` through for ``seconds`` (after a 429)."""
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self._model_buckets(model):
+                bucket.pause(seconds, now)
+
+
+def get_scheduler() -> LLMScheduler:
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            options = _settings()
+            _scheduler = LLMScheduler(options['MAX_CONCURRENCY'], options['LIMITS'])
+        return _scheduler
+
+
+def reset_scheduler() -> None:
+    """Forget the limits and the state of the buckets (used by tests)."""
+    global _scheduler
+    with _lock:
+        _scheduler = None
+
+
+def request_cost(request: httpx.Request) -> Tuple[Optional[str], int]:
+    """The model an API request is for and about how many tokens it will use."""
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, httpx.RequestNotRead):
+        return None, 0
+    if not isinstance(body, dict) or 'model' not in body:
+        return None, 0
+    messages = body.get('messages')
+    if not messages:
+        # Images are limited by requests only
+        return body['model'], 0
+    prompt = "\n".join(str(message.get('content') or '') for message in messages)
+    completion = (body.get('max_completion_tokens') or body.get('max_tokens')
+                  or _settings()['COMPLETION_TOKENS'])
+    return body['model'], count_tokens(prompt) + completion
+
+
+def should_retry(response: httpx.Response, attempt: int) -> bool:
+    retryable = response.status_code in RETRYABLE_STATUSES or response.status_code >= 500
+    return retryable and attempt < _settings()['MAX_RETRIES']
+
+
+def retry_delay(attempt: int, response: httpx.Response) -> float:
+    options = _settings()
+    retry_after = response.headers.get('retry-after')
+    try:
+        requested = float(retry_after) if retry_after else 0.0
+    except ValueError:
+        requested = 0.0
+    # Full jitter, so calls that failed together do not come back together
+    backoff = random.uniform(0, min(options['MAX_DELAY'], options['BASE_DELAY'] * 2 ** attempt))
+    return min(options['MAX_DELAY'], max(requested, backoff))
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    def __init__(self, stream: Any, slot: Slot):
+        self.stream = stream
+        self.slot = slot
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self.stream
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+        finally:
+            self.slot.release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: Any, slot: Slot):
+        self.stream = stream
+        self.slot = slot
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            self.slot.release()
+
+
+def _holding(response: httpx.Response, stream: Any, request: httpx.Request) -> httpx.Response:
+    # The slot is held until the body is read: a streamed chapter is still
+    # using the API after the headers have arrived
+    return httpx.Response(response.status_code, headers=response.headers, stream=stream,
+                          extensions=response.extensions, request=request)
+
+
+class ScheduledTransport(httpx.BaseTransport):
+    """Transport sending each API call when the scheduler lets it through."""
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = request_cost(request)
+        if model is None or not scheduler_enabled():
+            return self.transport.handle_request(request)
+        scheduler = get_scheduler()
+        attempt = 0
+        while True:
+            slot = scheduler.acquire(model, tokens)
+            try:
+                response = self.transport.handle_request(request)
+            except BaseException:
+                slot.release()
+                raise
+            if not should_retry(response, attempt):
+                return _holding(response, _ReleasingStream(response.stream, slot), request)
+            response.close()
+            slot.release()
+            response.request = request
+            record_http_response(response)
+            delay = retry_delay(attempt, response)
+            if response.status_code == 429:
+                scheduler.pause(model, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncScheduledTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = request_cost(request)
+        if model is None or not scheduler_enabled():
+            return await self.transport.handle_async_request(request)
+        scheduler = get_scheduler()
+        attempt = 0
+        while True:
+            slot = await scheduler.aacquire(model, tokens)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except BaseException:
+                slot.release()
+                raise
+            if not should_retry(response, attempt):
+                return _holding(response, _AsyncReleasingStream(response.stream, slot), request)
+            await response.aclose()
+            slot.release()
+            response.request = request
+            record_http_response(response)
+            delay = retry_delay(attempt, response)
+            if response.status_code == 429:
+                scheduler.pause(model, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
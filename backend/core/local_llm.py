@@ -0,0 +1,237 @@
+import os
+import queue
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Chat models served on the CPU from a GGUF file with llama.cpp, e.g. a
+# quantized export of the fine-tuned Llama 3.1 8B
+# (Fine_Tune_Llama_3_1_8B_with_Unsloth_Train_V2.ipynb). Needs the optional
+# llama-cpp-python package; see LLM_PROVIDER in core/llm.py.
+#
+# The model is loaded once per process and owned by one worker thread, which
+# serves every request in turn. Requests that arrive while it is busy are
+# taken together and served in the order that shares the most prompt with
+# the one before: llama.cpp keeps the evaluated prompt and only evaluates
+# what differs, so chapters of the same story (same system prompt and story
+# so far) follow each other and skip most of their prompt. A RAM cache keeps
+# the state of recent prompts too, for requests of different stories that
+# interleave.
+
+DEFAULT_LOCAL_LLM = {
+    'MODEL_PATH': None,
+    'N_CTX': 8192,  # tokens of prompt and answer
+    'N_THREADS': None,  # llama.cpp's default, the number of cores
+    'N_BATCH': 512,
+    'MAX_TOKENS': 2048,  # per answer
+    'CACHE_BYTES': 2 << 30,  # prompt states kept in RAM
+}
+
+_DONE = object()
+_lock = threading.Lock()
+_server: Optional["LocalInferenceServer"] = None
+
+
+def _settings() -> Dict[str, Any]:
+    return {**DEFAULT_LOCAL_LLM, **getattr(settings, 'LOCAL_LLM', {})}
+
+
+def _role(message: BaseMessage) -> str:
+    return {'human': 'user', 'ai': 'assistant', 'system': 'system'}.get(message.type, 'user')
+
+
+def _response_format(response_format: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # llama.cpp takes a JSON schema as {'type': 'json_object', 'schema': ...}
+    # and holds the model to it with a grammar
+    if response_format and response_format['type'] == 'json_schema':
+        return {'type': 'json_object', 'schema': response_format['json_schema']['schema']}
+    return response_format
+
+
+def _shared_prefix(a: str, b: str) -> int:
+    return len(os.path.commonprefix([a, b]))
+
+
+class _Request:
+    def __init__(self, messages: List[Dict[str, str]], options: Dict[str, Any]):
+        self.messages = messages
+        self.options = options
+        self.prompt = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        self.events: "queue.Queue[Any]" = queue.Queue()
+        self.cancelled = False
+
+    def results(self) -> Iterator[Any]:
+        """Text chunks, then the usage dict; raises what the worker raised."""
+        try:
+            while True:
+                event = self.events.get()
+                if event is _DONE:
+                    return
+                if isinstance(event, BaseException):
+                    raise event
+                yield event
+        finally:
+            # The caller stopped reading (e.g. a closed stream): stop generating
+            self.cancelled = True
+
+
+class LocalInferenceServer:
+    """The process's llama.cpp model and the worker thread that serves it."""
+
+    def __init__(self, model_path: str, options: Dict[str, Any]):
+        try:
+            from llama_cpp import Llama, LlamaRAMCache
+        except ImportError as e:
+            raise ImproperlyConfigured(
+                "LLM_PROVIDER uses llama_cpp, but llama-cpp-python is not installed "
+                "(pipenv run pip install llama-cpp-python)") from e
+        if not os.path.exists(model_path):
+            raise ImproperlyConfigured(f"LOCAL_LLM['MODEL_PATH'] does not exist: {model_path}")
+        self.model_path = model_path
+        self.max_tokens = options['MAX_TOKENS']
+        self.llama = Llama(
+            model_path=model_path,
+            n_ctx=options['N_CTX'],
+            n_threads=options['N_THREADS'],
+            n_batch=options['N_BATCH'],
+            verbose=False,
+        )
+        if options['CACHE_BYTES']:
+            self.llama.set_cache(LlamaRAMCache(capacity_bytes=options['CACHE_BYTES']))
+        self._pending: List[_Request] = []
+        self._ready = threading.Condition()
+        self._last_prompt = ""
+        threading.Thread(target=self._serve, name="local-llm", daemon=True).start()
+
+    def submit(self, messages: List[Dict[str, str]], **options: Any) -> _Request:
+        request = _Request(messages, options)
+        with self._ready:
+            self._pending.append(request)
+            self._ready.notify()
+        return request
+
+    def _take_batch(self) -> List[_Request]:
+        with self._ready:
+            while not self._pending:
+                self._ready.wait()
+            pending, self._pending = self._pending, []
+        # Each next request shares the most prompt with the one served before
+        # it; ties keep the order they arrived in
+        batch, previous = [], self._last_prompt
+        while pending:
+            request = max(pending, key=lambda r: _shared_prefix(previous, r.prompt))
+            pending.remove(request)
+            batch.append(request)
+            previous = request.prompt
+        return batch
+
+    def _serve(self) -> None:
+        while True:
+            for request in self._take_batch():
+                if not request.cancelled:
+                    self._run(request)
+
+    def _run(self, request: _Request) -> None:
+        try:
+            options = request.options
+            chunks = self.llama.create_chat_completion(
+                messages=request.messages,
+                temperature=options.get('temperature', 0.7),
+                max_tokens=options.get('max_tokens') or self.max_tokens,
+                stop=options.get('stop'),
+                response_format=_response_format(options.get('response_format')),
+                stream=True,
+            )
+            completion_tokens = 0
+            for chunk in chunks:
+                if request.cancelled:
+                    break
+                text = chunk['choices'][0]['delta'].get('content')
+                if text:
+                    # About one chunk per generated token
+                    completion_tokens += 1
+                    request.events.put(text)
+            self._last_prompt = request.prompt
+            request.events.put({
+                'input_tokens': max(self.llama.n_tokens - completion_tokens, 0),
+                'output_tokens': completion_tokens,
+                'total_tokens': self.llama.n_tokens,
+            })
+        except Exception as e:
+            request.events.put(e)
+        request.events.put(_DONE)
+
+
+def get_server() -> LocalInferenceServer:
+    """The process's server, loading the model on first use."""
+    global _server
+    with _lock:
+        if _server is None:
+            options = _settings()
+            if not options['MODEL_PATH']:
+                raise ImproperlyConfigured("LLM_PROVIDER uses llama_cpp, but LOCAL_LLM['MODEL_PATH'] is not set")
+            _server = LocalInferenceServer(str(options['MODEL_PATH']), options)
+        return _server
+
+
+class ChatLocalLlama(BaseChatModel):
+    """Chat model answered by the process's LocalInferenceServer."""
+
+    model_name: str = "local"
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "llama-cpp"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        # Part of the LLM cache key (core/llm_cache.py)
+        return {'model_name': self.model_name, 'temperature': self.temperature,
+                'model_path': str(_settings()['MODEL_PATH'])}
+
+    def _submit(self, messages: List[BaseMessage], stop: Optional[List[str]],
+                response_format: Optional[Dict[str, Any]] = None) -> _Request:
+        return get_server().submit(
+            [{'role': _role(m), 'content': str(m.content)} for m in messages],
+            temperature=self.temperature, max_tokens=self.max_tokens, stop=stop,
+            response_format=response_format)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        parts, usage = [], None
+        for event in self._submit(messages, stop, kwargs.get('response_format')).results():
+            if isinstance(event, dict):
+                usage = event
+            else:
+                parts.append(event)
+        message = AIMessage(content="".join(parts), usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)],
+                          llm_output={'model_name': self.model_name})
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for event in self._submit(messages, stop, kwargs.get('response_format')).results():
+            if isinstance(event, dict):
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=event))
+            else:
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=event))
+                if run_manager:
+                    run_manager.on_llm_new_token(event, chunk=chunk)
+            yield chunk
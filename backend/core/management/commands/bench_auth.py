@@ -0,0 +1,91 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from core.authentication import TokenAuthentication, token_cache
+from core.models import AuthToken, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Time token authentication against a large user table in a "
+        "throwaway test database: hashed indexed lookups with and without "
+        "the in-process cache, and an unindexed column lookup like the old "
+        "User.token for comparison."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--lookups', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.run_benchmark(**options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def populate(self, users, batch_size):
+        expires_at = timezone.now() + timedelta(days=30)
+        for start in range(0, users, batch_size):
+            end = min(start + batch_size, users)
+            created = User.objects.bulk_create([
+                # phone is an unindexed column, standing in for the old User.token
+                User(email=f'user{i}@example.com', password='-', phone=f'token-{i}')
+                for i in range(start, end)
+            ])
+            AuthToken.objects.bulk_create([
+                AuthToken(user=user, key_hash=AuthToken.hash_key(f'token-{i}'), expires_at=expires_at)
+                for i, user in zip(range(start, end), created)
+            ])
+
+    def time_lookups(self, lookup, keys):
+        timings = []
+        for key in keys:
+            start = time.perf_counter()
+            lookup(key)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def report(self, label, timings):
+        timings = sorted(timings)
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(
+            f'{label:<28} p50 {statistics.median(timings) * 1e6:10.1f}us  '
+            f'p99 {p99 * 1e6:10.1f}us')
+
+    def run_benchmark(self, users, lookups, batch_size, **options):
+        self.stdout.write(f'Creating {users} users...')
+        start = time.perf_counter()
+        self.populate(users, batch_size)
+        self.stdout.write(f'Done in {time.perf_counter() - start:.1f}s')
+
+        step = max(1, users // lookups)
+        keys = [f'token-{i}' for i in range(0, users, step)][:lookups]
+        factory = RequestFactory()
+        requests = {key: factory.get('/stories/', headers={'Authorization': key}) for key in keys}
+        authentication = TokenAuthentication()
+
+        token_cache.clear()
+        self.report('hashed token, uncached', self.time_lookups(
+            lambda key: (token_cache.clear(), authentication.authenticate(requests[key])), keys))
+
+        for key in keys:
+            authentication.authenticate(requests[key])
+        self.report('hashed token, cached', self.time_lookups(
+            lambda key: authentication.authenticate(requests[key]), keys))
+        token_cache.clear()
+
+        # The scan is slow, so only time a handful
+        scan_keys = keys[:max(1, min(20, len(keys)))]
+        self.report('unindexed column (old)', self.time_lookups(
+            lambda key: User.objects.get(phone=key), scan_keys))
@@ -0,0 +1,57 @@
+import contextlib
+import io
+import time
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from core.fakes import FakeChatModel
+from core.llm import clear_registry
+from core.story_generation import PARALLEL, SEQUENTIAL, StoryGenerator
+
+
+class Command(BaseCommand):
+    help = (
+        "Time sequential and parallel chapter generation with a fake model "
+        "of fixed latency and report the speedup. Needs no network or database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chapters', type=int, default=3)
+        parser.add_argument('--latency', type=float, default=1.0,
+                            help='Seconds the fake model takes per chapter.')
+        parser.add_argument('--max-concurrency', type=int, default=3)
+
+    def handle(self, *args, **options):
+        chapters = options['chapters']
+        outline = [['chapters', [
+            [['chapter_number', number], ['chapter_title', f'Chapter {number}']]
+            for number in range(1, chapters + 1)
+        ]]]
+
+        def fake_chat(**kwargs):
+            return FakeChatModel(responses=['# Chapter\n\nOnce upon a time...'],
+                                 latency=options['latency'])
+
+        timings = {}
+        # Shared models are built on first use, so drop them around the run
+        clear_registry()
+        try:
+            with mock.patch('core.llm.ChatOpenAI', fake_chat), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                for mode in (SEQUENTIAL, PARALLEL):
+                    story_gen = StoryGenerator(
+                        genre='Fantasy', topic='A benchmark story', outline=outline,
+                        questions_and_answers=['Q: Who?\nA: Alice'], characters='Alice',
+                        max_concurrency=options['max_concurrency'],
+                    )
+                    start = time.perf_counter()
+                    stories = story_gen.generate_stories(mode=mode)
+                    timings[mode] = time.perf_counter() - start
+                    assert len(stories) == chapters
+        finally:
+            clear_registry()
+
+        for mode, elapsed in timings.items():
+            self.stdout.write(f'{mode:<11} {chapters} chapters in {elapsed:6.2f}s')
+        self.stdout.write(f'speedup     {timings[SEQUENTIAL] / timings[PARALLEL]:.2f}x')
@@ -0,0 +1,103 @@
+import asyncio
+import contextlib
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.fakes import FakeChatModel
+from core.llm import clear_registry
+from core.models import Story, User
+
+OUTLINE_RESPONSE = json.dumps({"chapters": [
+    {"chapter_number": 1, "chapter_title": "The Beginning"},
+    {"chapter_number": 2, "chapter_title": "The Middle"},
+    {"chapter_number": 3, "chapter_title": "The End"},
+]})
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare how many concurrent outline requests the synchronous (WSGI) "
+        "and async (ASGI) story pipelines can serve, using a fake model with "
+        "a fixed latency. Runs against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Concurrent requests to send to each path.')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Worker threads available to the WSGI path.')
+        parser.add_argument('--latency', type=float, default=0.5,
+                            help='Seconds the fake model takes per call.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            self.run_benchmark(**options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run_benchmark(self, requests, workers, latency, **options):
+        user = User.objects.create(email='bench@example.com', password='-')
+        token = user.generate_token(name='bench')
+        story = Story.objects.create(title='Bench', genre='Fantasy', author=user)
+        payload = {
+            'step': 2,
+            'topic': 'A benchmark story',
+            'interview_questions': ['Who?', 'Where?'],
+            'answers': 'Alice\nWonderland',
+            'storyId': story.id,
+        }
+
+        def fake_chat(**kwargs):
+            return FakeChatModel(responses=[OUTLINE_RESPONSE], latency=latency)
+
+        def wsgi_request(_):
+            response = Client().post(
+                '/chat/', payload, content_type='application/json', headers={'Authorization': token})
+            return response.status_code
+
+        async def asgi_requests():
+            client = AsyncClient()
+            return await asyncio.gather(*[
+                client.post('/async/chat/', payload, content_type='application/json',
+                            headers={'Authorization': token})
+                for _ in range(requests)
+            ])
+
+        # Shared models are built on first use, so drop them around the run
+        clear_registry()
+        try:
+            with mock.patch('core.llm.ChatOpenAI', fake_chat), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    wsgi_statuses = list(pool.map(wsgi_request, range(requests)))
+                wsgi_elapsed = time.perf_counter() - start
+
+                start = time.perf_counter()
+                asgi_statuses = [r.status_code for r in asyncio.run(asgi_requests())]
+                asgi_elapsed = time.perf_counter() - start
+        finally:
+            clear_registry()
+
+        for label, statuses, elapsed in (
+            (f'WSGI ({workers} threads)', wsgi_statuses, wsgi_elapsed),
+            ('ASGI (1 event loop)', asgi_statuses, asgi_elapsed),
+        ):
+            failed = sum(1 for status in statuses if status != 200)
+            self.stdout.write(
+                f'{label:<22} {requests} requests in {elapsed:6.2f}s  '
+                f'{requests / elapsed:7.1f} req/s  '
+                f'in flight ~{requests * latency / elapsed:5.1f}  '
+                f'failed {failed}'
+            )
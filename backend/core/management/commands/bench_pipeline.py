@@ -0,0 +1,285 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from core import image_derivatives, prefetch
+from core.fakes import FakeChatModel, fake_image_transport, fake_png
+from core.llm import clear_registry
+from core.models import User
+from core.story_generation import PARALLEL, SEQUENTIAL
+
+INTERVIEW_RESPONSE = json.dumps({"questions": [
+    {"question": question} for question in (
+        "Who is the hero?", "Where does it happen?", "Who stands in the way?",
+        "What does the hero want?", "How should it end?",
+    )
+]})
+ANSWERS = "Alice\nWonderland\nThe Queen\nTo get home\nShe wakes up"
+CHARACTER_RESPONSE = json.dumps({"characters": [
+    {"name": "Alice", "appearance": "A curious girl in a blue dress",
+     "biography": "A girl who follows a white rabbit down a hole."},
+    {"name": "The Queen", "appearance": "A furious queen in red",
+     "biography": "The ruler of Wonderland, quick to anger."},
+]})
+CHAPTER_RESPONSE = "## Chapter\n\n" + "Alice walked on through the strange garden. " * 40
+
+# Steps of one simulated user's session, in order
+STEPS = ('create', 'interview', 'outline', 'characters', 'chapters',
+         'story_image', 'character_image', 'list_chapters')
+
+
+def outline_response(chapters):
+    return json.dumps({"chapters": [
+        {"chapter_number": number, "chapter_title": f"Chapter {number}"}
+        for number in range(1, chapters + 1)
+    ]})
+
+
+def acts_response(chapters):
+    # The outline step fits the counts to the chapters asked for
+    return json.dumps({"acts": [
+        {"act_number": number, "act_title": f"Act {number}",
+         "summary": "Alice goes deeper into Wonderland.", "chapter_count": chapters // 3}
+        for number in range(1, 4)
+    ]})
+
+
+def expansion_response(chapters):
+    # Each act keeps as many of these as it has chapters
+    return json.dumps({"chapters": [
+        {"chapter_number": number, "chapter_title": f"Chapter {number}",
+         "plot_points": ["Alice meets the Queen.", "Alice escapes."], "characters": ["Alice"]}
+        for number in range(1, chapters + 1)
+    ]})
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Run whole story sessions (interview, outline, characters, chapters, "
+        "images) through the views against a fake chat model and a fake image "
+        "endpoint, and report per-step latency and query counts, end-to-end "
+        "latency, throughput and peak memory. Needs no network; runs against "
+        "a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=4,
+                            help='Concurrent users, each running one full session.')
+        parser.add_argument('--sessions', type=int, default=1,
+                            help='Sessions each user runs one after another.')
+        parser.add_argument('--chapters', type=int, default=3)
+        parser.add_argument('--mode', choices=[SEQUENTIAL, PARALLEL], default=SEQUENTIAL)
+        parser.add_argument('--llm-latency', type=float, default=0.2,
+                            help='Seconds the fake model takes per call.')
+        parser.add_argument('--image-latency', type=float, default=0.5,
+                            help='Seconds the fake image endpoint takes per image.')
+        parser.add_argument('--image-size', type=int, default=1024,
+                            help='Width and height of the fake images, in pixels.')
+        parser.add_argument('--prompt-tokens', type=int, default=None,
+                            help='Prompt tokens each fake call reports (default: estimated).')
+        parser.add_argument('--completion-tokens', type=int, default=None,
+                            help='Completion tokens each fake call reports (default: estimated).')
+        parser.add_argument('--think-time', type=float, default=0.0,
+                            help='Seconds a user waits between steps.')
+        parser.add_argument('--prefetch', action='store_true',
+                            help='Enable speculative prefetch of the next step.')
+        parser.add_argument('--save', help='Write the results as JSON to this file.')
+        parser.add_argument('--baseline', help='Fail if results regress from this saved JSON file.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed regression against --baseline (0.2 = 20%%).')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        tracing_logger = logging.getLogger('core.tracing')
+        tracing_level = tracing_logger.level
+        # One JSON line per model call would drown the report
+        tracing_logger.setLevel(logging.WARNING)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(MEDIA_ROOT=media_root,
+                                      SEARCH_INDEX={'PATH': os.path.join(media_root, 'search.sqlite3')},
+                                      GENERATION_PREFETCH={'ENABLED': options['prefetch']}):
+                results = self.run_benchmark(options)
+        finally:
+            tracing_logger.setLevel(tracing_level)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.report(results)
+        if options['save']:
+            with open(options['save'], 'w') as file:
+                json.dump(results, file, indent=2)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def run_benchmark(self, options):
+        chat = dict(
+            responses=[CHAPTER_RESPONSE],
+            latency=options['llm_latency'],
+            routes=[
+                # Phrases of each chain's prompt; the schemas are not in
+                # the prompts when they go in the response format
+                ("interview a content expert", INTERVIEW_RESPONSE),
+                ("generate only", outline_response(options['chapters'])),
+                ("generate the characters information", CHARACTER_RESPONSE),
+                ("plan a long story", acts_response(options['chapters'])),
+                ("You are planning the chapters", expansion_response(options['chapters'])),
+            ],
+            prompt_tokens=options['prompt_tokens'],
+            completion_tokens=options['completion_tokens'],
+        )
+
+        def fake_chat(**kwargs):
+            return FakeChatModel(callbacks=kwargs.get('callbacks'), **chat)
+
+        image_client = httpx.Client(transport=fake_image_transport(
+            options['image_latency'], fake_png(options['image_size'])))
+
+        users = []
+        for number in range(options['users']):
+            user = User.objects.create(email=f'bench{number}@example.com', password='-')
+            users.append(user.generate_token(name='bench'))
+
+        def session(token):
+            client = Client(headers={'Authorization': token})
+            timings, queries = {}, {}
+
+            def call(step, method, path, data=None):
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = getattr(client, method)(path, data, content_type='application/json')
+                    timings[step] = time.perf_counter() - start
+                # Each thread has its own connection, so these are this request's queries
+                queries[step] = len(captured)
+                if response.status_code != 200:
+                    raise CommandError(f"{step} failed with {response.status_code}: {response.content[:200]}")
+                time.sleep(options['think_time'])
+                return response.json()
+
+            started = time.perf_counter()
+            story = call('create', 'post', '/stories/', {'title': 'Bench', 'genre': 'Fantasy'})
+            chat_step = {'storyId': story['id']}
+            call('interview', 'post', '/chat/', {**chat_step, 'step': 1, 'message': 'Alice in Wonderland'})
+            call('outline', 'post', '/chat/', {**chat_step, 'step': 2, 'answers': ANSWERS,
+                                              'chapters': options['chapters']})
+            call('characters', 'post', '/chat/', {**chat_step, 'step': 3})
+            call('chapters', 'post', '/chat/', {**chat_step, 'step': 4, 'generation_mode': options['mode']})
+            call('story_image', 'post', f"/stories/{story['id']}/generate-image/", {})
+            characters = call('list_characters', 'get', f"/stories/{story['id']}/characters/")
+            timings.pop('list_characters'), queries.pop('list_characters')
+            call('character_image', 'post', f"/characters/{characters[0]['id']}/generate-image/", {})
+            call('list_chapters', 'get', f"/stories/{story['id']}/chapters/")
+            return time.perf_counter() - started, timings, queries
+
+        def user_sessions(token):
+            return [session(token) for _ in range(options['sessions'])]
+
+        # Image renditions are made in the background after the response;
+        # they count towards memory but must finish before the database goes
+        renditions = []
+
+        def schedule_derivatives(instance):
+            renditions.append(image_derivatives.schedule_derivatives(instance))
+
+        # Shared models are built on first use, so drop them around the run
+        clear_registry()
+        prefetch.clear()
+        tracemalloc.start()
+        try:
+            with mock.patch('core.llm.ChatOpenAI', fake_chat), \
+                    mock.patch('core.llm.get_http_client', lambda: image_client), \
+                    mock.patch('core.signals.schedule_derivatives', schedule_derivatives), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=len(users)) as pool:
+                    sessions = [s for user in pool.map(user_sessions, users) for s in user]
+                elapsed = time.perf_counter() - start
+                for rendition in renditions:
+                    rendition.result()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            clear_registry()
+            prefetch.clear()
+            image_client.close()
+
+        end_to_end = [total for total, _, _ in sessions]
+        steps = {}
+        for step in STEPS:
+            latencies = [timings[step] for _, timings, _ in sessions]
+            counts = [queries[step] for _, _, queries in sessions]
+            steps[step] = {
+                'p50_ms': statistics.median(latencies) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'queries': max(counts),
+            }
+        return {
+            'users': options['users'],
+            'sessions': len(sessions),
+            'chapters': options['chapters'],
+            'mode': options['mode'],
+            'steps': steps,
+            'end_to_end_p50_ms': statistics.median(end_to_end) * 1000,
+            'end_to_end_p95_ms': percentile(end_to_end, 0.95) * 1000,
+            'sessions_per_minute': len(sessions) / elapsed * 60,
+            'peak_memory_mb': peak / (1024 * 1024),
+        }
+
+    def report(self, results):
+        self.stdout.write(
+            f"{results['sessions']} sessions, {results['users']} concurrent users, "
+            f"{results['chapters']} chapters ({results['mode']})")
+        self.stdout.write(f"{'step':<18}{'p50':>10}{'p95':>10}{'queries':>9}")
+        for step, row in results['steps'].items():
+            self.stdout.write(
+                f"{step:<18}{row['p50_ms']:>8.0f}ms{row['p95_ms']:>8.0f}ms{row['queries']:>9}")
+        self.stdout.write(
+            f"{'end to end':<18}{results['end_to_end_p50_ms']:>8.0f}ms{results['end_to_end_p95_ms']:>8.0f}ms")
+        self.stdout.write(f"throughput        {results['sessions_per_minute']:.1f} sessions/min")
+        self.stdout.write(f"peak memory       {results['peak_memory_mb']:.1f} MB (tracemalloc)")
+
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        regressions = []
+
+        def check(name, value, expected, higher_is_worse=True):
+            limit = expected * (1 + tolerance) if higher_is_worse else expected * (1 - tolerance)
+            if (value > limit) if higher_is_worse else (value < limit):
+                regressions.append(f"{name}: {value:.1f} (baseline {expected:.1f})")
+
+        for step, row in results['steps'].items():
+            expected = baseline['steps'].get(step)
+            if expected is None:
+                continue
+            # Query counts do not depend on timing, so they must not grow at all
+            check(f'{step} queries', row['queries'], expected['queries'] / (1 + tolerance))
+            check(f'{step} p95', row['p95_ms'], expected['p95_ms'])
+        check('end to end p95', results['end_to_end_p95_ms'], baseline['end_to_end_p95_ms'])
+        check('throughput', results['sessions_per_minute'], baseline['sessions_per_minute'],
+              higher_is_worse=False)
+        check('peak memory', results['peak_memory_mb'], baseline['peak_memory_mb'])
+
+        if regressions:
+            raise CommandError("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+        self.stdout.write(f"No regressions against {baseline_path}")
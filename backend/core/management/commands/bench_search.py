@@ -0,0 +1,97 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from core import search
+
+BATCH_SIZE = 1000
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill a throwaway search index with synthetic chapters and time "
+        "queries against it. Word frequencies follow a Zipf distribution, so "
+        "the queries mix common and rare words. Needs no database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chapters', type=int, default=100_000)
+        parser.add_argument('--authors', type=int, default=1,
+                            help='Authors the chapters are spread over; queries are for the first.')
+        parser.add_argument('--words', type=int, default=300, help='Words per chapter.')
+        parser.add_argument('--vocabulary', type=int, default=20_000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--max-ms', type=float, default=None,
+                            help='Fail if the p95 query time is above this.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        vocabulary = list({
+            "".join(rng.choices(letters, k=rng.randint(3, 10)))
+            for _ in range(options['vocabulary'])
+        })
+        rng.shuffle(vocabulary)
+        weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(SEARCH_INDEX={'PATH': os.path.join(directory, 'search.sqlite3')}):
+            start = time.perf_counter()
+            batch = []
+            for number in range(1, options['chapters'] + 1):
+                words = rng.choices(vocabulary, weights, k=options['words'])
+                batch.append(search.Document(
+                    search.CHAPTER, number, number // 20 + 1, number % options['authors'],
+                    " ".join(words[:4]), " ".join(words)))
+                if len(batch) >= BATCH_SIZE:
+                    search.write_documents(batch)
+                    batch = []
+            search.write_documents(batch)
+            conn = search.get_connection()
+            with conn:
+                conn.execute("INSERT INTO documents (documents) VALUES ('optimize')")
+            indexed = time.perf_counter() - start
+            size = os.path.getsize(search.index_path()) / (1024 * 1024)
+
+            timings, hits = {}, {}
+            # Frequent, middling and rare words, alone and in pairs
+            query_sets = {
+                'common word': lambda: rng.choice(vocabulary[:20]),
+                'rare word': lambda: rng.choice(vocabulary[-5000:]),
+                'two words': lambda: " ".join(rng.choices(vocabulary[:2000], k=2)),
+                'prefix': lambda: rng.choice(vocabulary[:2000])[:3],
+            }
+            for name, make_query in query_sets.items():
+                timings[name], hits[name] = [], []
+                for _ in range(options['queries']):
+                    query = make_query()
+                    start = time.perf_counter()
+                    results = search.search(0, query)
+                    timings[name].append(time.perf_counter() - start)
+                    hits[name].append(len(results))
+            search.close_connections()
+
+        self.stdout.write(
+            f"{options['chapters']} chapters of {options['words']} words indexed in "
+            f"{indexed:.1f}s ({size:.0f} MB)")
+        self.stdout.write(f"{'query':<14}{'p50':>10}{'p95':>10}{'results':>9}")
+        worst = 0.0
+        for name, values in timings.items():
+            p95 = percentile(values, 0.95) * 1000
+            worst = max(worst, p95)
+            self.stdout.write(
+                f"{name:<14}{statistics.median(values) * 1000:>8.1f}ms{p95:>8.1f}ms"
+                f"{statistics.mean(hits[name]):>9.1f}")
+        if options['max_ms'] is not None and worst > options['max_ms']:
+            raise CommandError(f"p95 query time {worst:.1f}ms is above {options['max_ms']}ms")
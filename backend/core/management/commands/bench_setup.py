@@ -0,0 +1,68 @@
+import contextlib
+import io
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.characters_generation import CharacterGenerator
+from core.expert_interview_chain import InterviewChain, build_interview_chain
+from core.llm import clear_registry, get_chain
+from core.story_generation import StoryGenerator
+from core.story_outline_generation import StoryOutlineGenerator
+
+OUTLINE = [['chapters', [
+    [['chapter_number', 1], ['chapter_title', 'The Beginning']],
+    [['chapter_number', 2], ['chapter_title', 'The End']],
+]]]
+
+SETUPS = {
+    'InterviewChain': lambda: get_chain(
+        "interview", build_interview_chain) and InterviewChain(topic='A story', genre='Fantasy'),
+    'StoryOutlineGenerator': lambda: StoryOutlineGenerator(
+        input='A story', genre='Fantasy', interview_questions_and_answers=['Q: Who?\nA: Alice']),
+    'CharacterGenerator': lambda: CharacterGenerator(
+        input='A story', genre='Fantasy', interview_questions_and_answers=['Q: Who?\nA: Alice']),
+    'StoryGenerator': lambda: StoryGenerator(
+        genre='Fantasy', topic='A story', outline=OUTLINE,
+        questions_and_answers=['Q: Who?\nA: Alice'], characters='Alice'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the per-request cost of setting up the generator classes, "
+        "rebuilding every client and chain each time (the old behaviour) "
+        "versus reusing the shared registry in core/llm.py. Makes no API calls."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+
+    def handle(self, *args, **options):
+        # Clients need a key to be constructed, but nothing is sent
+        os.environ.setdefault('OPENAI_API_KEY', 'sk-benchmark')
+        iterations = options['iterations']
+
+        self.stdout.write(f"{'setup':<24}{'rebuilt':>12}{'shared':>12}{'speedup':>10}")
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = {}
+            for name, setup in SETUPS.items():
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    clear_registry()
+                    setup()
+                rebuilt = (time.perf_counter() - start) / iterations
+
+                clear_registry()
+                setup()
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    setup()
+                shared = (time.perf_counter() - start) / iterations
+                results[name] = (rebuilt, shared)
+        clear_registry()
+
+        for name, (rebuilt, shared) in results.items():
+            self.stdout.write(
+                f'{name:<24}{rebuilt * 1e6:>10.0f}us{shared * 1e6:>10.0f}us{rebuilt / shared:>9.1f}x')
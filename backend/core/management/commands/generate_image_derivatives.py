@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.image_derivatives import create_derivatives, has_derivatives, record_derivatives
+from core.models import Character, Story
+
+
+class Command(BaseCommand):
+    help = "Create the thumbnail and medium WebP renditions for existing story and character images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Recreate renditions that already exist.')
+
+    def handle(self, *args, **options):
+        created = 0
+        for model in (Story, Character):
+            for instance in model.objects.exclude(image='').exclude(image__isnull=True).iterator():
+                if not options['force'] and has_derivatives(instance):
+                    continue
+                try:
+                    create_derivatives(instance.image)
+                    record_derivatives(instance)
+                except (OSError, ValueError) as exc:
+                    self.stderr.write(f"{model.__name__} {instance.pk}: {exc}")
+                    continue
+                created += 1
+        self.stdout.write(f"Created renditions for {created} images")
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from core import search
+from core.models import Chapter, Character, Story
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Index every story, chapter and character for full-text search. "
+        "Needed once for content written before the index existed; after "
+        "that the index is kept up to date on save and delete."
+    )
+
+    def handle(self, *args, **options):
+        if search.uses_fulltext():
+            self.stdout.write("The database keeps its own FULLTEXT indexes, nothing to rebuild")
+            return
+        conn = search.get_connection()
+        with conn:
+            conn.execute("DELETE FROM documents")
+        authors = dict(Story.objects.values_list('id', 'author_id'))
+
+        written = search.write_documents(
+            search.story_document(story)
+            for story in Story.objects.only('id', 'author_id', 'title', 'summary').iterator())
+        batch = []
+        querysets = (
+            (search.chapter_document, Chapter.objects.only('id', 'story_id', 'title', 'content')),
+            (search.character_document, Character.objects.only('id', 'story_id', 'name', 'biography')),
+        )
+        for document, queryset in querysets:
+            for instance in queryset.iterator(chunk_size=BATCH_SIZE):
+                batch.append(document(instance, authors[instance.story_id]))
+                if len(batch) >= BATCH_SIZE:
+                    written += search.write_documents(batch)
+                    batch = []
+        written += search.write_documents(batch)
+
+        with conn:
+            # Merge the index segments so queries read as few as possible
+            conn.execute("INSERT INTO documents (documents) VALUES ('optimize')")
+        self.stdout.write(f"Indexed {written} documents in {search.index_path()}")
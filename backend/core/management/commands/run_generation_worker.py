@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued story generation jobs. The queue lives in the "
+        "database, so start more of these processes to raise throughput."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--stale-after', type=int, default=None,
+                            help='Requeue running jobs without a heartbeat for this many seconds '
+                                 '(default: GENERATION_JOBS["STALE_AFTER"]).')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty.')
+
+    def handle(self, *args, **options):
+        stale_after = options['stale_after'] and timedelta(seconds=options['stale_after'])
+        self.stdout.write("Generation worker started")
+        while True:
+            close_old_connections()
+            job = claim_next_job(stale_after=stale_after)
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f"Running job {job.id} ({job.step}) for story {job.story_id}")
+            job = run_job(job)
+            self.stdout.write(f"Job {job.id} {job.status}")
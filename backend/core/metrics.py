@@ -0,0 +1,126 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+# Minimal in-process metrics registry rendered in the Prometheus text format
+# (served at /metrics/). Each worker process keeps its own values, so scrape
+# every worker (or run a single one) to get complete numbers.
+
+# Seconds; generation calls range from sub-second cache hits to minutes
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_metrics: Dict[str, "Metric"] = {}
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with _lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, amount: float, **labels: str) -> None:
+        key = self._key(labels)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, amount)] += 1
+            self._values[key] = (counts, total + amount)
+
+    def count(self, **labels: str) -> int:
+        with _lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _register(metric: Metric) -> Metric:
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render_metrics() -> str:
+    """Every registered metric in the Prometheus text exposition format."""
+    with _lock:
+        metrics = list(_metrics.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_story_genre'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chapter',
+            name='characters',
+        ),
+        migrations.CreateModel(
+            name='GenerationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step', models.CharField(choices=[('outline', 'Outline'), ('characters', 'Characters'), ('chapters', 'Chapters')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generation_jobs', to='core.story')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='core_genera_status_28bc31_idx')],
+            },
+        ),
+    ]
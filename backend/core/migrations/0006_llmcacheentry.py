@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_generationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('value', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
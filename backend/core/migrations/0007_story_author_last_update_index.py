@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_llmcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['author', '-last_update', '-id'], name='core_story_author__328b9a_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 20:57
+
+import hashlib
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def copy_user_tokens(apps, schema_editor):
+    # Keep existing logins working: store the hash of each user's token
+    User = apps.get_model('core', 'User')
+    AuthToken = apps.get_model('core', 'AuthToken')
+    expires_at = timezone.now() + timedelta(seconds=settings.AUTH_TOKEN_TTL)
+    AuthToken.objects.bulk_create([
+        AuthToken(
+            user_id=user_id,
+            key_hash=hashlib.sha256(token.encode()).hexdigest(),
+            expires_at=expires_at,
+        )
+        for user_id, token in User.objects.exclude(token__isnull=True).exclude(token='')
+        .values_list('id', 'token')
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_story_author_last_update_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_hash', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='auth_tokens', to='core.user')),
+            ],
+        ),
+        migrations.RunPython(copy_user_tokens, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='user',
+            name='token',
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 21:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_authtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationSession',
+            fields=[
+                ('story', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='generation_session', serialize=False, to='core.story')),
+                ('topic', models.TextField(blank=True, default='')),
+                ('interview_questions', models.JSONField(blank=True, null=True)),
+                ('interview_data', models.JSONField(blank=True, null=True)),
+                ('outline', models.JSONField(blank=True, null=True)),
+                ('characters', models.JSONField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_generationsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoalescedCall',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(db_index=True)),
+                ('finished_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_coalescedcall'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChapterSummary',
+            fields=[
+                ('chapter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='core.chapter')),
+                ('source_hash', models.CharField(max_length=64)),
+                ('summary', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_chaptersummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='image_renditions',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='image_renditions',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='requested_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='generation_jobs', to='core.user'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_generationjob_requested_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
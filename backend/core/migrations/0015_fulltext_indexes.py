@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# Searched with MATCH ... AGAINST on MySQL (see core/search.py); other
+# engines search an FTS5 file instead
+FULLTEXT_INDEXES = (
+    ('core_story', 'core_story_fulltext', ('title', 'summary')),
+    ('core_chapter', 'core_chapter_fulltext', ('title', 'content')),
+    ('core_character', 'core_character_fulltext', ('name', 'biography')),
+)
+
+
+def add_fulltext_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    quote = schema_editor.quote_name
+    for table, name, columns in FULLTEXT_INDEXES:
+        schema_editor.execute(
+            f"CREATE FULLTEXT INDEX {quote(name)} ON {quote(table)} "
+            f"({', '.join(quote(column) for column in columns)})")
+
+
+def remove_fulltext_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    quote = schema_editor.quote_name
+    for table, name, _ in FULLTEXT_INDEXES:
+        schema_editor.execute(f"DROP INDEX {quote(name)} ON {quote(table)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_generationjob_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_fulltext_indexes, remove_fulltext_indexes),
+    ]
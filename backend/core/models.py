@@ -1,5 +1,9 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 import hashlib
 
@@ -8,7 +12,6 @@ class User(models.Model):
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=255, blank=True, null=True)
     password = models.CharField(max_length=255)  # Store hashed passwords
-    token = models.CharField(max_length=64, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -24,12 +27,40 @@ class User(models.Model):
         hashed_password = hashlib.sha256(raw_password.encode()).hexdigest()
         return self.password == hashed_password
 
-    def generate_token(self):
-        # Generate a random token and save it
+    def generate_token(self, name=''):
+        # Generate a random token for one device and store only its hash
         # Generates a 64-character random string
-        self.token = get_random_string(64)
-        self.save()
-        return self.token
+        token = get_random_string(64)
+        AuthToken.objects.create(
+            user=self,
+            key_hash=AuthToken.hash_key(token),
+            name=name or '',
+            expires_at=timezone.now() + timedelta(seconds=settings.AUTH_TOKEN_TTL),
+        )
+        return token
+
+
+class AuthToken(models.Model):
+    """
+    A login token for one device. Only the SHA-256 of the token is stored,
+    under a unique index, so authentication is a single indexed lookup.
+    """
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='auth_tokens')
+    key_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    @staticmethod
+    def hash_key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def is_expired(self):
+        return self.expires_at <= timezone.now()
+
+    def __str__(self):
+        return f"{self.user.email} - {self.name or self.key_hash[:8]}"
 
 
 class Story(models.Model):
@@ -42,6 +73,15 @@ class Story(models.Model):
     author = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='stories')
     image = models.ImageField(upload_to='story_images/', null=True, blank=True)
+    # Name of the image the WebP renditions were created from (see
+    # core/image_derivatives.py); they are current when it matches image
+    image_renditions = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a user's stories, newest first
+            models.Index(fields=['author', '-last_update', '-id']),
+        ]
 
     def delete(self, *args, **kwargs):
         # Delete related chapters and characters explicitly
@@ -74,6 +114,22 @@ class Chapter(models.Model):
     #     super().delete(*args, **kwargs)
 
 
+class ChapterSummary(models.Model):
+    """
+    Summary of a chapter, kept until the chapter's title or content change
+    (see core.story_summary).
+    """
+    chapter = models.OneToOneField(
+        Chapter, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    # sha256 of the title and content the summary was written from
+    source_hash = models.CharField(max_length=64)
+    summary = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.chapter} - summary"
+
+
 class Character(models.Model):
     name = models.CharField(max_length=255)
     appearance = models.TextField()
@@ -82,6 +138,7 @@ class Character(models.Model):
         Story, on_delete=models.CASCADE, related_name='characters')
     image = models.ImageField(
         upload_to='character_images/', null=True, blank=True)
+    image_renditions = models.CharField(max_length=100, blank=True, default='')
 
     def __str__(self):
         return self.name
@@ -92,3 +149,104 @@ class Character(models.Model):
     #         raise ValidationError(
     #             "Cannot delete character. It is still associated with chapters.")
     #     super().delete(*args, **kwargs)
+
+
+class GenerationJob(models.Model):
+    """
+    A queued story generation step (outline, characters or chapters).
+
+    The table doubles as the job queue: web requests insert pending jobs and
+    ``manage.py run_generation_worker`` processes claim and run them.
+    """
+    STEP_OUTLINE = 'outline'
+    STEP_CHARACTERS = 'characters'
+    STEP_CHAPTERS = 'chapters'
+    STEP_CHOICES = [
+        (STEP_OUTLINE, 'Outline'),
+        (STEP_CHARACTERS, 'Characters'),
+        (STEP_CHAPTERS, 'Chapters'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    story = models.ForeignKey(
+        Story, on_delete=models.CASCADE, related_name='generation_jobs')
+    # Who queued the job; it only runs while they still own the story
+    requested_by = models.ForeignKey(
+        User, on_delete=models.CASCADE, null=True, blank=True, related_name='generation_jobs')
+    step = models.CharField(max_length=20, choices=STEP_CHOICES)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    payload = models.JSONField(default=dict)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed by the worker running the job; a running job whose heartbeat
+    # stops is put back in the queue
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"{self.story.title} - {self.step} ({self.status})"
+
+
+class GenerationSession(models.Model):
+    """
+    Results of the story generation chat so far, kept on the server so each
+    step only needs the story id instead of the client sending them back.
+
+    The structured results are stored as the ``model_dump()`` of their
+    pydantic objects (see core.generation_session).
+    """
+    story = models.OneToOneField(
+        Story, on_delete=models.CASCADE, primary_key=True, related_name='generation_session')
+    topic = models.TextField(blank=True, default='')
+    interview_questions = models.JSONField(null=True, blank=True)
+    # "Q: ...\nA: ..." pairs once the questions have been answered
+    interview_data = models.JSONField(null=True, blank=True)
+    outline = models.JSONField(null=True, blank=True)
+    characters = models.JSONField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.story.title} - generation session"
+
+
+class LLMCacheEntry(models.Model):
+    """Persistent tier of the LLM response cache (see core.llm_cache)."""
+    key = models.CharField(max_length=64, unique=True)
+    value = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+class CoalescedCall(models.Model):
+    """
+    A generation step running in some process, and then its result for a
+    while, so identical requests wait for it instead of repeating it (see
+    core.single_flight).
+    """
+    key = models.CharField(max_length=64, unique=True)
+    result = models.JSONField(null=True, blank=True)
+    started_at = models.DateTimeField(db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,94 @@
+import base64
+import datetime
+import json
+
+from django.db.models import DateTimeField, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination:
+    """
+    Keyset (cursor) pagination over a unique ordering such as
+    ``('-last_update', '-id')``.
+
+    The cursor holds the ordering values of the last row of the previous
+    page, so each page is a single indexed range query however deep the
+    client has scrolled, and rows added in the meantime do not shift pages.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+
+    def __init__(self, ordering, default_limit=20, max_limit=100):
+        self.ordering = ordering
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+
+    @staticmethod
+    def is_requested(request):
+        return ('cursor' in request.query_params
+                or 'limit' in request.query_params)
+
+    def _fields(self):
+        return [(field.lstrip('-'), field.startswith('-')) for field in self.ordering]
+
+    def _limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, self.default_limit))
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer.'})
+        return max(1, min(limit, self.max_limit))
+
+    def _encode_cursor(self, row):
+        values = [getattr(row, name) for name, _ in self._fields()]
+        # Full precision: DjangoJSONEncoder would drop the microseconds
+        raw = json.dumps([
+            value.isoformat() if isinstance(value, datetime.datetime) else value
+            for value in values
+        ])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def _decode_cursor(self, queryset, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            raise ValidationError({'cursor': 'Invalid cursor.'})
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise ValidationError({'cursor': 'Invalid cursor.'})
+
+        decoded = []
+        for (name, _), value in zip(self._fields(), values):
+            if isinstance(queryset.model._meta.get_field(name), DateTimeField):
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValidationError({'cursor': 'Invalid cursor.'})
+            decoded.append(value)
+        return decoded
+
+    def _after(self, values):
+        # (a, b) > (x, y) for the ordering's direction:
+        # a > x OR (a = x AND b > y), expanded for any number of fields
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(self._fields(), values):
+            lookup = 'lt' if descending else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def paginate_queryset(self, queryset, request):
+        """Return the rows of the requested page and the next page's URL."""
+        limit = self._limit(request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self._after(self._decode_cursor(queryset, cursor)))
+
+        rows = list(queryset[:limit + 1])
+        next_url = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_url = replace_query_param(
+                request.build_absolute_uri(), self.cursor_query_param, self._encode_cursor(rows[-1]))
+        return rows, next_url
@@ -2,4 +2,5 @@ from rest_framework.permissions import BasePermission
 
 class IsAuthenticatedCustom(BasePermission):
     def has_permission(self, request, view):
-        return bool(request.user and request.user.token)
+        # request.auth is the AuthToken set by TokenAuthentication
+        return bool(request.user and request.auth)
@@ -0,0 +1,92 @@
+from typing import Iterable, List, Sequence, Tuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Chapter, Character, Story
+from .search import index_story_on_commit
+from .story_summary import deferred_summary_update
+
+# Writes for the results of the generation pipeline. Each function runs a
+# fixed number of queries however many rows it writes, and can be re-run
+# for the same story (e.g. when a step is retried) without duplicating or
+# conflicting rows.
+
+
+def _touch_story(story: Story) -> None:
+    # Bulk writes skip the post_save signals that normally bump last_update
+    # and update the search index
+    story.last_update = timezone.now()
+    Story.objects.filter(pk=story.pk).update(last_update=story.last_update)
+    index_story_on_commit(story.pk)
+
+
+def save_characters(story: Story, characters: Iterable) -> List[Character]:
+    """
+    Save generated characters for ``story``, updating the ones whose name
+    already exists instead of adding duplicates.
+    """
+    characters = list(characters)
+    with transaction.atomic():
+        existing = {
+            character.name: character
+            for character in Character.objects.filter(
+                story=story, name__in=[c.name for c in characters])
+        }
+        to_update, to_create = [], []
+        for generated in characters:
+            character = existing.get(generated.name)
+            if character is None:
+                to_create.append(Character(
+                    story=story,
+                    name=generated.name,
+                    appearance=generated.appearance,
+                    biography=generated.biography,
+                ))
+                continue
+            character.appearance = generated.appearance
+            character.biography = generated.biography
+            to_update.append(character)
+
+        if to_update:
+            Character.objects.bulk_update(to_update, ['appearance', 'biography'])
+        if to_create:
+            Character.objects.bulk_create(to_create)
+        _touch_story(story)
+    return to_update + to_create
+
+
+def save_chapters(story: Story, chapters: Sequence[Tuple[str, str]]) -> List[Chapter]:
+    """
+    Save ``(title, content)`` pairs as chapters 1..n of ``story`` with one
+    upsert on ``(story, position)``; chapters past n are deleted.
+    """
+    rows = [
+        Chapter(story=story, position=position, title=title, content=content)
+        for position, (title, content) in enumerate(chapters, start=1)
+    ]
+    # MySQL's ON DUPLICATE KEY UPDATE cannot name the conflicting columns
+    unique_fields = (['story', 'position']
+                     if connection.features.supports_update_conflicts_with_target else None)
+    # Held until the deletes below commit, which then update the summary once
+    with deferred_summary_update(story.pk), transaction.atomic():
+        if rows:
+            Chapter.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=unique_fields,
+                update_fields=['title', 'content'],
+            )
+        # Left over from an earlier, longer generation
+        Chapter.objects.filter(story=story, position__gt=len(rows)).delete()
+        _touch_story(story)
+    return rows
+
+
+def save_chapter(story: Story, position: int, title: str, content: str) -> Chapter:
+    """Save a single chapter as soon as it is generated (e.g. when streaming)."""
+    chapter, _ = Chapter.objects.update_or_create(
+        story=story, position=position,
+        defaults={'title': title, 'content': content},
+    )
+    return chapter
@@ -0,0 +1,239 @@
+from typing import Any, Dict, Iterator, List, Tuple
+
+from asgiref.sync import sync_to_async
+
+from .characters_generation import CharacterGenerator
+from .expert_interview_chain import InterviewChain
+from .generation_session import store_step
+from .models import Story
+from .persistence import save_chapters, save_characters
+from .prefetch import aresult_of, prefetch, result_of, take
+from .story_generation import SEQUENTIAL, create_story_generator
+from .story_outline_generation import DEFAULT_CHAPTERS, ActsOutline, StoryOutlineGenerator
+from .story_summary import summarize_story
+from .title_selection_chain import TitleGenerator
+from .tracing import trace_step, tracing_scope
+
+# Steps 1-6 of the story generation chat. Each function takes the inputs of
+# its step and returns the same payload StoryGenerationView responds with, so
+# the steps can run either inside the request or on a generation worker.
+# Results the later steps need are saved to the story's generation session.
+# The outline and the characters can be streamed too (StoryStreamView): the
+# ``stream_*`` functions yield each chapter or character as soon as it is
+# written, as a plain dict, and last a ``done`` event with the step's payload.
+# The ``arun_*`` functions are the same steps for the async views: the model
+# calls are awaited and the rest runs through the same helpers.
+
+
+def interview_data_from_answers(interview_questions: List[str], answers: List[str]) -> List[str]:
+    return [
+        f"Q: {q}\nA: {a}" for q, a in zip(interview_questions, answers)
+    ]
+
+
+def generate_characters(genre: str, topic: str, interview_data: List[str]) -> Any:
+    character_generator = CharacterGenerator(
+        input=topic, genre=genre, interview_questions_and_answers=interview_data
+    )
+    return character_generator.generate_character()
+
+
+async def agenerate_characters(genre: str, topic: str, interview_data: List[str]) -> Any:
+    character_generator = CharacterGenerator(
+        input=topic, genre=genre, interview_questions_and_answers=interview_data
+    )
+    return await character_generator.agenerate_character()
+
+
+def generate_chapters(genre: str, topic: str, interview_data: List[str], outline_result: Any,
+                      character_result: Any, mode: str = SEQUENTIAL) -> List[Tuple[str, str]]:
+    """``(title, content)`` of every chapter in the outline."""
+    story_gen = create_story_generator(
+        topic=topic, outline=outline_result,
+        questions_and_answers=interview_data, characters=character_result, genre=genre
+    )
+    stories = story_gen.generate_stories(mode=mode)
+    return [
+        (chapter.chapter_title, content)
+        for chapter, content in zip(story_gen.outline.chapters, stories)
+    ]
+
+
+async def agenerate_chapters(genre: str, topic: str, interview_data: List[str], outline_result: Any,
+                             character_result: Any, mode: str = SEQUENTIAL) -> List[Tuple[str, str]]:
+    story_gen = create_story_generator(
+        topic=topic, outline=outline_result,
+        questions_and_answers=interview_data, characters=character_result, genre=genre
+    )
+    stories = await story_gen.agenerate_stories(mode=mode)
+    return [
+        (chapter.chapter_title, content)
+        for chapter, content in zip(story_gen.outline.chapters, stories)
+    ]
+
+
+def run_interview_step(story: Story, topic: str) -> dict:
+    interview_chain = InterviewChain(topic=topic, genre=story.genre)
+    with trace_step(story.pk, 'interview'):
+        interview_questions_obj = interview_chain()
+    return finish_interview_step(story, topic, interview_questions_obj)
+
+
+async def arun_interview_step(story: Story, topic: str) -> dict:
+    interview_chain = InterviewChain(topic=topic, genre=story.genre)
+    with trace_step(story.pk, 'interview'):
+        interview_questions_obj = await interview_chain.acall()
+    return await sync_to_async(finish_interview_step)(story, topic, interview_questions_obj)
+
+
+def finish_interview_step(story: Story, topic: str, interview_questions_obj: Any) -> dict:
+    store_step(story, topic=topic, interview_questions=interview_questions_obj)
+    return {
+        'step': 2,
+        'interview_questions': [q.question for q in interview_questions_obj.questions],
+        'topic': topic
+    }
+
+
+def run_outline_step(story: Story, topic: str, interview_data: List[str],
+                     chapters: int = DEFAULT_CHAPTERS) -> dict:
+    outline_generator = StoryOutlineGenerator(
+        input=topic, genre=story.genre, interview_questions_and_answers=interview_data,
+        chapters=chapters
+    )
+    with trace_step(story.pk, 'outline'):
+        outline_result = outline_generator.generate_outline()
+    return finish_outline_step(story, topic, interview_data, outline_result)
+
+
+async def arun_outline_step(story: Story, topic: str, interview_data: List[str],
+                            chapters: int = DEFAULT_CHAPTERS) -> dict:
+    outline_generator = StoryOutlineGenerator(
+        input=topic, genre=story.genre, interview_questions_and_answers=interview_data,
+        chapters=chapters
+    )
+    with trace_step(story.pk, 'outline'):
+        outline_result = await outline_generator.agenerate_outline()
+    return await sync_to_async(finish_outline_step)(story, topic, interview_data, outline_result)
+
+
+def stream_outline_step(story: Story, topic: str, interview_data: List[str],
+                        chapters: int = DEFAULT_CHAPTERS) -> Iterator[Dict[str, Any]]:
+    outline_generator = StoryOutlineGenerator(
+        input=topic, genre=story.genre, interview_questions_and_answers=interview_data,
+        chapters=chapters
+    )
+    with trace_step(story.pk, 'outline'):
+        for event in outline_generator.stream_outline():
+            if event['event'] == 'outline':
+                outline_result = event['result']
+            else:
+                name = event['event']
+                yield {'event': name, name: event[name].model_dump()}
+    yield {'event': 'done', **finish_outline_step(story, topic, interview_data, outline_result)}
+
+
+def finish_outline_step(story: Story, topic: str, interview_data: List[str], outline_result: Any) -> dict:
+    store_step(story, topic=topic, interview_data=interview_data, outline=outline_result)
+    # The characters need nothing more from the user, start them while they read the outline
+    with tracing_scope(story.pk, 'characters'):
+        prefetch(generate_characters, story.genre, topic, interview_data)
+    return {
+        'step': 3,
+        'outline_result': outline_result,
+        'interview_questions': interview_data,
+        'topic': topic,
+    }
+
+
+def run_character_step(story: Story, topic: str, interview_questions: List[str], outline_result: Any) -> dict:
+    with trace_step(story.pk, 'characters'):
+        character_result = result_of(generate_characters, story.genre, topic, interview_questions)
+    return finish_character_step(story, topic, interview_questions, outline_result, character_result)
+
+
+async def arun_character_step(story: Story, topic: str, interview_questions: List[str],
+                              outline_result: Any) -> dict:
+    with trace_step(story.pk, 'characters'):
+        character_result = await aresult_of(
+            generate_characters, agenerate_characters, story.genre, topic, interview_questions)
+    return await sync_to_async(finish_character_step)(
+        story, topic, interview_questions, outline_result, character_result)
+
+
+def stream_character_step(story: Story, topic: str, interview_questions: List[str],
+                          outline_result: Any) -> Iterator[Dict[str, Any]]:
+    with trace_step(story.pk, 'characters'):
+        future = take(generate_characters, story.genre, topic, interview_questions)
+        if future is not None and future.exception() is None:
+            # Prefetched, so they are all written already
+            character_result = future.result()
+            for character in character_result.characters:
+                yield {'event': 'character', 'character': character.model_dump()}
+        else:
+            character_generator = CharacterGenerator(
+                input=topic, genre=story.genre, interview_questions_and_answers=interview_questions
+            )
+            for event in character_generator.stream_characters():
+                if event['event'] == 'characters':
+                    character_result = event['result']
+                else:
+                    yield {'event': 'character', 'character': event['character'].model_dump()}
+    yield {'event': 'done', **finish_character_step(
+        story, topic, interview_questions, outline_result, character_result)}
+
+
+def finish_character_step(story: Story, topic: str, interview_questions: List[str], outline_result: Any,
+                          character_result: Any) -> dict:
+    # Create and save the characters for the current story
+    save_characters(story, character_result.characters)
+    store_step(story, characters=character_result)
+    # Likewise the chapters, in the default mode, while they read the characters.
+    # A long story is too much work to start on speculation.
+    if not isinstance(outline_result, ActsOutline):
+        with tracing_scope(story.pk, 'chapters'):
+            prefetch(generate_chapters, story.genre, topic, interview_questions, outline_result,
+                     character_result, SEQUENTIAL)
+
+    return {
+        'step': 4,
+        'character_result': character_result,
+        'outline_result': outline_result,
+        'topic': topic
+    }
+
+
+def run_chapter_step(story: Story, topic: str, interview_questions: List[str], outline_result: Any,
+                     character_result: Any, mode: str = SEQUENTIAL) -> dict:
+    with trace_step(story.pk, 'chapters'):
+        chapters = result_of(
+            generate_chapters, story.genre, topic, interview_questions, outline_result, character_result, mode)
+
+    # save the title and content and position to the database
+    save_chapters(story, chapters)
+
+    return {'step': 5, 'stories': [content for _, content in chapters]}
+
+
+async def arun_chapter_step(story: Story, topic: str, interview_questions: List[str], outline_result: Any,
+                            character_result: Any, mode: str = SEQUENTIAL) -> dict:
+    with trace_step(story.pk, 'chapters'):
+        chapters = await aresult_of(
+            generate_chapters, agenerate_chapters,
+            story.genre, topic, interview_questions, outline_result, character_result, mode)
+    await sync_to_async(save_chapters)(story, chapters)
+    return {'step': 5, 'stories': [content for _, content in chapters]}
+
+
+def run_summary_step(story: Story) -> dict:
+    with trace_step(story.pk, 'summary'):
+        summary = summarize_story(story)
+    return {'step': 6, 'summary': summary}
+
+
+def run_title_step(story: Story) -> dict:
+    with trace_step(story.pk, 'titles'):
+        # The titles are drawn from the summary, never from the whole story
+        summary = story.summary or summarize_story(story)
+        title_candidates = TitleGenerator(summary=summary).generate_titles()
+    return {'step': 1, 'titles': title_candidates.titles}
@@ -0,0 +1,143 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.utils.encoders import JSONEncoder
+
+from .llm_scheduler import BULK, llm_priority
+
+logger = logging.getLogger(__name__)
+
+# Speculative prefetch of the next generation step.
+#
+# While the user reads the result of one step, the next step often needs no
+# more input from them (the characters only need the answered interview, the
+# chapters only need the outline and the characters). When enabled, the
+# pipeline starts that work in the background and keeps the future keyed by
+# the step and a hash of its inputs. The next request uses it only if it asks
+# for the same step with the same inputs, otherwise it runs the step as usual.
+#
+# Results live in this process, so with several web workers a request served
+# by another process simply misses and generates the step itself.
+
+DEFAULT_PREFETCH = {
+    'ENABLED': False,
+    'MAX_WORKERS': 2,
+    'MAX_ENTRIES': 64,
+    'TTL': 15 * 60,  # seconds an unclaimed result is kept
+}
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+# key -> (started_at, future), oldest first
+_futures: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def _settings() -> dict:
+    return {**DEFAULT_PREFETCH, **getattr(settings, 'GENERATION_PREFETCH', {})}
+
+
+def is_enabled() -> bool:
+    return bool(_settings()['ENABLED'])
+
+
+def prefetch_key(func: Callable, *args: Any) -> str:
+    """Key of ``func(*args)``; pydantic results are hashed by their fields."""
+    data = json.dumps([func.__module__, func.__qualname__, args], cls=JSONEncoder, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _run(func: Callable, *args: Any) -> Any:
+    # Runs on a worker thread, which needs its own database connection
+    close_old_connections()
+    try:
+        # Speculative, so it must not hold up requests a user is waiting on
+        with llm_priority(BULK):
+            return func(*args)
+    finally:
+        close_old_connections()
+
+
+def _expire(now: float, ttl: float, max_entries: int) -> None:
+    while _futures:
+        key, (started_at, future) = next(iter(_futures.items()))
+        if len(_futures) <= max_entries and now - started_at <= ttl:
+            break
+        del _futures[key]
+        future.cancel()
+
+
+def prefetch(func: Callable, *args: Any) -> None:
+    """Start ``func(*args)`` in the background if prefetching is enabled."""
+    options = _settings()
+    if not options['ENABLED']:
+        return
+    global _executor
+    key = prefetch_key(func, *args)
+    with _lock:
+        if key in _futures:
+            return
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=options['MAX_WORKERS'], thread_name_prefix='generation-prefetch')
+        # Run with the caller's context, so the work is traced to its story
+        context = contextvars.copy_context()
+        _futures[key] = (time.monotonic(), _executor.submit(context.run, _run, func, *args))
+        _expire(time.monotonic(), options['TTL'], options['MAX_ENTRIES'])
+
+
+def take(func: Callable, *args: Any) -> Optional[Future]:
+    """Claim the prefetched ``func(*args)``, if one was started."""
+    key = prefetch_key(func, *args)
+    with _lock:
+        _expire(time.monotonic(), _settings()['TTL'], _settings()['MAX_ENTRIES'])
+        entry = _futures.pop(key, None)
+    return entry[1] if entry else None
+
+
+def result_of(func: Callable, *args: Any) -> Any:
+    """
+    ``func(*args)``, from the prefetched result when there is one (waiting
+    for it if it is still running) and computed here otherwise.
+    """
+    future = take(func, *args)
+    if future is not None:
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("Prefetched %s failed, running it again", func.__qualname__)
+        else:
+            logger.debug("Using prefetched %s", func.__qualname__)
+            return result
+    return func(*args)
+
+
+async def aresult_of(func: Callable, afunc: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+    """``result_of`` for async views: ``afunc(*args)`` is awaited on a miss."""
+    future = take(func, *args)
+    if future is not None:
+        try:
+            result = await asyncio.wrap_future(future)
+        except Exception:
+            logger.exception("Prefetched %s failed, running it again", func.__qualname__)
+        else:
+            logger.debug("Using prefetched %s", func.__qualname__)
+            return result
+    return await afunc(*args)
+
+
+def clear() -> None:
+    """Forget every prefetched result (used by tests and benchmarks)."""
+    with _lock:
+        for _, future in _futures.values():
+            future.cancel()
+        _futures.clear()
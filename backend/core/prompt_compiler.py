@@ -0,0 +1,75 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from .tokens import count_tokens, truncate_tokens
+
+# Compiles the context shared by every call of a generator into one block.
+#
+# Each piece of context (the outline, the characters, the interview...) is
+# added once as a section with a priority. compile() renders the sections in
+# the order they were added, and if they do not fit the token budget, cuts
+# the lowest priority sections first: each is shortened to what is left of
+# the budget, or left out when less than MIN_SECTION_TOKENS would be left.
+# The result and its token count are kept, so a generator renders its
+# context once however many calls it makes.
+
+MIN_SECTION_TOKENS = 24
+TRUNCATED = " ..."
+SEPARATOR = "\n\n"
+
+
+@dataclass
+class PromptSection:
+    title: str
+    text: str
+    priority: int = 0  # higher is kept longer
+    tokens: int = field(init=False)
+
+    def __post_init__(self):
+        # Counted with the separator, so the sections' sum covers the whole block
+        self.tokens = count_tokens(self.render() + SEPARATOR)
+
+    def render(self) -> str:
+        return f"### {self.title}:\n{self.text}"
+
+
+class PromptCompiler:
+    def __init__(self, max_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens
+        self.sections: List[PromptSection] = []
+        self._compiled: Optional[str] = None
+        self.tokens = 0
+
+    def add(self, title: str, text: str, priority: int = 0) -> "PromptCompiler":
+        text = text.strip()
+        if text:
+            self.sections.append(PromptSection(title, text, priority))
+            self._compiled = None
+        return self
+
+    def _fit(self) -> List[PromptSection]:
+        total = sum(section.tokens for section in self.sections)
+        if self.max_tokens is None or total <= self.max_tokens:
+            return self.sections
+        fitted = {id(section): section for section in self.sections}
+        for section in sorted(self.sections, key=lambda s: s.priority):
+            overflow = total - self.max_tokens
+            if overflow <= 0:
+                break
+            # Room for the text once the heading and the marker are paid for
+            room = section.tokens - overflow - count_tokens(f"### {section.title}:\n{TRUNCATED}{SEPARATOR}")
+            if room < MIN_SECTION_TOKENS:
+                del fitted[id(section)]
+                total -= section.tokens
+                continue
+            shortened = PromptSection(
+                section.title, truncate_tokens(section.text, room) + TRUNCATED, section.priority)
+            fitted[id(section)] = shortened
+            total -= section.tokens - shortened.tokens
+        return [fitted[id(section)] for section in self.sections if id(section) in fitted]
+
+    def compile(self) -> str:
+        if self._compiled is None:
+            self._compiled = SEPARATOR.join(section.render() for section in self._fit())
+            self.tokens = count_tokens(self._compiled)
+        return self._compiled
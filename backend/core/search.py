@@ -0,0 +1,383 @@
+import html
+import logging
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+logger = logging.getLogger(__name__)
+
+# Full-text search over stories, chapters and characters.
+#
+# With MySQL (production) the tables themselves are searched, through the
+# FULLTEXT indexes of migration 0015, which MySQL keeps up to date on every
+# write. Other engines (SQLite in development and tests) have no such index,
+# so there the documents are copied into an SQLite FTS5 table in a file of
+# its own next to the main database. Rows are written after the transaction
+# that changed them commits (see core/signals.py and core/persistence.py);
+# `manage.py rebuild_search_index` fills it from scratch. With several web
+# hosts PATH must be on storage they all share.
+#
+# Every FTS5 document is keyed by its rowid, the object's primary key times
+# four plus its kind, so updating or removing one is a lookup rather than a
+# scan. The owner column holds the author as a token ("u42"), which lets a
+# query be limited to one user's documents by the index itself.
+
+DEFAULT_SEARCH_INDEX = {
+    'ENABLED': True,
+    'PATH': None,  # BASE_DIR / 'search_index.sqlite3'
+    'MAX_RESULTS': 50,
+    # Queries matching more documents than this (e.g. of only common words)
+    # rank the most recent ones only, to keep them fast
+    'MAX_CANDIDATES': 2000,
+}
+
+STORY, CHAPTER, CHARACTER = 'story', 'chapter', 'character'
+KINDS = {STORY: 1, CHAPTER: 2, CHARACTER: 3}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+# The title and text columns of each kind, searched together on MySQL: each
+# pair has a FULLTEXT index
+FULLTEXT_COLUMNS = {
+    STORY: ('title', 'summary'),
+    CHAPTER: ('title', 'content'),
+    CHARACTER: ('name', 'biography'),
+}
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    title, body, owner, story_id UNINDEXED, tokenize = 'porter unicode61'
+)
+"""
+# Titles (and character names) weigh more than the text; owner not at all
+RANK = "bm25(5.0, 1.0, 0.0)"
+# Markers that cannot occur in the text, replaced by <mark> once it is escaped
+MARK_START, MARK_END = "\x02", "\x03"
+SNIPPET_TOKENS = 24
+MAX_TERMS = 16
+# Shorter prefixes match too many words to be worth looking up
+MIN_PREFIX = 3
+# Words in more documents than this are too costly to score, and score
+# close to nothing in bm25 once they are in most documents
+COMMON_TERM_DOCUMENTS = 10_000
+TERM = re.compile(r"\w+")
+
+_local = threading.local()
+
+
+@dataclass
+class Document:
+    kind: str
+    object_id: int
+    story_id: int
+    author_id: int
+    title: str
+    body: str
+
+    @property
+    def rowid(self) -> int:
+        return self.object_id * 4 + KINDS[self.kind]
+
+
+def _settings() -> dict:
+    return {**DEFAULT_SEARCH_INDEX, **getattr(settings, 'SEARCH_INDEX', {})}
+
+
+def is_enabled() -> bool:
+    return bool(_settings()['ENABLED'])
+
+
+def uses_fulltext() -> bool:
+    """Whether the main database searches its own tables (MySQL FULLTEXT)."""
+    return connection.vendor == 'mysql'
+
+
+def index_path() -> str:
+    return str(_settings()['PATH'] or settings.BASE_DIR / 'search_index.sqlite3')
+
+
+def get_connection() -> sqlite3.Connection:
+    """This thread's connection to the index, creating the index on first use."""
+    path = index_path()
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        # Readers do not wait for the writer, and commits do not fsync each time
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(SCHEMA)
+        connections[path] = conn
+    return conn
+
+
+def close_connections() -> None:
+    for conn in getattr(_local, 'connections', {}).values():
+        conn.close()
+    _local.connections = {}
+
+
+def write_documents(documents: Iterable[Document]) -> int:
+    rows = [
+        (d.rowid, d.title or '', d.body or '', f"u{d.author_id}", d.story_id)
+        for d in documents
+    ]
+    if not rows:
+        return 0
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("DELETE FROM documents WHERE rowid = ?", [(row[0],) for row in rows])
+        conn.executemany(
+            "INSERT INTO documents (rowid, title, body, owner, story_id) VALUES (?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def delete_documents(kind: str, object_ids: Iterable[int]) -> None:
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("DELETE FROM documents WHERE rowid = ?",
+                         [(object_id * 4 + KINDS[kind],) for object_id in object_ids])
+
+
+def story_document(story) -> Document:
+    return Document(STORY, story.pk, story.pk, story.author_id, story.title, story.summary or '')
+
+
+def chapter_document(chapter, author_id: int) -> Document:
+    return Document(CHAPTER, chapter.pk, chapter.story_id, author_id, chapter.title, chapter.content)
+
+
+def character_document(character, author_id: int) -> Document:
+    return Document(CHARACTER, character.pk, character.story_id, author_id,
+                    character.name, character.biography)
+
+
+def document_for(instance) -> Document:
+    from .models import Chapter, Character, Story
+
+    if isinstance(instance, Story):
+        return story_document(instance)
+    author_id = instance.story.author_id
+    if isinstance(instance, Chapter):
+        return chapter_document(instance, author_id)
+    if isinstance(instance, Character):
+        return character_document(instance, author_id)
+    raise TypeError(f"Cannot index {type(instance).__name__}")
+
+
+def index_story(story_id: int) -> int:
+    """(Re)index a story with its chapters and characters."""
+    from .models import Story
+
+    story = Story.objects.filter(pk=story_id).first()
+    if story is None:
+        return 0
+    documents = [story_document(story)]
+    documents += [chapter_document(chapter, story.author_id)
+                  for chapter in story.chapters.only('id', 'story_id', 'title', 'content')]
+    documents += [character_document(character, story.author_id)
+                  for character in story.characters.only('id', 'story_id', 'name', 'biography')]
+    return write_documents(documents)
+
+
+def _safely(func, *args) -> None:
+    try:
+        func(*args)
+    except Exception:
+        # A stale search result is better than a failed save
+        logger.exception("Could not update the search index")
+
+
+def index_on_commit(instance) -> None:
+    if is_enabled() and not uses_fulltext():
+        transaction.on_commit(lambda: _safely(lambda: write_documents([document_for(instance)])))
+
+
+def delete_on_commit(kind: str, object_id: int) -> None:
+    if is_enabled() and not uses_fulltext():
+        transaction.on_commit(lambda: _safely(delete_documents, kind, [object_id]))
+
+
+def index_story_on_commit(story_id: int) -> None:
+    if is_enabled() and not uses_fulltext():
+        transaction.on_commit(lambda: _safely(index_story, story_id))
+
+
+def query_terms(query: str) -> List[str]:
+    return TERM.findall(query.lower())[:MAX_TERMS]
+
+
+def match_expression(terms: List[str]) -> str:
+    """
+    FTS5 query for ``terms``: all of them must match, the last one also as a
+    prefix, since it may still be being typed.
+    """
+    quoted = [f'"{term}"' for term in terms]
+    if len(terms[-1]) >= MIN_PREFIX:
+        quoted[-1] += '*'
+    return " ".join(quoted)
+
+
+def _is_common(conn: sqlite3.Connection, term: str) -> bool:
+    # Stops after COMMON_TERM_DOCUMENTS rows rather than counting them all
+    return conn.execute(
+        "SELECT rowid FROM documents WHERE documents MATCH ? LIMIT 1 OFFSET ?",
+        [f'{{title body}} : "{term}"', COMMON_TERM_DOCUMENTS]).fetchone() is not None
+
+
+def _highlighted(text: str) -> str:
+    return (html.escape(text)
+            .replace(MARK_START, "<mark>")
+            .replace(MARK_END, "</mark>"))
+
+
+def boolean_expression(terms: List[str]) -> str:
+    """MySQL boolean mode query for ``terms``, like ``match_expression``."""
+    words = [f"+{term}" for term in terms]
+    if len(terms[-1]) >= MIN_PREFIX:
+        words[-1] += '*'
+    return " ".join(words)
+
+
+def _mark(text: str, terms: List[str]) -> str:
+    """``text`` with the words matching ``terms`` (the last as a prefix) marked."""
+    exact, prefix = set(terms), terms[-1] if len(terms[-1]) >= MIN_PREFIX else None
+
+    def mark(match):
+        word = match.group(0).lower()
+        if word in exact or (prefix and word.startswith(prefix)):
+            return MARK_START + match.group(0) + MARK_END
+        return match.group(0)
+
+    return TERM.sub(mark, text)
+
+
+def _snippet(text: str, terms: List[str]) -> str:
+    """Some SNIPPET_TOKENS words of ``text`` around its first match, marked."""
+    words = list(TERM.finditer(text))
+    if len(words) <= SNIPPET_TOKENS:
+        return _mark(text, terms)
+    marked = [i for i, word in enumerate(words) if MARK_START in _mark(word.group(0), terms)]
+    start = max(0, min((marked or [0])[0] - SNIPPET_TOKENS // 4, len(words) - SNIPPET_TOKENS))
+    end = start + SNIPPET_TOKENS
+    snippet = text[words[start].start():words[end - 1].end()]
+    return ("..." if start else "") + _mark(snippet, terms) + ("..." if end < len(words) else "")
+
+
+def _search_fulltext(author_id: int, terms: List[str], kind: Optional[str], limit: int) -> List[dict]:
+    from .models import Chapter, Character, Story
+
+    models = {STORY: Story, CHAPTER: Chapter, CHARACTER: Character}
+    expression = boolean_expression(terms)
+    results = []
+    for name in [kind] if kind is not None else KINDS:
+        model = models[name]
+        title, body = FULLTEXT_COLUMNS[name]
+        table = connection.ops.quote_name(model._meta.db_table)
+        columns = ", ".join(f"{table}.{connection.ops.quote_name(column)}" for column in (title, body))
+        owner = {'author_id': author_id} if model is Story else {'story__author_id': author_id}
+        rows = (
+            model.objects.filter(**owner)
+            .annotate(score=RawSQL(f"MATCH ({columns}) AGAINST (%s IN BOOLEAN MODE)", [expression]))
+            .filter(score__gt=0)
+            .order_by('-score', '-pk')
+            .values_list('pk', 'pk' if model is Story else 'story_id', title, body, 'score')[:limit]
+        )
+        results += [
+            {
+                'kind': name,
+                'id': pk,
+                'story_id': story_id,
+                'title': _highlighted(_mark(title_text, terms)),
+                'snippet': _highlighted(_snippet(body_text or '', terms)),
+                'score': score,
+            }
+            for pk, story_id, title_text, body_text, score in rows
+        ]
+    results.sort(key=lambda result: -result['score'])
+    return results[:limit]
+
+
+def search(author_id: int, query: str, kind: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+    """
+    The author's documents matching ``query``, best first, with the matched
+    words of the title and of a snippet of the text in ``<mark>`` tags.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    options = _settings()
+    limit = max(1, min(limit or options['MAX_RESULTS'], options['MAX_RESULTS']))
+    if uses_fulltext():
+        return _search_fulltext(author_id, terms, kind, limit)
+    expression = f'owner : "u{int(author_id)}" AND {{title body}} : ({match_expression(terms)})'
+    conn = get_connection()
+
+    # Walking the matches in rowid order is cheap, scoring them is not, so
+    # only the newest MAX_CANDIDATES are ranked
+    sql = "SELECT rowid FROM documents WHERE documents MATCH ?"
+    params = [expression]
+    if kind is not None:
+        sql += " AND rowid % 4 = ?"
+        params.append(KINDS[kind])
+    candidates = [row[0] for row in conn.execute(
+        sql + " ORDER BY rowid DESC LIMIT ?", [*params, options['MAX_CANDIDATES']])]
+    if not candidates:
+        return []
+
+    # bm25 reads every document of every term it scores (to weigh how rare
+    # the term is), so score by the exact words that are not in most
+    # documents; the owner and the other words only filter
+    ranking = [term for term in dict.fromkeys(terms) if not _is_common(conn, term)]
+    if ranking:
+        # Rank before making snippets: they are costly, and SQLite would make
+        # one for every match before sorting if they were in the same query
+        scores = dict(conn.execute(f"""
+            SELECT rowid, rank FROM documents
+            WHERE documents MATCH ? AND rank MATCH ? AND rowid BETWEEN ? AND ?
+              AND +rowid IN ({", ".join("?" * len(candidates))})
+            ORDER BY rank LIMIT ?
+        """, ['{title body} : (' + " OR ".join(f'"{term}"' for term in ranking) + ')', RANK,
+              min(candidates), max(candidates), *candidates, limit]).fetchall())
+    else:
+        # Newest first when no word says more than another
+        scores = {rowid: -1.0 / position for position, rowid in enumerate(candidates[:limit], start=1)}
+    # Then the newest of those that only matched the last word as a prefix
+    for rowid in candidates:
+        if len(scores) >= limit:
+            break
+        scores.setdefault(rowid, 0.0)
+
+    # One pass over the range of the top rowids; looking each one up instead
+    # would repeat the whole query, prefix expansion and all, for every row
+    rows = conn.execute(f"""
+        SELECT rowid, story_id,
+               highlight(documents, 0, ?, ?),
+               snippet(documents, 1, ?, ?, '...', {SNIPPET_TOKENS})
+        FROM documents
+        WHERE documents MATCH ? AND rowid BETWEEN ? AND ?
+          AND +rowid IN ({", ".join("?" * len(scores))})
+    """, [MARK_START, MARK_END, MARK_START, MARK_END, expression,
+          min(scores), max(scores), *scores]).fetchall()
+    rows.sort(key=lambda row: scores[row[0]])
+    return [
+        {
+            'kind': KIND_NAMES[rowid % 4],
+            'id': rowid // 4,
+            'story_id': story_id,
+            'title': _highlighted(title),
+            'snippet': _highlighted(snippet),
+            # bm25 is lower for better matches
+            'score': -scores[rowid],
+        }
+        for rowid, story_id, title, snippet in rows
+    ]
@@ -1,5 +1,35 @@
 from rest_framework import serializers
 from .models import Chapter, Character, User, Story
+from .image_derivatives import derivative_url
+
+
+class SparseFieldsMixin:
+    """
+    Takes an optional ``fields`` argument (e.g. from ``?fields=id,title``)
+    and only serializes those fields.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class ImageRenditionsMixin(serializers.Serializer):
+    """
+    URLs of the smaller WebP renditions of ``image``. Until a rendition has
+    been created these fall back to the original image.
+    """
+    image_thumbnail = serializers.SerializerMethodField()
+    image_medium = serializers.SerializerMethodField()
+
+    def get_image_thumbnail(self, obj):
+        return derivative_url(obj, 'thumbnail')
+
+    def get_image_medium(self, obj):
+        return derivative_url(obj, 'medium')
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -8,10 +38,11 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ['id', 'email']
 
 
-class StorySerializer(serializers.ModelSerializer):
+class StorySerializer(SparseFieldsMixin, ImageRenditionsMixin, serializers.ModelSerializer):
     class Meta:
         model = Story
-        fields = ['id', 'title', 'summary', 'genre', 'image']
+        fields = ['id', 'title', 'summary', 'genre', 'image',
+                  'image_thumbnail', 'image_medium']
 
 
 class CharacterSerializer(serializers.ModelSerializer):
@@ -20,7 +51,7 @@ class CharacterSerializer(serializers.ModelSerializer):
         fields = ['id', 'name']
 
 
-class ChapterSerializer(serializers.ModelSerializer):
+class ChapterSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     # characters = CharacterSerializer(many=True)
 
     class Meta:
@@ -29,7 +60,8 @@ class ChapterSerializer(serializers.ModelSerializer):
                   'position']
 
 
-class ComplexCharacterSerializer(serializers.ModelSerializer):
+class ComplexCharacterSerializer(ImageRenditionsMixin, serializers.ModelSerializer):
     class Meta:
         model = Character
-        fields = ['id', 'name', 'appearance', 'biography', 'image']
+        fields = ['id', 'name', 'appearance', 'biography', 'image',
+                  'image_thumbnail', 'image_medium']
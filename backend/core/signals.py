@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from django.dispatch import receiver
+
+from . import search
+from .image_derivatives import has_derivatives, schedule_derivatives
+from .models import Chapter, Character, Story
+from .story_summary import schedule_summary_update
+
+# Fields each model has in the search index
+SEARCH_FIELDS = {
+    Story: {'title', 'summary'},
+    Chapter: {'title', 'content'},
+    Character: {'name', 'biography'},
+}
+
+
+@receiver(post_save, sender=Story)
+@receiver(post_save, sender=Character)
+def image_saved(sender, instance, update_fields=None, **kwargs):
+    # Only when the image may have changed, and once the row is committed
+    if not instance.image:
+        return
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    if has_derivatives(instance):
+        return
+    transaction.on_commit(lambda: schedule_derivatives(instance))
+
+
+@receiver(post_save, sender=Chapter)
+@receiver(post_delete, sender=Chapter)
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Character)
+def story_content_changed(sender, instance, **kwargs):
+    # Story.last_update drives the ETag/Last-Modified of the story's listings
+    Story.objects.filter(pk=instance.story_id).update(last_update=timezone.now())
+
+
+@receiver(post_save, sender=Chapter)
+@receiver(post_delete, sender=Chapter)
+def chapter_changed(sender, instance, update_fields=None, **kwargs):
+    # Keep a summarized story's summary in step with its chapters
+    if update_fields is not None and not {'title', 'content'} & set(update_fields):
+        return
+    transaction.on_commit(lambda: schedule_summary_update(instance.story_id))
+
+
+@receiver(post_save, sender=Story)
+@receiver(post_save, sender=Chapter)
+@receiver(post_save, sender=Character)
+def update_search_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_FIELDS[sender] & set(update_fields):
+        return
+    search.index_on_commit(instance)
+
+
+@receiver(post_delete, sender=Story)
+@receiver(post_delete, sender=Chapter)
+@receiver(post_delete, sender=Character)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.delete_on_commit(sender._meta.model_name, instance.pk)
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import CoalescedCall
+
+# Coalescing of identical generation requests.
+#
+# A double click or a client retry sends the same step for the same story
+# again while the first one is still running; without this, each one pays
+# for its own model or image calls. A call is keyed by story, step and a
+# hash of its inputs. Within a process, identical calls wait for the one in
+# flight and get its result. Across processes (several web workers or
+# hosts), the first one inserts a CoalescedCall row, which the unique key
+# lets only one do; the others poll it and get the result stored there once
+# it is finished. A call that arrives after another finished runs anew (a
+# deliberate "regenerate" must not get the old result back) unless
+# RESULT_TTL is set, to reuse results that recent. If the call fails its row
+# is removed, and the next waiter runs the step itself.
+
+DEFAULT_SINGLE_FLIGHT = {
+    'ENABLED': True,
+    'RESULT_TTL': 0,  # seconds a finished call's result is reused by later calls
+    'STALE_AFTER': 30 * 60,  # seconds after which a call is taken as lost (e.g. its process died)
+    'POLL_INTERVAL': 0.5,  # seconds between looks at a call running in another process
+}
+
+DONE, RUNNING, MISSING = 'done', 'running', 'missing'
+
+# Seconds a finished call's row is kept past RESULT_TTL for the calls still
+# polling it from other processes
+FINISHED_GRACE = 60
+
+_lock = threading.Lock()
+_in_flight: Dict[str, Future] = {}
+
+
+def _settings() -> dict:
+    return {**DEFAULT_SINGLE_FLIGHT, **getattr(settings, 'SINGLE_FLIGHT', {})}
+
+
+def is_enabled() -> bool:
+    return bool(_settings()['ENABLED'])
+
+
+def flight_key(story_id: int, step: str, inputs: Any) -> str:
+    data = json.dumps([story_id, step, inputs], cls=JSONEncoder, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _claim(key: str, since) -> bool:
+    """Start the call for ``key`` unless another process has since ``since``."""
+    options = _settings()
+    now = timezone.now()
+    CoalescedCall.objects.filter(
+        Q(key=key, finished_at__lt=since)
+        | Q(finished_at__lt=now - timedelta(seconds=options['RESULT_TTL'] + FINISHED_GRACE))
+        | Q(finished_at__isnull=True, started_at__lt=now - timedelta(seconds=options['STALE_AFTER']))
+    ).delete()
+    try:
+        with transaction.atomic():
+            CoalescedCall.objects.create(key=key, started_at=now)
+    except IntegrityError:
+        return False
+    return True
+
+
+def _poll(key: str, since) -> Tuple[str, Any]:
+    call = CoalescedCall.objects.filter(key=key).only('result', 'finished_at').first()
+    if call is None or (call.finished_at is not None and call.finished_at < since):
+        return MISSING, None
+    if call.finished_at is None:
+        return RUNNING, None
+    return DONE, call.result
+
+
+def _finish(key: str, result: Any) -> None:
+    # Stored the way the response sends it
+    CoalescedCall.objects.filter(key=key).update(
+        result=json.loads(json.dumps(result, cls=JSONEncoder)), finished_at=timezone.now())
+
+
+def _abandon(key: str) -> None:
+    CoalescedCall.objects.filter(key=key).delete()
+
+
+def _join(key: str) -> Tuple[Future, bool]:
+    """This process's future for ``key`` and whether this call leads it."""
+    with _lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future, False
+        future = _in_flight[key] = Future()
+        return future, True
+
+
+def _settle(key: str, future: Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+    with _lock:
+        _in_flight.pop(key, None)
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def single_flight(story_id: int, step: str, inputs: Any, compute: Callable[[], Any]) -> Any:
+    """
+    ``compute()``, unless an identical call (same story, step and inputs)
+    is in flight, in this process or another, in which case its result.
+    """
+    if not is_enabled():
+        return compute()
+    key = flight_key(story_id, step, inputs)
+    future, leader = _join(key)
+    if not leader:
+        return future.result()
+    try:
+        result = _lead(key, compute)
+    except BaseException as e:
+        _settle(key, future, error=e)
+        raise
+    _settle(key, future, result)
+    return result
+
+
+def _since() -> Any:
+    """Calls finished before this are not reused."""
+    return timezone.now() - timedelta(seconds=_settings()['RESULT_TTL'])
+
+
+def _lead(key: str, compute: Callable[[], Any]) -> Any:
+    since = _since()
+    while not _claim(key, since):
+        status, result = _poll(key, since)
+        if status == DONE:
+            return result
+        if status == RUNNING:
+            time.sleep(_settings()['POLL_INTERVAL'])
+        # MISSING: the other call failed, expired or finished too long ago
+    try:
+        result = compute()
+    except BaseException:
+        _abandon(key)
+        raise
+    _finish(key, result)
+    return result
+
+
+async def asingle_flight(story_id: int, step: str, inputs: Any, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """``single_flight`` for async views; ``compute`` is a coroutine function."""
+    if not is_enabled():
+        return await compute()
+    key = flight_key(story_id, step, inputs)
+    future, leader = _join(key)
+    if not leader:
+        return await asyncio.wrap_future(future)
+    try:
+        result = await _alead(key, compute)
+    except BaseException as e:
+        _settle(key, future, error=e)
+        raise
+    _settle(key, future, result)
+    return result
+
+
+async def _alead(key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+    since = _since()
+    while not await sync_to_async(_claim)(key, since):
+        status, result = await sync_to_async(_poll)(key, since)
+        if status == DONE:
+            return result
+        if status == RUNNING:
+            await asyncio.sleep(_settings()['POLL_INTERVAL'])
+    try:
+        result = await compute()
+    except BaseException:
+        await sync_to_async(_abandon)(key)
+        raise
+    await sync_to_async(_finish)(key, result)
+    return result
@@ -1,14 +1,56 @@
+import logging
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+from asgiref.sync import sync_to_async
 from langchain.chains import LLMChain
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.memory import ConversationSummaryBufferMemory
+from django.conf import settings
 from langchain_core.prompts import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
     MessagesPlaceholder,
 )
 from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+
+from .continuity_index import build_continuity_index, chapter_source, character_source
+from .llm import get_chat_model
+from .prompt_compiler import PromptCompiler
+from .story_memory import StoryMemory
+from .story_outline_generation import Act, ActExpander, ActsOutline, ChapterPlan
+from .tokens import truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Chapter generation modes
+SEQUENTIAL = "sequential"  # one chapter at a time, continuity from memory
+PARALLEL = "parallel"  # all chapters at once, continuity from the outline
+
+# Defaults for the STORY_MEMORY setting
+DEFAULT_STORY_MEMORY = {
+    'SYNOPSIS_MAX_TOKENS': 400,
+    'TAIL_MAX_TOKENS': 300,
+    # Model that rewrites the synopsis after each chapter; None keeps the
+    # synopsis to digests of the chapters' own text and makes no extra calls
+    'SUMMARIZER_MODEL': None,
+    'BACKGROUND': True,
+}
+
+# Defaults for the STORY_GENERATION setting
+DEFAULT_STORY_GENERATION = {
+    # Chapters drafted at once in parallel mode
+    'PARALLEL_MAX_CONCURRENCY': 3,
+}
+
+# Defaults for the STORY_PROMPT setting
+DEFAULT_STORY_PROMPT = {
+    # Budget for the story context (outline, characters, interview) sent with
+    # every chapter; when it is over, the interview is cut first, then the
+    # characters, then the outline
+    'CONTEXT_MAX_TOKENS': 1500,
+}
+
+# Cap on each character's description in a long-form chapter prompt
+CHARACTER_MAX_TOKENS = 150
 
 
 @dataclass
@@ -34,11 +76,65 @@ class Outline:
         ]
         return cls(chapters=chapters)
 
+    @classmethod
+    def from_result(cls, outline):
+        # A StoriesOutline from the generation session, or the nested list
+        # older clients send back
+        if hasattr(outline, 'chapters'):
+            return cls(chapters=[
+                Chapter(chapter_number=c.chapter_number, chapter_title=c.chapter_title)
+                for c in outline.chapters
+            ])
+        return cls.from_nested_list(outline)
+
+
+def build_story_memory() -> StoryMemory:
+    options = {**DEFAULT_STORY_MEMORY, **getattr(settings, 'STORY_MEMORY', {})}
+    summarizer = None
+    if options['SUMMARIZER_MODEL']:
+        summarizer = get_chat_model(model=options['SUMMARIZER_MODEL'], temperature=0)
+    return StoryMemory(
+        memory_key="chat_history",
+        synopsis_max_tokens=options['SYNOPSIS_MAX_TOKENS'],
+        tail_max_tokens=options['TAIL_MAX_TOKENS'],
+        summarizer=summarizer,
+        background=options['BACKGROUND'],
+    )
+
+
+def render_outline(outline: Outline) -> str:
+    return "\n".join(f"{c.chapter_number}. {c.chapter_title}" for c in outline.chapters)
+
+
+def render_interview(questions_and_answers: Any) -> str:
+    if isinstance(questions_and_answers, (list, tuple)):
+        # One line per "Q: ...\nA: ..." pair
+        return "\n".join(" ".join(str(item).split()) for item in questions_and_answers)
+    return str(questions_and_answers or "")
+
+
+def render_character(character: Any, max_tokens: Optional[int] = None) -> str:
+    description = " ".join(f"{character.appearance} {character.biography}".split())
+    if max_tokens is not None:
+        description = truncate_tokens(description, max_tokens)
+    return f"- {character.name}: {description}"
 
-class OnlyStoreAIMemory(ConversationSummaryBufferMemory):
-    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
-        input_str, output_str = self._get_input_output(inputs, outputs)
-        self.chat_memory.add_ai_message(output_str)
+
+def render_characters(characters: Any) -> str:
+    if hasattr(characters, 'characters'):
+        return "\n".join(render_character(c) for c in characters.characters)
+    # The nested list sent by older clients
+    return str(characters or "")
+
+
+def build_story_context(outline: Outline, questions_and_answers: Any, characters: Any) -> PromptCompiler:
+    options = {**DEFAULT_STORY_PROMPT, **getattr(settings, 'STORY_PROMPT', {})}
+    return (
+        PromptCompiler(max_tokens=options['CONTEXT_MAX_TOKENS'])
+        .add("Outline", render_outline(outline), priority=2)
+        .add("Characters", render_characters(characters), priority=1)
+        .add("Interview insights", render_interview(questions_and_answers), priority=0)
+    )
 
 
 class StoryGenerator:
@@ -46,33 +142,42 @@ class StoryGenerator:
         self,
         genre: str,
         topic: str,
-        outline: List,  # Changed to accept the nested list directly
+        outline: Any,  # StoriesOutline, or the nested list sent by older clients
         questions_and_answers: dict,
         characters,
+        max_concurrency: Optional[int] = None,
     ):
         self.genre = genre
         self.topic = topic
-        self.outline = Outline.from_nested_list(
+        self.outline = Outline.from_result(
             outline)  # Convert to Outline object
         self.questions_and_answers = questions_and_answers
         self.characters = characters
+        if max_concurrency is None:
+            options = {**DEFAULT_STORY_GENERATION, **getattr(settings, 'STORY_GENERATION', {})}
+            max_concurrency = options['PARALLEL_MAX_CONCURRENCY']
+        self.max_concurrency = max_concurrency
 
+        # The outline, interview and characters go in the system prompt once,
+        # rendered compactly; the section prompts only carry the chapter
+        self.context = build_story_context(self.outline, questions_and_answers, characters).compile()
         prompt = f"""
         Act as a Story writer.
-        You are currently writing a story on topic: {self.topic} which genre {self.genre}.
-        This is the outline of the story: {self.outline.chapters}. You will be responsible for writing the story sections.
+        You are currently writing a story on topic: {self.topic} which genre {self.genre}. You will be responsible for writing the story sections.
+
+{self.context}
         ---
-        Use your previous AI messages to avoid repeating yourself as you continually re-write the story sections.
+        Use the story so far and the end of the previous section to continue the story without repeating yourself.
         """
-        chat = ChatOpenAI(model="gpt-3.5-turbo-16k")
-        memory = OnlyStoreAIMemory(
-            llm=chat,
-            memory_key="chat_history",
-            return_messages=True,
-            max_token_limit=1200,
-        )
+        self.chat = get_chat_model(model="gpt-3.5-turbo-16k")
+        self.memory = build_story_memory()
+        # The characters and earlier chapters' passages, recalled into the
+        # prompts of later chapters
+        self.continuity = build_continuity_index()
+        if self.continuity is not None:
+            self.continuity.add_characters(characters)
 
-        chat_prompt = ChatPromptTemplate.from_messages(
+        self.chat_prompt = ChatPromptTemplate.from_messages(
             [
                 SystemMessage(content=prompt),
                 MessagesPlaceholder(variable_name="chat_history"),
@@ -81,41 +186,363 @@ class StoryGenerator:
         )
 
         self.story_chain = LLMChain(
-            llm=chat, prompt=chat_prompt, memory=memory, output_key="story"
+            llm=self.chat, prompt=self.chat_prompt, memory=self.memory, output_key="story"
         )
 
-    def generate_stories(self) -> List[str]:
-        story = []
-        print("Generating the story...\n---")
-        for chapter in self.outline.chapters:
-            section_prompt = f"""
+    def _parallel_chain(self):
+        # Stateless chain for parallel mode: no shared memory between chapters
+        prompt = f"""
+        Act as a Story writer.
+        You are currently writing a story on topic: {self.topic} which genre {self.genre}. You will be responsible for writing the story sections.
+
+{self.context}
+        ---
+        Other writers are drafting the other chapters at the same time. Follow the outline and the continuity notes closely so the chapters read as one story.
+        """
+        chat_prompt = ChatPromptTemplate.from_messages(
+            [
+                SystemMessage(content=prompt),
+                HumanMessagePromptTemplate.from_template("{human_input}"),
+            ]
+        )
+        return chat_prompt | self.chat | StrOutputParser()
+
+    def _continuity_notes(self, index: int) -> str:
+        """
+        Precomputed context for drafting chapter ``index`` without waiting for
+        the chapters before it: where the story comes from and where it goes.
+        """
+        chapters = self.outline.chapters
+        notes = []
+        if index > 0:
+            previous = chapters[index - 1]
+            notes.append(
+                f"- The previous chapter, Chapter {previous.chapter_number}: {previous.chapter_title}, "
+                f"covers the events leading up to this one. Pick up where it ends without retelling it.")
+        else:
+            notes.append("- This is the opening chapter. Introduce the setting and the main characters.")
+        if index < len(chapters) - 1:
+            following = chapters[index + 1]
+            notes.append(
+                f"- The next chapter is Chapter {following.chapter_number}: {following.chapter_title}. "
+                f"End this chapter so that it leads into it, without writing its events.")
+        else:
+            notes.append("- This is the final chapter. Resolve the story.")
+        return "\n            ".join(notes)
+
+    def _recall(self, chapter: Chapter) -> str:
+        """
+        Passages of the chapters before the previous one (which the memory
+        already holds the end of) that are closest to where the story is.
+        """
+        if self.continuity is None:
+            return ""
+        return self.continuity.recall(
+            f"{chapter.chapter_title}\n{self.memory.tail}",
+            skip={chapter_source(chapter.chapter_number - 1)},
+        )
+
+    def _remember(self, chapter: Chapter, text: str) -> None:
+        if self.continuity is not None:
+            self.continuity.add_chapter(chapter.chapter_number, text)
+
+    def _section_prompt(self, chapter: Chapter, continuity: str = "", recalled: str = "") -> str:
+        continuity_section = f"""
+            ### Continuity:
+            {continuity}
+""" if continuity else ""
+        if recalled:
+            continuity_section += f"""
+            ### Earlier passages to stay consistent with:
+            {recalled}
+"""
+        return f"""
             You are writing a section for a chapter of a book. Use the following information and guidelines to craft the content.
             ---
             ### Chapter Details:
             - Chapter Number: {chapter.chapter_number}
             - Chapter Title: {chapter.chapter_title}
 
-            ### Insights to Include:
-            Below are the key insights gathered from interviews. These must be integrated into the section to enhance its relevance and ensure it ranks better:
-            - {self.questions_and_answers}
-
-            ### Character Information:
-            The following information pertains to the characters and must be woven seamlessly into the section:
-            - {self.characters}
             ---
             ### Writing Guidelines:
             - Write the content specifically for Chapter {chapter.chapter_number}: {chapter.chapter_title}.
             - Ensure the text aligns with the themes, narrative, and objectives of the chapter.
-            - Use the character information ({self.characters}) effectively to develop the narrative or enhance the description.
+            - Integrate the interview insights and weave the characters from the story context seamlessly into the section.
             - The final section must be written in **Markdown (.md) format**.
             - Use proper headings, subheadings, lists, and other Markdown features for readability.
-            ---
+{continuity_section}            ---
             ### Output Section:
             Write the following section:
             - Chapter {chapter.chapter_number}: {chapter.chapter_title}
             """
+
+    def generate_stories(self, mode: str = SEQUENTIAL) -> List[str]:
+        if mode == PARALLEL:
+            return self.generate_stories_parallel()
+        story = []
+        logger.debug("Writing %d chapters", len(self.outline.chapters))
+        for chapter in self.outline.chapters:
+            section_prompt = self._section_prompt(chapter, recalled=self._recall(chapter))
             result = self.story_chain.predict(human_input=section_prompt)
+            self._remember(chapter, result)
             story.append(result)
+        return story
+
+    def _parallel_inputs(self) -> List[Dict[str, str]]:
+        return [
+            {"human_input": self._section_prompt(chapter, self._continuity_notes(index))}
+            for index, chapter in enumerate(self.outline.chapters)
+        ]
 
-        print("Finished generating the story!\n---")
+    def generate_stories_parallel(self) -> List[str]:
+        """
+        Draft every chapter at once, at most ``max_concurrency`` at a time.
+        Each chapter gets its continuity from the outline instead of from the
+        chapters before it, so the wall-clock time is close to one chapter's.
+        """
+        logger.debug("Writing %d chapters in parallel", len(self.outline.chapters))
+        story = self._parallel_chain().batch(
+            self._parallel_inputs(), config={"max_concurrency": self.max_concurrency})
         return story
+
+    async def agenerate_stories_parallel(self) -> List[str]:
+        logger.debug("Writing %d chapters in parallel", len(self.outline.chapters))
+        story = await self._parallel_chain().abatch(
+            self._parallel_inputs(), config={"max_concurrency": self.max_concurrency})
+        return story
+
+    async def agenerate_stories(self, mode: str = SEQUENTIAL) -> List[str]:
+        if mode == PARALLEL:
+            return await self.agenerate_stories_parallel()
+        story = []
+        logger.debug("Writing %d chapters", len(self.outline.chapters))
+        for chapter in self.outline.chapters:
+            section_prompt = self._section_prompt(chapter, recalled=self._recall(chapter))
+            result = await self.story_chain.apredict(human_input=section_prompt)
+            self._remember(chapter, result)
+            story.append(result)
+        return story
+
+    def stream_stories(self) -> Iterator[Dict[str, Any]]:
+        """
+        Stream the story chapter by chapter.
+
+        Yields a ``token`` event for every chunk the model produces and a
+        ``chapter`` event with the full text once a chapter is finished, so
+        callers can persist each chapter without waiting for the whole story.
+        """
+        logger.debug("Streaming %d chapters", len(self.outline.chapters))
+        for chapter in self.outline.chapters:
+            section_prompt = self._section_prompt(chapter, recalled=self._recall(chapter))
+            chat_history = self.memory.load_memory_variables({})["chat_history"]
+            messages = self.chat_prompt.format_messages(
+                chat_history=chat_history, human_input=section_prompt
+            )
+
+            parts = []
+            for chunk in self.chat.stream(messages):
+                if not chunk.content:
+                    continue
+                parts.append(chunk.content)
+                yield {
+                    "event": "token",
+                    "chapter": chapter.chapter_number,
+                    "text": chunk.content,
+                }
+
+            result = "".join(parts)
+            self.memory.save_context(
+                {"human_input": section_prompt}, {"story": result})
+            self._remember(chapter, result)
+            yield {
+                "event": "chapter",
+                "chapter": chapter.chapter_number,
+                "title": chapter.chapter_title,
+                "content": result,
+            }
+
+
+class LongStoryGenerator:
+    """
+    Writes a story from an ActsOutline, for stories of many chapters.
+
+    Each act is expanded into chapter plans when the writer reaches it, from
+    the story written so far. A chapter's prompt holds only its act, its plot
+    points, the characters who appear in it and the next chapter's title, with
+    the bounded StoryMemory for continuity, so it stays about the same size
+    however many chapters the story has. Chapters build on each other, so
+    they are always written in order, whatever the generation mode.
+    """
+
+    def __init__(
+        self,
+        genre: str,
+        topic: str,
+        outline: ActsOutline,
+        questions_and_answers: Any,
+        characters,
+    ):
+        self.genre = genre
+        self.topic = topic
+        self.acts = outline.acts
+        # Filled in act by act, as the acts are expanded
+        self.outline = Outline(chapters=[])
+        # Characters, or the nested list sent by older clients
+        self.characters = list(getattr(characters, 'characters', []))
+        self.expander = ActExpander(
+            input=topic, genre=genre, interview_questions_and_answers=questions_and_answers,
+            outline=outline, character_names=[c.name for c in self.characters])
+
+        prompt = f"""
+        Act as a Story writer.
+        You are currently writing a long story on topic: {self.topic} which genre {self.genre}, one chapter at a time.
+        ---
+        Use the story so far and the end of the previous chapter to continue the story without repeating yourself.
+        """
+        self.chat = get_chat_model(model="gpt-3.5-turbo-16k")
+        self.memory = build_story_memory()
+        # The characters and the chapters written, for the prompts to recall
+        # what the outline and the memory no longer hold
+        self.continuity = build_continuity_index()
+        if self.continuity is not None:
+            self.continuity.add_characters(characters)
+        self.chat_prompt = ChatPromptTemplate.from_messages(
+            [
+                SystemMessage(content=prompt),
+                MessagesPlaceholder(variable_name="chat_history"),
+                HumanMessagePromptTemplate.from_template("{human_input}"),
+            ]
+        )
+
+    def _characters_in(self, plan: ChapterPlan) -> List[Any]:
+        names = {name.lower() for name in plan.characters}
+        text = " ".join(plan.plot_points).lower()
+        return [c for c in self.characters if c.name.lower() in names or c.name.lower() in text]
+
+    def _chapter_characters(self, plan: ChapterPlan) -> str:
+        return "\n            ".join(
+            render_character(c, CHARACTER_MAX_TOKENS) for c in self._characters_in(plan))
+
+    def _recall(self, plan: ChapterPlan) -> str:
+        """
+        Passages of earlier chapters and descriptions of other characters
+        closest to this chapter's plan and to where the story is.
+        """
+        if self.continuity is None:
+            return ""
+        # The previous chapter's end and these characters are in the prompt already
+        skip = {chapter_source(plan.chapter_number - 1)}
+        skip.update(character_source(c.name) for c in self._characters_in(plan))
+        query = "\n".join([plan.chapter_title, *plan.plot_points, self.memory.tail])
+        return self.continuity.recall(query, skip=skip)
+
+    def _remember(self, plan: ChapterPlan, text: str) -> None:
+        if self.continuity is not None:
+            self.continuity.add_chapter(plan.chapter_number, text)
+
+    def _section_prompt(self, act: Act, plan: ChapterPlan, following: Optional[str]) -> str:
+        plot_points = "\n            ".join(f"- {point}" for point in plan.plot_points)
+        characters = self._chapter_characters(plan) or "- No named characters."
+        if following:
+            continuity = f"- End this chapter so that it leads into {following}, without writing its events."
+        else:
+            continuity = "- This is the final chapter. Resolve the story."
+        recalled = self._recall(plan)
+        if recalled:
+            continuity += f"""
+
+            ### Earlier passages to stay consistent with:
+            {recalled}"""
+        return f"""
+            You are writing a chapter of a book. Use the following information and guidelines to craft the content.
+            ---
+            ### Act {act.act_number} of {len(self.acts)}: {act.act_title}
+            {act.summary}
+
+            ### Chapter {plan.chapter_number}: {plan.chapter_title}
+            Plot points:
+            {plot_points}
+
+            ### Characters in this chapter:
+            {characters}
+
+            ### Continuity:
+            {continuity}
+            ---
+            ### Writing Guidelines:
+            - Write only the events of this chapter's plot points.
+            - The final section must be written in **Markdown (.md) format**.
+            - Use proper headings, subheadings, lists, and other Markdown features for readability.
+            ---
+            ### Output Section:
+            Write the following section:
+            - Chapter {plan.chapter_number}: {plan.chapter_title}
+            """
+
+    def _sections(self) -> Iterator[Tuple[ChapterPlan, str]]:
+        """``(plan, prompt)`` of every chapter, expanding each act when it is reached."""
+        for index, act in enumerate(self.acts):
+            plans = self.expander.expand(
+                act, first_chapter=len(self.outline.chapters) + 1, synopsis=self.memory.synopsis())
+            self.outline.chapters.extend(
+                Chapter(chapter_number=plan.chapter_number, chapter_title=plan.chapter_title)
+                for plan in plans
+            )
+            for position, plan in enumerate(plans):
+                if position + 1 < len(plans):
+                    following = plans[position + 1]
+                    following = f"Chapter {following.chapter_number}: {following.chapter_title}"
+                elif index + 1 < len(self.acts):
+                    following = f"Act {self.acts[index + 1].act_number}: {self.acts[index + 1].act_title}"
+                else:
+                    following = None
+                yield plan, self._section_prompt(act, plan, following)
+
+    def _messages(self, section_prompt: str):
+        chat_history = self.memory.load_memory_variables({})["chat_history"]
+        return self.chat_prompt.format_messages(chat_history=chat_history, human_input=section_prompt)
+
+    def generate_stories(self, mode: str = SEQUENTIAL) -> List[str]:
+        story = []
+        logger.debug("Writing a long story of %d acts", len(self.acts))
+        for plan, section_prompt in self._sections():
+            result = self.chat.invoke(self._messages(section_prompt)).content
+            self.memory.save_context({"human_input": section_prompt}, {"story": result})
+            self._remember(plan, result)
+            story.append(result)
+        return story
+
+    async def agenerate_stories(self, mode: str = SEQUENTIAL) -> List[str]:
+        # Every chapter waits for the one before it, so run the loop on a thread
+        return await sync_to_async(self.generate_stories, thread_sensitive=False)(mode)
+
+    def stream_stories(self) -> Iterator[Dict[str, Any]]:
+        """Same events as ``StoryGenerator.stream_stories``."""
+        logger.debug("Streaming a long story of %d acts", len(self.acts))
+        for plan, section_prompt in self._sections():
+            parts = []
+            for chunk in self.chat.stream(self._messages(section_prompt)):
+                if not chunk.content:
+                    continue
+                parts.append(chunk.content)
+                yield {
+                    "event": "token",
+                    "chapter": plan.chapter_number,
+                    "text": chunk.content,
+                }
+            result = "".join(parts)
+            self.memory.save_context({"human_input": section_prompt}, {"story": result})
+            self._remember(plan, result)
+            yield {
+                "event": "chapter",
+                "chapter": plan.chapter_number,
+                "title": plan.chapter_title,
+                "content": result,
+            }
+
+
+def create_story_generator(genre: str, topic: str, outline: Any, questions_and_answers: Any, characters):
+    """The generator for ``outline``: acts are written by LongStoryGenerator."""
+    generator = LongStoryGenerator if isinstance(outline, ActsOutline) else StoryGenerator
+    return generator(genre=genre, topic=topic, outline=outline,
+                     questions_and_answers=questions_and_answers, characters=characters)
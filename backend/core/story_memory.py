@@ -0,0 +1,178 @@
+import contextvars
+import logging
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.memory import BaseMemory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from pydantic import PrivateAttr
+
+from .tokens import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Background synopsis rewrites, shared by every StoryMemory in the process
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='story-memory')
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+HEADING = re.compile(r'^\s*#+\s*(.+?)\s*$', re.MULTILINE)
+OMITTED = "(Earlier chapters omitted.)"
+
+SYNOPSIS_PROMPT = """You keep the synopsis of a story that is being written chapter by chapter.
+Rewrite the synopsis so that it also covers the new chapter. Keep the main events, the characters' \
+situations and any open threads. Use at most {max_words} words and reply with the synopsis only.
+
+Synopsis so far:
+{synopsis}
+
+New chapter:
+{chapter}"""
+
+
+def _sentences(text: str) -> List[str]:
+    body = HEADING.sub('', text)
+    return [s.strip() for s in SENTENCE_END.split(body) if s.strip()]
+
+
+def _choose_digests(digests: List[Tuple[str, int, str, int]], budget: int) -> List[str]:
+    """Digests of the newest chapters that fit in ``budget``, newest first."""
+    # Newest chapters matter most: give them full digests first
+    chosen = []
+    for full, full_tokens, short, short_tokens in reversed(digests):
+        # Each one with the newline before the next
+        if full_tokens + 1 <= budget:
+            chosen.append(full)
+            budget -= full_tokens + 1
+        elif short_tokens + 1 <= budget:
+            chosen.append(short)
+            budget -= short_tokens + 1
+        else:
+            break
+    return chosen
+
+
+class StoryMemory(BaseMemory):
+    """
+    Bounded memory for writing a story one chapter at a time.
+
+    The prompt gets a synopsis of the chapters written so far, capped at
+    ``synopsis_max_tokens``, and the end of the previous chapter, capped at
+    ``tail_max_tokens``, so it stays the same size however long the story
+    gets. Each chapter adds a digest taken from its own text (its title and
+    first and last sentences); the oldest digests are shortened, then dropped,
+    to stay within the cap. Token counts are kept with each entry.
+
+    With a ``summarizer`` model, the synopsis is rewritten by the model after
+    every chapter instead, in the background when ``background`` is set; the
+    chapters a rewrite has not covered yet are represented by their digests.
+    """
+
+    memory_key: str = "chat_history"
+    synopsis_max_tokens: int = 400
+    tail_max_tokens: int = 300
+    summarizer: Optional[BaseChatModel] = None
+    background: bool = True
+
+    # (full digest, tokens, short digest, tokens) per chapter
+    digests: List[Tuple[str, int, str, int]] = []
+    tail: str = ""
+    # Model-written synopsis and how many chapters it covers
+    summary: str = ""
+    summarized: int = 0
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _pending: Optional[Future] = PrivateAttr(default=None)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def _digest(self, text: str) -> Tuple[str, int, str, int]:
+        number = len(self.digests) + 1
+        heading = HEADING.search(text)
+        title = heading.group(1) if heading else f"Chapter {number}"
+        sentences = _sentences(text)
+        short = f"{title}: {sentences[0]}" if sentences else title
+        full = short if len(sentences) < 2 else f"{short} ... {sentences[-1]}"
+        return full, count_tokens(full), short, count_tokens(short)
+
+    def synopsis(self) -> str:
+        with self._lock:
+            summary, covered = self.summary, self.summarized
+            digests = self.digests[covered:]
+        budget = self.synopsis_max_tokens
+        parts = []
+        if summary:
+            summary = truncate_tokens(summary, budget)
+            parts.append(summary)
+            # And the newline after it, as after every digest
+            budget -= count_tokens(summary) + 1
+        chosen = _choose_digests(digests, budget)
+        if len(chosen) < len(digests) and not summary:
+            # Not every chapter fits, leave room to say so
+            chosen = _choose_digests(digests, budget - count_tokens(OMITTED) - 1)
+            parts.append(OMITTED)
+        parts.extend(reversed(chosen))
+        return "\n".join(parts)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, List[BaseMessage]]:
+        messages: List[BaseMessage] = []
+        synopsis = self.synopsis()
+        if synopsis:
+            messages.append(SystemMessage(content=f"The story so far:\n{synopsis}"))
+        if self.tail:
+            messages.append(AIMessage(content=self.tail))
+        return {self.memory_key: messages}
+
+    def _rewrite_summary(self, covered: int, chapter: str) -> None:
+        with self._lock:
+            synopsis = self.summary or "(none yet)"
+            # Chapters a failed rewrite left out, by their digests
+            missed = [full for full, _, _, _ in self.digests[self.summarized:covered - 1]]
+        prompt = SYNOPSIS_PROMPT.format(
+            # About three words for every four tokens
+            max_words=self.synopsis_max_tokens * 3 // 4,
+            synopsis="\n".join([synopsis, *missed]),
+            chapter=truncate_tokens(chapter, self.synopsis_max_tokens * 4),
+        )
+        try:
+            result = self.summarizer.invoke([HumanMessage(content=prompt)])
+        except Exception:
+            # The digests still cover these chapters
+            logger.exception("Could not update the story synopsis")
+            return
+        with self._lock:
+            self.summary = truncate_tokens(str(result.content), self.synopsis_max_tokens)
+            self.summarized = covered
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        text = next(iter(outputs.values())) if len(outputs) == 1 else outputs.get("story", "")
+        digest = self._digest(text)
+        with self._lock:
+            self.digests = [*self.digests, digest]
+            covered = len(self.digests)
+        self.tail = truncate_tokens(text, self.tail_max_tokens, keep_end=True)
+        if self.summarizer is None:
+            return
+        # Rewrites build on each other, so run them one after another
+        previous = self._pending
+        if previous is not None:
+            previous.result()
+        if self.background:
+            context = contextvars.copy_context()
+            self._pending = _executor.submit(context.run, self._rewrite_summary, covered, text)
+        else:
+            self._rewrite_summary(covered, text)
+
+    def clear(self) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        with self._lock:
+            self.digests = []
+            self.tail = ""
+            self.summary = ""
+            self.summarized = 0
@@ -1,9 +1,16 @@
 from dotenv import load_dotenv
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.output_parsers import PydanticOutputParser
 from langchain_core.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate
-from typing import List, Any
-from pydantic import BaseModel
+from typing import Any, Dict, Iterator, List, Optional
+from pydantic import BaseModel, Field
+from .llm import get_chain
+from .structured_output import StructuredChain
+
+# Chapters in an outline unless the user asks for a number
+DEFAULT_CHAPTERS = 3
+MAX_CHAPTERS = 50
+# Longer stories are outlined as acts, and each act is only expanded into
+# chapters when the writer gets to it (see ActExpander)
+LONG_FORM_CHAPTERS = 8
 
 
 class Chapter(BaseModel):
@@ -15,52 +22,217 @@ class StoriesOutline(BaseModel):
     chapters: List[Chapter]
 
 
-# Langchain libraries:
+class Act(BaseModel):
+    act_number: int
+    act_title: str
+    summary: str = Field(description="What happens in the act, from its opening to its turning point")
+    chapter_count: int = Field(description="Number of chapters the act takes")
+
+
+class ActsOutline(BaseModel):
+    acts: List[Act]
+
+
+class ChapterPlan(BaseModel):
+    chapter_number: int
+    chapter_title: str
+    plot_points: List[str] = Field(description="The main events of the chapter, in order")
+    characters: List[str] = Field(description="Names of the characters who appear in the chapter")
+
+
+class ActChapters(BaseModel):
+    chapters: List[ChapterPlan]
+
+
+def parse_outline(data: dict) -> Any:
+    """The StoriesOutline or ActsOutline stored as ``data``."""
+    if 'acts' in data:
+        return ActsOutline.model_validate(data)
+    return StoriesOutline.model_validate(data)
+
 
-# Custom types:
 load_dotenv()
 
 
+OUTLINE_PROMPT = """
+        Based on the user_queries and genre and the interview answer, generate only {chapters} chapters for the stories
+        user_queries: {input}
+        genre: {genre}
+        ---
+        Here is the interview which I answered: {interview_questions_and_answers}
+        - If the interview question do not contain the answers, it is consider user let you to decide the answer
+        ---
+        Output format: {format_instructions}
+        """
+
+ACTS_PROMPT = """
+        Based on the user_queries and genre and the interview answer, plan a long story of {chapters} chapters in {acts} acts
+        user_queries: {input}
+        genre: {genre}
+        ---
+        Here is the interview which I answered: {interview_questions_and_answers}
+        - If the interview question do not contain the answers, it is consider user let you to decide the answer
+        ---
+        Give every act a title, a summary of what happens in it and the number of chapters it takes.
+        The chapter counts of the acts must add up to {chapters}.
+        Output format: {format_instructions}
+        """
+
+EXPANSION_PROMPT = """
+        You are planning the chapters of a long {genre} story, one act at a time.
+        user_queries: {input}
+        Here is the interview which I answered: {interview_questions_and_answers}
+        ---
+        The acts of the story:
+        {acts}
+
+        The characters: {characters}
+
+        The story so far:
+        {synopsis}
+        ---
+        Plan chapters {first_chapter} to {last_chapter}, which make up Act {act_number}: {act_title}.
+        Give every chapter a title, its plot points in order and the names of the characters who appear in it.
+        Only plan the events of this act, and end it so that it leads into the next one.
+        Output format: {format_instructions}
+        """
+
+
+def build_story_outline_chain():
+    system_message_prompt = SystemMessagePromptTemplate.from_template(
+        OUTLINE_PROMPT
+    )
+    chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt])
+    return StructuredChain(chat_prompt, StoriesOutline, model="gpt-4o", temperature=0)
+
+
+def build_acts_outline_chain():
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [SystemMessagePromptTemplate.from_template(ACTS_PROMPT)])
+    return StructuredChain(chat_prompt, ActsOutline, model="gpt-4o", temperature=0)
+
+
+def build_act_expansion_chain():
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [SystemMessagePromptTemplate.from_template(EXPANSION_PROMPT)])
+    return StructuredChain(chat_prompt, ActChapters, model="gpt-4o", temperature=0)
+
+
+def fit_chapter_counts(outline: ActsOutline, chapters: int) -> ActsOutline:
+    """Adjust the acts' chapter counts so they add up to ``chapters``."""
+    # Every act takes a chapter at least, so only as many acts as chapters
+    acts = outline.acts[:max(1, chapters)]
+    counts = [max(1, act.chapter_count) for act in acts]
+    while sum(counts) > chapters and max(counts) > 1:
+        counts[counts.index(max(counts))] -= 1
+    while sum(counts) < chapters:
+        counts[counts.index(min(counts))] += 1
+    return ActsOutline(acts=[
+        act.model_copy(update={'act_number': number, 'chapter_count': count})
+        for number, (act, count) in enumerate(zip(acts, counts), start=1)
+    ])
+
+
 class StoryOutlineGenerator:
-    def __init__(self, input: str, genre: str, interview_questions_and_answers: Any):
+    """
+    Outlines ``chapters`` chapters. Up to ``LONG_FORM_CHAPTERS`` the result is
+    a StoriesOutline; longer stories get an ActsOutline instead, whose acts
+    are expanded into chapters while the story is written.
+    """
+
+    def __init__(self, input: str, genre: str, interview_questions_and_answers: Any,
+                 chapters: int = DEFAULT_CHAPTERS):
         self.input = input
         self.genre = genre
         self.interview_questions_and_answers = interview_questions_and_answers
+        self.chapters = chapters
+        self.long_form = chapters > LONG_FORM_CHAPTERS
 
-        # Create a prompt
-        prompt_content = """
-            Based on the user_queries and genre and the interview answer, generate only 3 chapters for the stories
-            user_queries: {input}
-            genre: {genre}
-            ---
-            Here is the interview which I answered: {interview_questions_and_answers}
-            - If the interview question do not contain the answers, it is consider user let you to decide the answer
-            ---
-            Output format: {format_instructions}
-            """
-
-        system_message_prompt = SystemMessagePromptTemplate.from_template(
-            prompt_content
-        )
-        self.chat_prompt = ChatPromptTemplate.from_messages(
-            [system_message_prompt])
-
-        # Create an output parser
-        self.parser = PydanticOutputParser(pydantic_object=StoriesOutline)
-
-        # Set up the chain
-        self.outline_chain = self.chat_prompt | ChatOpenAI(
-            temperature=0, model="gpt-4o") | self.parser
+        # The prompt, parser and model are shared by every request
+        if self.long_form:
+            self.outline_chain = get_chain("acts_outline", build_acts_outline_chain)
+        else:
+            self.outline_chain = get_chain("story_outline", build_story_outline_chain)
+
+    def _chain_inputs(self) -> dict:
+        inputs = {
+            "input": self.input,
+            "genre": self.genre,
+            "interview_questions_and_answers": self.interview_questions_and_answers,
+            "chapters": self.chapters,
+        }
+        if self.long_form:
+            # About eight chapters an act
+            inputs.update(acts=min(6, max(3, round(self.chapters / 8))))
+        return inputs
+
+    def _result(self, result: Any) -> Any:
+        if self.long_form:
+            return fit_chapter_counts(result, self.chapters)
+        return result
 
     def generate_outline(self) -> Any:
         print("Generating the Stories Outline...\n---")
-        result = self.outline_chain.invoke(
-            {
-                "input": self.input,
-                "genre": self.genre,
-                "interview_questions_and_answers": self.interview_questions_and_answers,
-                "format_instructions": self.parser.get_format_instructions(),
-            }
-        )
+        result = self.outline_chain.invoke(self._chain_inputs())
         print("Finished generating the outline!\n---")
-        return result
+        return self._result(result)
+
+    async def agenerate_outline(self) -> Any:
+        print("Generating the Stories Outline...\n---")
+        result = await self.outline_chain.ainvoke(self._chain_inputs())
+        print("Finished generating the outline!\n---")
+        return self._result(result)
+
+    def stream_outline(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yields a ``chapter`` event (an ``act`` event for a long story) as
+        soon as each one is written, then an ``outline`` event with the
+        whole outline, which is the one to keep.
+        """
+        print("Streaming the Stories Outline...\n---")
+        key = "acts" if self.long_form else "chapters"
+        for result in self.outline_chain.stream(self._chain_inputs(), key):
+            if isinstance(result, (StoriesOutline, ActsOutline)):
+                yield {"event": "outline", "result": self._result(result)}
+            else:
+                yield {"event": key[:-1], key[:-1]: result}
+        print("Finished streaming the outline!\n---")
+
+
+class ActExpander:
+    """
+    Expands the acts of an ActsOutline into chapter plans, one act at a time,
+    from the story written so far.
+    """
+
+    def __init__(self, input: str, genre: str, interview_questions_and_answers: Any,
+                 outline: ActsOutline, character_names: Optional[List[str]] = None):
+        self.input = input
+        self.genre = genre
+        self.interview_questions_and_answers = interview_questions_and_answers
+        self.outline = outline
+        self.character_names = character_names or []
+        self.expansion_chain = get_chain("act_expansion", build_act_expansion_chain)
+
+    def expand(self, act: Act, first_chapter: int, synopsis: str = "") -> List[ChapterPlan]:
+        print(f"Expanding Act {act.act_number}: {act.act_title}...\n---")
+        last_chapter = first_chapter + act.chapter_count - 1
+        result = self.expansion_chain.invoke({
+            "input": self.input,
+            "genre": self.genre,
+            "interview_questions_and_answers": self.interview_questions_and_answers,
+            "acts": "\n".join(
+                f"Act {a.act_number}: {a.act_title} ({a.chapter_count} chapters) - {a.summary}"
+                for a in self.outline.acts),
+            "characters": ", ".join(self.character_names) or "(none yet)",
+            "synopsis": synopsis or "(nothing written yet)",
+            "first_chapter": first_chapter,
+            "last_chapter": last_chapter,
+            "act_number": act.act_number,
+            "act_title": act.act_title,
+        })
+        # Number the chapters from where the story is, whatever the model wrote
+        return [
+            plan.model_copy(update={'chapter_number': number})
+            for number, plan in enumerate(result.chapters[:act.chapter_count], start=first_chapter)
+        ]
@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, List, Set
+
+from django.db import close_old_connections, connection, transaction
+
+from .llm_scheduler import BULK, llm_priority
+from .models import Chapter, ChapterSummary, Story
+from .summary_chain import StorySummarizer
+from .tracing import tracing_scope
+
+logger = logging.getLogger(__name__)
+
+# Story.summary, reduced from the summaries of the story's chapters.
+#
+# Every chapter's summary is stored with a hash of the title and content it
+# was written from, so summarizing a story again only summarizes the chapters
+# that changed since. When a chapter of a summarized story is edited or
+# deleted, its summary and the story's are brought up to date off the
+# request path (see core.signals). While the generation pipeline writes a
+# story's chapters one by one, those updates wait for it to finish and then
+# run once.
+
+# Summary updates run on a small pool of threads
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='story-summary')
+_lock = threading.Lock()
+# Stories with an update queued but not started, so a burst of edits makes one
+_pending: Set[int] = set()
+# Stories the pipeline is writing chapters of, and how many times over
+_writing: Counter = Counter()
+
+
+def source_hash(chapter: Chapter) -> str:
+    return hashlib.sha256(f"{chapter.title}\x00{chapter.content}".encode('utf-8')).hexdigest()
+
+
+def chapter_summaries(story: Story, summarizer: StorySummarizer) -> List[str]:
+    """The summary of every chapter of ``story``, in order, summarizing the stale ones."""
+    chapters = list(Chapter.objects.filter(story=story).order_by('position'))
+    stored = {
+        summary.chapter_id: summary
+        for summary in ChapterSummary.objects.filter(chapter__story=story)
+    }
+    hashes = {chapter.pk: source_hash(chapter) for chapter in chapters}
+    stale = [
+        chapter for chapter in chapters
+        if chapter.pk not in stored or stored[chapter.pk].source_hash != hashes[chapter.pk]
+    ]
+    summaries = {pk: summary.summary for pk, summary in stored.items()}
+    if stale:
+        fresh = summarizer.summarize_chapters(
+            [(chapter.position, chapter.title, chapter.content) for chapter in stale])
+        rows = [
+            ChapterSummary(chapter=chapter, source_hash=hashes[chapter.pk], summary=summary)
+            for chapter, summary in zip(stale, fresh)
+        ]
+        # MySQL's ON DUPLICATE KEY UPDATE cannot name the conflicting columns
+        unique_fields = (['chapter']
+                         if connection.features.supports_update_conflicts_with_target else None)
+        with transaction.atomic():
+            ChapterSummary.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=unique_fields,
+                update_fields=['source_hash', 'summary', 'updated_at'],
+            )
+        summaries.update((row.chapter_id, row.summary) for row in rows)
+    return [summaries[chapter.pk] for chapter in chapters]
+
+
+def summarize_story(story: Story) -> str:
+    """Bring ``story.summary`` up to date with its chapters and save it."""
+    summarizer = StorySummarizer(genre=story.genre)
+    story.summary = summarizer.reduce(chapter_summaries(story, summarizer))
+    story.save(update_fields=['summary', 'last_update'])
+    return story.summary
+
+
+def _update(story_id: int) -> None:
+    with _lock:
+        _pending.discard(story_id)
+    # Runs on a worker thread, which needs its own database connection
+    close_old_connections()
+    try:
+        story = Story.objects.filter(pk=story_id).first()
+        # Only summaries someone asked for are kept up to date
+        if story is not None and story.summary:
+            with tracing_scope(story_id, 'summary'), llm_priority(BULK):
+                summarize_story(story)
+    except Exception:
+        logger.exception("Could not update the summary of story %s", story_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_summary_update(story_id: int) -> None:
+    with _lock:
+        if story_id in _pending or story_id in _writing:
+            return
+        _pending.add(story_id)
+    _executor.submit(_update, story_id)
+
+
+@contextmanager
+def deferred_summary_update(story_id: int) -> Iterator[None]:
+    """
+    Hold back the summary updates of the chapters written inside the block,
+    and schedule one once it is done (and committed).
+    """
+    with _lock:
+        _writing[story_id] += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _writing[story_id] -= 1
+            if not _writing[story_id]:
+                del _writing[story_id]
+        transaction.on_commit(lambda: schedule_summary_update(story_id))
@@ -0,0 +1,325 @@
+import json
+import logging
+import re
+from typing import Any, Dict, Iterator, List, Optional, Type, get_args
+
+from annotated_types import MaxLen
+from django.conf import settings
+from langchain.output_parsers import PydanticOutputParser
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel, ValidationError
+
+from .llm import get_chat_model, get_provider
+from .tracing import current_scope
+
+logger = logging.getLogger(__name__)
+
+# JSON answers of the chat models (interview questions, outlines, characters).
+#
+# Where the provider can hold the model to a JSON schema (OpenAI structured
+# outputs on the models in JSON_SCHEMA_MODELS, grammars on llama.cpp), the
+# schema goes in the request's response format and the prompt carries no
+# format instructions. Other OpenAI models get JSON mode and the parser's
+# format instructions, as before.
+#
+# Replies are read leniently: a code fence or prose around the JSON, trailing
+# commas, raw newlines in strings, a reply cut off before its closing
+# brackets and lists longer than the schema allows are fixed here. Only a
+# reply that still does not fit the schema is sent back to the model, with
+# the error, at most MAX_REPROMPTS times.
+#
+# Answers can be streamed too: the items of one list (the characters, the
+# chapters of an outline) are picked out of the reply as each one is
+# complete, so they can be sent on before the model has finished.
+
+DEFAULT_STRUCTURED_OUTPUT = {
+    'RESPONSE_FORMAT': True,  # False to always prompt with format instructions
+    # OpenAI models that take a JSON schema as their response format
+    'JSON_SCHEMA_MODELS': ['gpt-4o', 'gpt-4o-mini'],
+    'MAX_REPROMPTS': 1,
+}
+
+# Stands in for the format instructions when the schema is in the request
+SCHEMA_INSTRUCTIONS = "Answer in JSON."
+
+REPROMPT = """Your answer could not be used: {error}
+Answer again with only the JSON, following the output format."""
+
+FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+# Keywords the structured outputs API does not take; titles only cost tokens,
+# and with every property required a default never applies
+UNSUPPORTED_KEYWORDS = frozenset(['title', 'default', 'minItems', 'maxItems'])
+
+
+def _settings() -> Dict[str, Any]:
+    return {**DEFAULT_STRUCTURED_OUTPUT, **getattr(settings, 'STRUCTURED_OUTPUT', {})}
+
+
+def _tighten(schema: Any, defs: Dict[str, Any]) -> Any:
+    if isinstance(schema, list):
+        return [_tighten(value, defs) for value in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if '$ref' in schema and len(schema) > 1:
+        # Nothing may sit next to a $ref (e.g. a field's description), so
+        # the definition is inlined
+        referenced = defs[schema['$ref'].rsplit('/', 1)[-1]]
+        schema = {**referenced, **{key: value for key, value in schema.items() if key != '$ref'}}
+    tightened = {
+        key: ({name: _tighten(field, defs) for name, field in value.items()}
+              if key in ('properties', '$defs') else _tighten(value, defs))
+        for key, value in schema.items() if key not in UNSUPPORTED_KEYWORDS
+    }
+    if 'properties' in tightened:
+        # Strict schemas list every property as required and no others
+        tightened['required'] = list(tightened['properties'])
+        tightened['additionalProperties'] = False
+    return tightened
+
+
+def strict_json_schema(schema: Type[BaseModel]) -> dict:
+    """JSON schema of ``schema`` in the form strict structured outputs take."""
+    json_schema = schema.model_json_schema()
+    return _tighten(json_schema, json_schema.get('$defs', {}))
+
+
+def response_format(model: str, schema: Type[BaseModel]) -> Optional[dict]:
+    """The response format to request ``schema`` from ``model`` with, if any."""
+    options = _settings()
+    if not options['RESPONSE_FORMAT']:
+        return None
+    provider = get_provider(model)
+    if provider == 'llama_cpp' or model in options['JSON_SCHEMA_MODELS']:
+        return {
+            'type': 'json_schema',
+            'json_schema': {'name': schema.__name__, 'schema': strict_json_schema(schema), 'strict': True},
+        }
+    if provider == 'openai':
+        return {'type': 'json_object'}
+    return None
+
+
+def _drop_trailing_commas(text: str) -> str:
+    out: List[str] = []
+    in_string = escaped = False
+    comma = None  # index in out of a comma followed only by whitespace so far
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            comma = None
+        elif char in '}]' and comma is not None:
+            del out[comma]
+            comma = None
+        elif char == ',':
+            comma = len(out)
+        elif not char.isspace():
+            comma = None
+        out.append(char)
+    return "".join(out)
+
+
+def repair_json(text: str) -> Any:
+    """
+    The JSON value in a model's reply ``text``, fixing what models commonly
+    get wrong. Raises ValueError if there is no JSON to be found.
+    """
+    fenced = FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        raise ValueError("there is no JSON in the answer")
+    text = _drop_trailing_commas(text[min(starts):])
+    try:
+        # Ignores anything after the value
+        return json.JSONDecoder(strict=False).raw_decode(text)[0]
+    except ValueError:
+        pass
+    # Cut off, e.g. at the token limit: close the open strings and brackets
+    value = parse_partial_json(text, strict=False)
+    if value is None:
+        raise ValueError("the answer is not valid JSON")
+    return value
+
+
+def _fit(value: Any, schema: Type[BaseModel]) -> Any:
+    """``value`` shaped to ``schema`` where that is obvious."""
+    fields = schema.model_fields
+    if isinstance(value, list) and len(fields) == 1:
+        # The list without the object around it
+        value = {next(iter(fields)): value}
+    if isinstance(value, dict):
+        for name, field in fields.items():
+            for constraint in field.metadata:
+                if isinstance(constraint, MaxLen) and isinstance(value.get(name), list):
+                    value[name] = value[name][:constraint.max_length]
+    return value
+
+
+def parse_structured(text: str, schema: Type[BaseModel]) -> BaseModel:
+    """``schema`` read from a model's reply, repaired if need be."""
+    try:
+        return schema.model_validate(_fit(repair_json(text), schema))
+    except (ValueError, ValidationError) as e:
+        raise OutputParserException(
+            f"Failed to parse {schema.__name__} from the answer: {e}", llm_output=text) from e
+
+
+class JsonItemStream:
+    """
+    Picks the objects of the list under ``key`` out of a JSON object's text
+    as it streams in, each one as soon as its closing brace arrives.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.text = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_key = None  # the last string of the outer object
+        self._in_list = False
+        self._item_start = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        """The items completed by ``chunk``."""
+        self.text += chunk
+        text, items = self.text, []
+        for index in range(self._position, len(text)):
+            char = text[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = text[self._string_start + 1:index]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = index
+            elif char in '{[':
+                self._depth += 1
+                if char == '[' and self._depth == 2 and self._last_key == self.key:
+                    self._in_list = True
+                elif char == '{' and self._depth == 3 and self._in_list:
+                    self._item_start = index
+            elif char in '}]':
+                if char == '}' and self._depth == 3 and self._item_start is not None:
+                    try:
+                        items.append(json.loads(text[self._item_start:index + 1], strict=False))
+                    except ValueError:
+                        pass
+                    self._item_start = None
+                elif char == ']' and self._depth == 2:
+                    self._in_list = False
+                self._depth -= 1
+        self._position = len(text)
+        return items
+
+
+def _item_schema(schema: Type[BaseModel], key: str) -> Type[BaseModel]:
+    return get_args(schema.model_fields[key].annotation)[0]
+
+
+class StructuredChain:
+    """
+    ``prompt`` answered by ``model`` with an instance of ``schema``. The
+    prompt's ``{format_instructions}`` are filled in here.
+    """
+
+    def __init__(self, prompt: ChatPromptTemplate, schema: Type[BaseModel], model: str = "gpt-3.5-turbo",
+                 temperature: float = 0.7):
+        self.prompt = prompt
+        self.schema = schema
+        self.parser = PydanticOutputParser(pydantic_object=schema)
+        self.chat = get_chat_model(model=model, temperature=temperature)
+        self.response_format = response_format(model, schema)
+        if self.response_format is None:
+            self.llm = self.chat
+        else:
+            self.llm = self.chat.bind(response_format=self.response_format)
+        if self.response_format and self.response_format['type'] == 'json_schema':
+            self.format_instructions = SCHEMA_INSTRUCTIONS
+        else:
+            self.format_instructions = self.parser.get_format_instructions()
+
+    def _messages(self, inputs: Dict[str, Any]) -> List[BaseMessage]:
+        return self.prompt.format_messages(**{**inputs, 'format_instructions': self.format_instructions})
+
+    def _reprompt(self, messages: List[BaseMessage], text: str,
+                  error: OutputParserException) -> List[BaseMessage]:
+        # Without the exception's troubleshooting link
+        reason = error.__cause__ or error
+        # A JSON line next to the step's model calls (see core/tracing.py)
+        scope = current_scope()
+        logger.warning(json.dumps({
+            'event': 'structured_output_reprompt', 'story_id': scope['story_id'], 'step': scope['step'],
+            'schema': self.schema.__name__, 'error': str(reason),
+        }))
+        return messages + [AIMessage(content=text), HumanMessage(content=REPROMPT.format(error=reason))]
+
+    def _answer(self, messages: List[BaseMessage], text: str) -> Any:
+        """``text`` parsed, asking again while it cannot be and reprompts are left."""
+        reprompts = _settings()['MAX_REPROMPTS']
+        while True:
+            try:
+                return parse_structured(text, self.schema)
+            except OutputParserException as e:
+                if reprompts <= 0:
+                    raise
+                reprompts -= 1
+                messages = self._reprompt(messages, text, e)
+                text = self.llm.invoke(messages).content
+
+    async def _aanswer(self, messages: List[BaseMessage], text: str) -> Any:
+        reprompts = _settings()['MAX_REPROMPTS']
+        while True:
+            try:
+                return parse_structured(text, self.schema)
+            except OutputParserException as e:
+                if reprompts <= 0:
+                    raise
+                reprompts -= 1
+                messages = self._reprompt(messages, text, e)
+                text = (await self.llm.ainvoke(messages)).content
+
+    def invoke(self, inputs: Dict[str, Any]) -> Any:
+        messages = self._messages(inputs)
+        return self._answer(messages, self.llm.invoke(messages).content)
+
+    async def ainvoke(self, inputs: Dict[str, Any]) -> Any:
+        messages = self._messages(inputs)
+        return await self._aanswer(messages, (await self.llm.ainvoke(messages)).content)
+
+    def stream(self, inputs: Dict[str, Any], key: str) -> Iterator[Any]:
+        """
+        Yields each item of the list field ``key`` as soon as the model has
+        written it, and last the whole answer. Should the answer need asking
+        for again, the items of the new answer are not streamed; the whole
+        answer is the one to keep.
+        """
+        messages = self._messages(inputs)
+        item_schema = _item_schema(self.schema, key)
+        items = JsonItemStream(key)
+        for chunk in self.llm.stream(messages):
+            for item in items.feed(chunk.content):
+                try:
+                    yield item_schema.model_validate(item)
+                except ValidationError:
+                    # Left to the repair of the whole answer
+                    continue
+        yield self._answer(messages, items.text)
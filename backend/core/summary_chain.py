@@ -1,55 +1,136 @@
 from dotenv import load_dotenv
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.output_parsers import PydanticOutputParser
+from django.conf import settings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate
-from typing import Any
-from pydantic.v1 import BaseModel
-
-
-class StorySummary(BaseModel):
-    summary: str
-
+from typing import Any, Dict, List, Sequence, Tuple
+from .llm import get_chain, get_chat_model
+from .tokens import count_tokens
 
 # Langchain libraries:
 
 # Custom types:
 load_dotenv()
 
+# Stories are summarized map-reduce style, so no prompt has to hold the whole
+# story: chapters are split into chunks, the chunks of every chapter are
+# summarized in parallel, and the summaries are combined a group of
+# consecutive ones at a time, level by level, until they fit in one prompt.
+# Groups are fixed runs of REDUCE_FANOUT summaries, so when one chapter
+# changes only its group is combined anew; the other groups' prompts are
+# unchanged and answered from the LLM cache (core/llm_cache.py).
 
-class StorySummarizer:
-    def __init__(self, story: str):
-        self.story = story
+DEFAULT_SUMMARIZATION = {
+    'CHUNK_TOKENS': 2000,
+    'CHUNK_OVERLAP': 100,  # tokens
+    'MAX_CONCURRENCY': 8,  # calls at a time
+    'REDUCE_TOKENS': 3000,  # summaries combined in one call
+    'REDUCE_FANOUT': 8,
+}
+
+CHUNK_PROMPT = """
+        Summarize the following part of chapter {chapter} of a {genre} story.
+        Keep the key events, the characters involved and anything that changes for them, in a few sentences.
+
+        Text: {text}
+    """
+
+REDUCE_PROMPT = """
+        The following are summaries of consecutive parts of {scope}, in order.
+        Combine them into one concise summary.
+        The summary should cover the key events and major points without dividing it into chapters.
+
+        Summaries:
+        {summaries}
+    """
+
+
+def _settings() -> Dict[str, Any]:
+    return {**DEFAULT_SUMMARIZATION, **getattr(settings, 'SUMMARIZATION', {})}
 
-        # Create a prompt
-        prompt_content = """
-            Summarize the following story into one concise summary.
-            The summary should cover the key events and major points of the story without dividing it into chapters.
 
-            Story: {story}
-            ---
-            Output format: {format_instructions}
-        """
+def build_chunk_summary_chain():
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [SystemMessagePromptTemplate.from_template(CHUNK_PROMPT)])
+    return chat_prompt | get_chat_model(model="gpt-4o", temperature=0) | StrOutputParser()
 
-        system_message_prompt = SystemMessagePromptTemplate.from_template(
-            prompt_content
+
+def build_reduce_summary_chain():
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [SystemMessagePromptTemplate.from_template(REDUCE_PROMPT)])
+    return chat_prompt | get_chat_model(model="gpt-4o", temperature=0) | StrOutputParser()
+
+
+class StorySummarizer:
+    """
+    Summarizes ``(title, content)`` chapters, each one on its own, and the
+    story from the chapter summaries.
+    """
+
+    def __init__(self, genre: str = "story"):
+        self.genre = genre
+        self.options = _settings()
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self.options['CHUNK_TOKENS'],
+            chunk_overlap=self.options['CHUNK_OVERLAP'],
+            length_function=count_tokens,
         )
-        self.chat_prompt = ChatPromptTemplate.from_messages(
-            [system_message_prompt])
 
-        # Create an output parser
-        self.parser = PydanticOutputParser(pydantic_object=StorySummary)
+        # The prompts and model are shared by every request
+        self.chunk_chain = get_chain("chunk_summary", build_chunk_summary_chain)
+        self.reduce_chain = get_chain("reduce_summary", build_reduce_summary_chain)
 
-        # Set up the chain
-        self.summarization_chain = self.chat_prompt | ChatOpenAI(
-            temperature=0, model="gpt-4o") | self.parser
+    def _config(self) -> dict:
+        return {'max_concurrency': self.options['MAX_CONCURRENCY']}
 
-    def summarize_story(self) -> Any:
+    def summarize_chapters(self, chapters: Sequence[Tuple[int, str, str]]) -> List[str]:
+        """Summaries of ``(number, title, content)`` chapters, in order."""
+        if not chapters:
+            return []
+        print(f"Summarizing {len(chapters)} chapters...\n---")
+        # The chunks of every chapter, all summarized at once
+        chunks = [
+            (index, {"chapter": f"{number}, \"{title}\"", "genre": self.genre, "text": text})
+            for index, (number, title, content) in enumerate(chapters)
+            for text in self.splitter.split_text(content) or [content]
+        ]
+        summaries = self.chunk_chain.batch([inputs for _, inputs in chunks], config=self._config())
+        parts: List[List[str]] = [[] for _ in chapters]
+        for (index, _), summary in zip(chunks, summaries):
+            parts[index].append(summary)
+        # Chapters of one chunk are done; the others are combined, all at once too
+        scopes = [f"chapter {number}, \"{title}\", of a {self.genre} story" for number, title, _ in chapters]
+        return self._reduce_all(parts, scopes)
+
+    def _reduce_all(self, groups: List[List[str]], scopes: List[str]) -> List[str]:
+        """One summary of each group, combining the groups of several in parallel."""
+        pending = [index for index, group in enumerate(groups) if len(group) > 1]
+        combined = self.reduce_chain.batch([
+            {"scope": scopes[index], "summaries": "\n\n".join(groups[index])} for index in pending
+        ], config=self._config()) if pending else []
+        result = [group[0] if group else "" for group in groups]
+        for index, summary in zip(pending, combined):
+            result[index] = summary
+        return result
+
+    def reduce(self, summaries: List[str], scope: str = "") -> str:
+        """``summaries`` of consecutive parts combined into one, level by level."""
+        scope = scope or f"a {self.genre} story"
+        summaries = [summary for summary in summaries if summary]
+        fanout = max(2, self.options['REDUCE_FANOUT'])
+        while len(summaries) > 1 and sum(map(count_tokens, summaries)) > self.options['REDUCE_TOKENS']:
+            print(f"Combining {len(summaries)} summaries...\n---")
+            groups = [summaries[start:start + fanout] for start in range(0, len(summaries), fanout)]
+            summaries = self._reduce_all(groups, [scope] * len(groups))
+        if len(summaries) > 1:
+            summaries = self._reduce_all([summaries], [scope])
+        return summaries[0] if summaries else ""
+
+    def summarize_story(self, chapters: Sequence[Tuple[str, str]]) -> str:
         print("Generating the Story Summary...\n---")
-        result = self.summarization_chain.invoke(
-            {
-                "story": self.story,
-                "format_instructions": self.parser.get_format_instructions(),
-            }
-        )
+        summaries = self.summarize_chapters([
+            (number, title, content) for number, (title, content) in enumerate(chapters, start=1)
+        ])
+        result = self.reduce(summaries)
         print("Finished generating the summary!\n---")
         return result
@@ -1,3 +1,923 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import ModuleType, SimpleNamespace
+from io import BytesIO
+from unittest import mock, skipUnless
+
+from django.core.files.base import ContentFile
+from django.db import connection, connections
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import httpx
+import openai
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai.chat_models import ChatOpenAI
+from PIL import Image
+
+from .characters_generation import Characters
+from .continuity_index import ContinuityIndex, character_source
+from .fakes import FakeChatModel, FakeLlama, FakeRateLimitedAPI
+from .image_derivatives import _create_derivatives_for
+from .llm import clear_registry, get_chat_model
+from .local_llm import DEFAULT_LOCAL_LLM, LocalInferenceServer
+from .llm_scheduler import BULK, INTERACTIVE, LLMScheduler, ScheduledTransport, TokenBucket, reset_scheduler
+from .jobs import claim_next_job, run_job
+from .models import Chapter, Character, CoalescedCall, GenerationJob, Story, User
+from .generation_session import load_state, store_step
+from .persistence import save_chapter, save_chapters, save_characters
+from .prompt_compiler import MIN_SECTION_TOKENS, TRUNCATED, PromptCompiler
+from .serializers import StorySerializer
+from . import search, single_flight as flights, story_memory, story_summary
+from .story_generation import PARALLEL, LongStoryGenerator, StoryGenerator, build_story_context, build_story_memory
+from .story_memory import StoryMemory
+from .story_outline_generation import (
+    ActsOutline, ChapterPlan, StoriesOutline, StoryOutlineGenerator, fit_chapter_counts,
+)
+from .story_summary import deferred_summary_update, summarize_story
+from .structured_output import JsonItemStream, StructuredChain, parse_structured, strict_json_schema
+from . import tokens
+from .tokens import count_tokens
+
+# A small GGUF model (any llama.cpp architecture) for the local backend tests
+LOCAL_TEST_MODEL = os.environ.get('LOCAL_LLM_TEST_MODEL')
+
+
+def generated_characters(count, biography="A biography"):
+    return [
+        SimpleNamespace(name=f"Character {i}", appearance="An appearance", biography=biography)
+        for i in range(count)
+    ]
+
+
+def generated_chapters(count, content="Once upon a time"):
+    return [(f"Chapter {i}", content) for i in range(1, count + 1)]
+
+
+class PersistenceTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=user)
+
+    def count_queries(self, save, rows):
+        with CaptureQueriesContext(connection) as queries:
+            save(self.story, rows)
+        return len(queries)
+
+    def test_characters_use_constant_queries(self):
+        one = self.count_queries(save_characters, generated_characters(1))
+        Character.objects.all().delete()
+        many = self.count_queries(save_characters, generated_characters(25))
+        self.assertEqual(one, many)
+        self.assertEqual(self.story.characters.count(), 25)
+
+    def test_chapters_use_constant_queries(self):
+        one = self.count_queries(save_chapters, generated_chapters(1))
+        Chapter.objects.all().delete()
+        many = self.count_queries(save_chapters, generated_chapters(25))
+        self.assertEqual(one, many)
+        self.assertEqual(self.story.chapters.count(), 25)
+
+    def test_retried_characters_are_updated(self):
+        save_characters(self.story, generated_characters(3))
+        first = self.count_queries(save_characters, generated_characters(3, biography="Rewritten"))
+        self.assertEqual(self.story.characters.count(), 3)
+        self.assertEqual(set(self.story.characters.values_list('biography', flat=True)), {"Rewritten"})
+        self.assertEqual(first, self.count_queries(save_characters, generated_characters(3)))
+
+    def test_retried_chapters_are_updated(self):
+        save_chapters(self.story, generated_chapters(3))
+        save_chapters(self.story, generated_chapters(3, content="Rewritten"))
+        self.assertEqual(
+            list(self.story.chapters.values_list('position', 'content')),
+            [(1, "Rewritten"), (2, "Rewritten"), (3, "Rewritten")],
+        )
+
+    def test_shorter_regeneration_drops_extra_chapters(self):
+        save_chapters(self.story, generated_chapters(5))
+        save_chapters(self.story, generated_chapters(2, content="Rewritten"))
+        self.assertEqual(
+            list(self.story.chapters.values_list('position', 'content')),
+            [(1, "Rewritten"), (2, "Rewritten")],
+        )
+
+
+class GenerationJobTests(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=user)
+
+    def job(self, step=GenerationJob.STEP_OUTLINE, **fields):
+        return GenerationJob.objects.create(story=self.story, step=step, **fields)
+
+    def test_claims_the_oldest_pending_job(self):
+        first, second = self.job(), self.job()
+        claimed = claim_next_job()
+        self.assertEqual(claimed.pk, first.pk)
+        first.refresh_from_db()
+        self.assertEqual(first.status, GenerationJob.STATUS_RUNNING)
+        self.assertEqual(first.attempts, 1)
+        self.assertEqual(first.heartbeat_at, first.started_at)
+        self.assertEqual(claim_next_job().pk, second.pk)
+        self.assertIsNone(claim_next_job())
+
+    def test_requeues_jobs_whose_heartbeat_stopped(self):
+        # Both started long ago, only the heartbeat tells a dead worker apart
+        started_at = timezone.now() - timedelta(hours=1)
+        stale = self.job(status=GenerationJob.STATUS_RUNNING, attempts=1, started_at=started_at,
+                         heartbeat_at=timezone.now() - timedelta(minutes=10))
+        alive = self.job(status=GenerationJob.STATUS_RUNNING, attempts=1, started_at=started_at,
+                         heartbeat_at=timezone.now())
+        claimed = claim_next_job(stale_after=timedelta(minutes=5))
+        self.assertEqual(claimed.pk, stale.pk)
+        self.assertEqual(claimed.attempts, 2)
+        alive.refresh_from_db()
+        self.assertEqual((alive.status, alive.attempts), (GenerationJob.STATUS_RUNNING, 1))
+
+    @override_settings(GENERATION_JOBS={'MAX_ATTEMPTS': 2})
+    def test_fails_jobs_that_ran_out_of_attempts(self):
+        job = self.job(status=GenerationJob.STATUS_RUNNING, attempts=2,
+                       heartbeat_at=timezone.now() - timedelta(minutes=10))
+        self.assertIsNone(claim_next_job(stale_after=timedelta(minutes=5)))
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.STATUS_FAILED)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_two_workers_do_not_claim_the_same_job(self):
+        job = self.job()
+        ready = threading.Barrier(2)
+        claimed = []
+
+        def worker():
+            try:
+                ready.wait()
+                claimed.append(claim_next_job())
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([j.pk for j in claimed if j is not None], [job.pk])
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 1)
+
+    @override_settings(GENERATION_JOBS={'HEARTBEAT_INTERVAL': 0.05})
+    def test_running_job_refreshes_its_heartbeat(self):
+        self.job()
+        job = claim_next_job()
+        with mock.patch('core.jobs.execute_step', lambda job: time.sleep(0.3) or {'step': 3}):
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.STATUS_SUCCEEDED)
+        self.assertGreater(job.heartbeat_at, job.started_at)
+
+    def test_requeued_job_keeps_the_result_of_its_new_claim(self):
+        self.job()
+        job = claim_next_job()
+        # The heartbeat stopped and another worker claimed it again
+        GenerationJob.objects.filter(pk=job.pk).update(attempts=job.attempts + 1)
+        with self.assertLogs('core.jobs', level='WARNING'), \
+                mock.patch('core.jobs.execute_step', lambda job: {'step': 3}):
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (GenerationJob.STATUS_RUNNING, 2))
+        self.assertIsNone(job.result)
+
+    def test_failed_job_keeps_the_traceback_out_of_its_error(self):
+        self.job(step='epilogue')
+        job = claim_next_job()
+        with self.assertLogs('core.jobs', level='ERROR') as logs:
+            run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.STATUS_FAILED)
+        self.assertEqual(job.error, "Generation failed (ValueError)")
+        self.assertIn("Traceback", logs.output[0])
+
+
+class OwnershipTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=owner)
+        store_step(self.story, topic="A secret topic", interview_data=["Q: Who?\nA: Nobody"])
+        intruder = User.objects.create(email="reader@example.com", password="x")
+        self.intruder = intruder
+        self.client.defaults['HTTP_AUTHORIZATION'] = intruder.generate_token(name="test")
+
+    def test_generation_steps_are_only_for_the_author(self):
+        response = self.client.post('/chat/', {'storyId': self.story.pk, 'step': 3}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn(b"secret", response.content)
+
+    async def test_async_steps_and_images_are_only_for_the_author(self):
+        token = self.client.defaults['HTTP_AUTHORIZATION']
+        character = await Character.objects.acreate(
+            story=self.story, name="Mira", appearance="Tall", biography="A sailor")
+        response = await self.async_client.post(
+            '/async/chat/', {'storyId': self.story.pk, 'step': 3}, content_type='application/json',
+            headers={'Authorization': token})
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.post(
+            f'/async/characters/{character.pk}/generate-image/', {}, content_type='application/json',
+            headers={'Authorization': token})
+        self.assertEqual(response.status_code, 404)
+
+    def test_sessions_are_only_loaded_for_the_author(self):
+        self.assertEqual(load_state(self.story, author=self.intruder).topic, "")
+        self.assertEqual(load_state(self.story, author=self.story.author).topic, "A secret topic")
+
+
+class MetricsTests(SimpleTestCase):
+    def scrape(self, **headers):
+        return Client(headers=headers).get('/metrics/')
+
+    @override_settings(METRICS_TOKEN="scraper-secret")
+    def test_needs_the_metrics_token(self):
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape(Authorization="Bearer wrong").status_code, 401)
+        response = self.scrape(Authorization="Bearer scraper-secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_is_off_without_a_token(self):
+        self.assertEqual(self.scrape(Authorization="Bearer ").status_code, 404)
+
+
+class ImageRenditionTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrider = override_settings(MEDIA_ROOT=media.name)
+        overrider.enable()
+        self.addCleanup(overrider.disable)
+        user = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=user)
+        buffer = BytesIO()
+        Image.new('RGB', (600, 400)).save(buffer, 'PNG')
+        self.story.image.save('cover.png', ContentFile(buffer.getvalue()))
+
+    def test_renditions_are_recorded_on_the_story(self):
+        self.assertTrue(StorySerializer(self.story).data['image_thumbnail'].endswith('.png'))
+        before = Story.objects.get(pk=self.story.pk).last_update
+        _create_derivatives_for(Story, self.story.pk)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEqual(story.image_renditions, story.image.name)
+        self.assertGreater(story.last_update, before)
+        # The URLs come from the row alone
+        with mock.patch.object(story.image.storage, 'exists', side_effect=AssertionError):
+            data = StorySerializer(story).data
+        self.assertTrue(data['image_thumbnail'].endswith('.thumbnail.webp'))
+        self.assertTrue(data['image_medium'].endswith('.medium.webp'))
+
+
+class LocalServerTests(SimpleTestCase):
+    """LocalInferenceServer with llama.cpp stubbed out, no model needed."""
+
+    def setUp(self):
+        llama_cpp = ModuleType('llama_cpp')
+        llama_cpp.Llama = FakeLlama
+        llama_cpp.LlamaRAMCache = lambda capacity_bytes: None
+        patcher = mock.patch.dict(sys.modules, {'llama_cpp': llama_cpp})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        model_file = tempfile.NamedTemporaryFile(suffix='.gguf')
+        self.addCleanup(model_file.close)
+        self.server = LocalInferenceServer(model_file.name, DEFAULT_LOCAL_LLM)
+        self.llama = self.server.llama
+
+    def submit(self, story, chapter):
+        return self.server.submit([{'role': 'system', 'content': story}, {'role': 'user', 'content': chapter}])
+
+    def test_waiting_requests_are_served_by_shared_prompt(self):
+        self.llama.gate.clear()
+        first = self.submit("Story A", "A1")
+        self.llama.started.wait(5)
+        waiting = [self.submit("Story B", "B1"), self.submit("Story A", "A2"), self.submit("Story B", "B2")]
+        self.llama.gate.set()
+        for request in [first, *waiting]:
+            self.assertEqual("".join(e for e in request.results() if isinstance(e, str)), "word " * 3)
+        self.assertEqual(self.llama.prompts, ["A1", "A2", "B1", "B2"])
+
+    def test_cancelled_requests_stop(self):
+        self.llama.gate.clear()
+        first = self.submit("Story A", "A1")
+        self.llama.started.wait(5)
+        # What the caller's results() does when it stops reading
+        dropped = self.submit("Story B", "B1")
+        dropped.cancelled = True
+        self.llama.gate.set()
+        list(first.results())
+        # A stream closed after its first word ends the answer there
+        self.llama.words = 10 ** 6
+        results = self.submit("Story A", "A2").results()
+        next(results)
+        results.close()
+        self.llama.words = 3
+        list(self.submit("Story C", "C1").results())
+        self.assertEqual(self.llama.prompts, ["A1", "A2", "C1"])
+        self.assertLess(self.llama.words_read, 10 ** 6)
+
+    @override_settings(LLM_PROVIDER={'BACKEND': 'llama_cpp', 'MODELS': ['gpt-3.5-turbo-16k']})
+    @mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test'})
+    def test_other_models_stay_on_openai(self):
+        clear_registry()
+        self.addCleanup(clear_registry)
+        self.assertIsInstance(get_chat_model(model="gpt-4o", temperature=0), ChatOpenAI)
+
+
+@skipUnless(LOCAL_TEST_MODEL and importlib.util.find_spec('llama_cpp'),
+            "needs llama-cpp-python and LOCAL_LLM_TEST_MODEL, the path of a small GGUF model")
+@override_settings(
+    LLM_PROVIDER={'BACKEND': 'llama_cpp', 'MODELS': None},
+    LOCAL_LLM={'MODEL_PATH': LOCAL_TEST_MODEL, 'N_CTX': 512, 'MAX_TOKENS': 16},
+    LLM_CACHE={'ENABLED': False},
+)
+class LocalModelTests(SimpleTestCase):
+    messages = [SystemMessage(content="Act as a Story writer."), HumanMessage(content="Once upon a time")]
+
+    def setUp(self):
+        clear_registry()
+
+    def test_chat_models_use_the_local_backend(self):
+        from .local_llm import ChatLocalLlama, get_server
+
+        model = get_chat_model(model="gpt-3.5-turbo-16k", temperature=0)
+        self.assertIsInstance(model, ChatLocalLlama)
+        message = model.invoke(self.messages)
+        self.assertTrue(message.content)
+        self.assertGreater(message.usage_metadata['output_tokens'], 0)
+        # Every model name is served by the one model loaded in the process
+        get_chat_model(model="gpt-4o", temperature=0).invoke(self.messages)
+        self.assertIs(get_server(), get_server())
+
+    def test_stream_matches_invoke(self):
+        model = get_chat_model(model="gpt-3.5-turbo-16k", temperature=0)
+        streamed = "".join(chunk.content for chunk in model.stream(self.messages))
+        self.assertEqual(streamed, model.invoke(self.messages).content)
+
+    def test_concurrent_requests_are_all_served(self):
+        model = get_chat_model(model="gpt-3.5-turbo-16k", temperature=0)
+        prompts = [[*self.messages[:1], HumanMessage(content=f"Chapter {i}")] for i in range(6)]
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            concurrent = list(executor.map(lambda m: model.invoke(m).content, prompts))
+        self.assertEqual(concurrent, [model.invoke(m).content for m in prompts])
+
+
+@override_settings(LLM_SCHEDULER={'MAX_CONCURRENCY': 2, 'MAX_RETRIES': 3, 'BASE_DELAY': 0.01, 'MAX_DELAY': 0.05})
+class SchedulerTests(SimpleTestCase):
+    def setUp(self):
+        reset_scheduler()
+
+    def chat_model(self, api):
+        client = httpx.Client(transport=ScheduledTransport(api.transport()))
+        return ChatOpenAI(model="gpt-4o", api_key="test", http_client=client, max_retries=0)
+
+    def test_rate_limited_calls_are_retried(self):
+        api = FakeRateLimitedAPI(failures=2)
+        self.assertEqual(self.chat_model(api).invoke("Hello").content, "A fake answer")
+        self.assertEqual(api.calls, 3)
+
+    def test_calls_fail_after_max_retries(self):
+        api = FakeRateLimitedAPI(failures=10)
+        with self.assertRaises(openai.RateLimitError):
+            self.chat_model(api).invoke("Hello")
+        self.assertEqual(api.calls, 4)
+
+    def test_image_calls_are_retried(self):
+        api = FakeRateLimitedAPI(failures=1)
+        client = openai.OpenAI(api_key="test", max_retries=0,
+                               http_client=httpx.Client(transport=ScheduledTransport(api.transport())))
+        response = client.images.generate(prompt="A castle", model="dall-e-3", response_format="b64_json")
+        self.assertTrue(response.data[0].b64_json)
+        self.assertEqual(api.calls, 2)
+
+    def test_concurrency_is_bounded(self):
+        api = FakeRateLimitedAPI(latency=0.05)
+        model = self.chat_model(api)
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(model.invoke, ["Hello"] * 6))
+        self.assertEqual(api.calls, 6)
+        self.assertEqual(api.max_in_flight, 2)
+
+    def test_interactive_calls_go_first(self):
+        scheduler = LLMScheduler(max_concurrency=1, limits={})
+        held = scheduler.acquire("gpt-4o")
+        granted = []
+
+        def call(priority, name):
+            slot = scheduler.acquire("gpt-4o", priority=priority)
+            granted.append(name)
+            slot.release()
+
+        threads = [threading.Thread(target=call, args=(BULK, "job"))]
+        threads.append(threading.Thread(target=call, args=(INTERACTIVE, "user")))
+        for thread in threads:
+            thread.start()
+            # Queued in this order
+            time.sleep(0.05)
+        held.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(granted, ["user", "job"])
+
+    def test_token_bucket_refills_over_a_minute(self):
+        bucket = TokenBucket(per_minute=600)
+        now = time.monotonic()
+        self.assertEqual(bucket.wait_time(600, now), 0)
+        bucket.take(600)
+        self.assertAlmostEqual(bucket.wait_time(10, now), 1.0, places=2)
+        self.assertEqual(bucket.wait_time(10, now + 1.0), 0)
+
+
+CHARACTERS_JSON = (
+    '{"characters": [{"name": "Mira", "appearance": "A red {coat}", "biography": "A pilot"}, '
+    '{"name": "Oren", "appearance": "Short", "biography": "Her brother"}]}'
+)
+
+
+@override_settings(SINGLE_FLIGHT={'POLL_INTERVAL': 0.01})
+class SingleFlightTests(TransactionTestCase):
+    def setUp(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    def compute(self):
+        self.calls += 1
+        self.release.wait(5)
+        return {'step': 1, 'questions': [self.calls]}
+
+    def in_thread(self, results):
+        def call():
+            try:
+                results.append(flights.single_flight(1, 'interview', ["a topic"], self.compute))
+            finally:
+                connections.close_all()
+        thread = threading.Thread(target=call)
+        thread.start()
+        return thread
+
+    def test_identical_calls_run_once(self):
+        results = []
+        threads = [self.in_thread(results) for _ in range(5)]
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'step': 1, 'questions': [1]}] * 5)
+        # A call after that one finished runs again
+        flights.single_flight(1, 'interview', ["a topic"], self.compute)
+        self.assertEqual(self.calls, 2)
+
+    def test_failed_call_is_removed(self):
+        def fail():
+            raise ValueError("The model is down")
+
+        with self.assertRaises(ValueError):
+            flights.single_flight(1, 'interview', ["a topic"], fail)
+        self.assertFalse(CoalescedCall.objects.exists())
+        self.release.set()
+        flights.single_flight(1, 'interview', ["a topic"], self.compute)
+        self.assertEqual(self.calls, 1)
+
+    def test_call_running_in_another_process_is_waited_for(self):
+        results = []
+        first = self.in_thread(results)
+        time.sleep(0.2)
+        # What another process sees: no future, only the CoalescedCall row
+        with flights._lock:
+            flights._in_flight.clear()
+        second = self.in_thread(results)
+        time.sleep(0.2)
+        self.assertEqual(self.calls, 1)
+        self.release.set()
+        first.join()
+        second.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'step': 1, 'questions': [1]}] * 2)
+
+
+class StructuredOutputTests(SimpleTestCase):
+    def test_replies_are_repaired(self):
+        # Fenced, with a trailing comma, cut off before the closing brackets
+        reply = "Here they are:\n```json\n" + CHARACTERS_JSON[:-3] + ",\n"
+        characters = parse_structured(reply, Characters).characters
+        self.assertEqual([c.name for c in characters], ["Mira", "Oren"])
+
+    def test_list_items_are_read_as_they_complete(self):
+        stream = JsonItemStream("characters")
+        cut = CHARACTERS_JSON.index('{"name": "Oren"')
+        self.assertEqual([item['name'] for item in stream.feed(CHARACTERS_JSON[:cut])], ["Mira"])
+        self.assertEqual([item['name'] for item in stream.feed(CHARACTERS_JSON[cut:])], ["Oren"])
+
+    def test_unusable_replies_are_asked_for_again(self):
+        model = FakeChatModel(responses=["I would rather not.", CHARACTERS_JSON])
+        prompt = ChatPromptTemplate.from_messages([("system", "Characters, please. {format_instructions}")])
+        with mock.patch('core.structured_output.get_chat_model', lambda **kwargs: model):
+            chain = StructuredChain(prompt, Characters, model="gpt-4o")
+        with self.assertLogs('core.structured_output', level='WARNING') as logs:
+            self.assertEqual(len(chain.invoke({}).characters), 2)
+        self.assertEqual(model.i, 2)
+        self.assertIn('"schema": "Characters"', logs.output[0])
+
+    def test_schemas_are_strict(self):
+        schema = strict_json_schema(Characters)
+        for definition in [schema, *schema['$defs'].values()]:
+            self.assertIs(definition['additionalProperties'], False)
+            self.assertEqual(definition['required'], list(definition['properties']))
+            self.assertNotIn('title', definition)
+
+
+@override_settings(SUMMARIZATION={'MAX_CONCURRENCY': 1})
+class SummaryTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=user)
+        save_chapters(self.story, generated_chapters(3))
+        self.model = FakeChatModel(responses=["What happened"])
+        patcher = mock.patch('core.summary_chain.get_chat_model', lambda **kwargs: self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        clear_registry()
+        self.addCleanup(clear_registry)
+
+    def test_only_changed_chapters_are_summarized_again(self):
+        self.assertEqual(summarize_story(self.story), "What happened")
+        # One call a chapter, then one to combine them
+        self.assertEqual(self.model.i, 4)
+        Chapter.objects.filter(story=self.story, position=2).update(content="Something else")
+        summarize_story(self.story)
+        self.assertEqual(self.model.i, 6)
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.summary, "What happened")
+
+
+class SearchTests(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(SEARCH_INDEX={'PATH': os.path.join(directory.name, 'search.sqlite3')})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(search.close_connections)
+        self.user = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=self.user)
+
+    def find(self, query, user=None):
+        client = Client(headers={'Authorization': (user or self.user).generate_token(name="test")})
+        response = client.get('/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [(result['kind'], result['id']) for result in response.json()['results']]
+
+    def test_finds_only_the_users_own_documents(self):
+        chapter = Chapter.objects.create(story=self.story, position=1, title="One", content="A dragon sleeps.")
+        other = User.objects.create(email="other@example.com", password="x")
+        theirs = Story.objects.create(title="Theirs", genre="Fantasy", author=other)
+        Chapter.objects.create(story=theirs, position=1, title="One", content="A dragon wakes.")
+        self.assertEqual(self.find("dragon"), [('chapter', chapter.pk)])
+
+    def test_index_follows_saves_and_deletes(self):
+        chapter = Chapter.objects.create(story=self.story, position=1, title="One", content="A dragon sleeps.")
+        self.assertEqual(self.find("dragon"), [('chapter', chapter.pk)])
+        chapter.content = "A griffin sleeps."
+        chapter.save()
+        self.assertEqual(self.find("dragon"), [])
+        self.assertEqual(self.find("griffin"), [('chapter', chapter.pk)])
+        chapter.delete()
+        self.assertEqual(self.find("griffin"), [])
+
+    def test_title_matches_rank_first(self):
+        in_text = Chapter.objects.create(story=self.story, position=1, title="One",
+                                         content="The knight met a dragon. " + "He rode on. " * 20)
+        in_title = Chapter.objects.create(story=self.story, position=2, title="The dragon",
+                                          content="He rode on. " * 20)
+        unrelated = Chapter.objects.create(story=self.story, position=3, title="Three", content="A quiet day.")
+        results = self.find("dragon")
+        self.assertEqual(results, [('chapter', in_title.pk), ('chapter', in_text.pk)])
+        self.assertNotIn(('chapter', unrelated.pk), results)
+
+    def test_matches_are_marked_and_the_text_escaped(self):
+        Chapter.objects.create(story=self.story, position=1, title="Dragons & <knights>",
+                               content="<b>A dragon</b> & a knight.")
+        result, = search.search(self.user.id, "dragon")
+        self.assertEqual(result['title'], "<mark>Dragons</mark> &amp; &lt;knights&gt;")
+        self.assertEqual(result['snippet'], "&lt;b&gt;A <mark>dragon</mark>&lt;/b&gt; &amp; a knight.")
+
+
+class FulltextSearchTests(SimpleTestCase):
+    # The MySQL side; its queries need a MySQL server, the rest does not
+    def test_boolean_expression_requires_every_word(self):
+        self.assertEqual(search.boolean_expression(["red", "dra"]), "+red +dra*")
+        self.assertEqual(search.boolean_expression(["red", "dr"]), "+red +dr")
+
+    def test_snippet_marks_the_words_around_the_first_match(self):
+        text = "Nothing here. " * 20 + "Then a <dragon> came. " + "Nothing here. " * 20
+        snippet = search._snippet(text, ["dragon"])
+        self.assertEqual(len(search.TERM.findall(snippet)), search.SNIPPET_TOKENS)
+        snippet = search._highlighted(snippet)
+        self.assertTrue(snippet.startswith("...") and snippet.endswith("..."))
+        self.assertIn("a &lt;<mark>dragon</mark>&gt; came", snippet)
+
+
+
+class SummaryUpdateTests(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create(email="writer@example.com", password="x")
+        self.story = Story.objects.create(title="A story", genre="Fantasy", author=user, summary="So far")
+        patcher = mock.patch('core.story_summary._executor')
+        self.executor = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(story_summary._pending.clear)
+
+    def forget_updates(self):
+        # As if the updates scheduled so far had started
+        story_summary._pending.clear()
+        self.executor.reset_mock()
+
+    def test_edited_chapter_updates_the_summary(self):
+        chapter = Chapter.objects.create(story=self.story, position=1, title="One", content="Text")
+        self.forget_updates()
+        chapter.content = "New text"
+        chapter.save()
+        self.executor.submit.assert_called_once_with(story_summary._update, self.story.pk)
+
+    def test_chapters_written_by_the_pipeline_update_it_once(self):
+        with deferred_summary_update(self.story.pk):
+            for position in range(1, 6):
+                save_chapter(self.story, position, f"Chapter {position}", "Text")
+                # As if the update of the chapter before had started
+                story_summary._pending.clear()
+            self.executor.submit.assert_not_called()
+        self.executor.submit.assert_called_once_with(story_summary._update, self.story.pk)
+
+    def test_regenerated_chapters_update_it_once(self):
+        save_chapters(self.story, generated_chapters(5))
+        self.forget_updates()
+        save_chapters(self.story, generated_chapters(2, content="Rewritten"))
+        self.executor.submit.assert_called_once_with(story_summary._update, self.story.pk)
+
+class ContinuityIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = ContinuityIndex()
+        self.index.add_chapter(1, "Mira hid the silver dragon egg in the cave under the waterfall.")
+        self.index.add_chapter(2, "The market sold bread, apples and cheap wine to the sailors.")
+        self.index.add_chapter(3, "Rain fell on the harbour for three days and nobody left the inn.")
+
+    def test_recalls_the_relevant_passage_first(self):
+        found = self.index.search("Where is the dragon egg hidden?")
+        self.assertEqual(found[0].source, "Chapter 1")
+        self.assertIn("(Chapter 1) Mira hid", self.index.recall("Where is the dragon egg hidden?"))
+
+    def test_skipped_sources_are_left_out(self):
+        found = self.index.search("Where is the dragon egg hidden?", skip={"Chapter 1"})
+        self.assertNotIn("Chapter 1", [passage.source for passage in found])
+
+    def test_recall_stays_within_top_k_and_max_tokens(self):
+        for number in range(4, 10):
+            self.index.add_chapter(number, f"The dragon flew over the valley for the {number}th time.")
+        self.index.top_k = 3
+        self.assertEqual(len(self.index.search("the dragon")), 3)
+        self.index.top_k, self.index.max_tokens = 10, 30
+        found = self.index.search("the dragon")
+        self.assertTrue(found)
+        self.assertLessEqual(sum(count_tokens(passage.text) for passage in found), 30)
+
+    def test_story_generator_indexes_the_characters(self):
+        characters = Characters.model_validate({'characters': [
+            {'name': "Mira", 'appearance': "A tall girl", 'biography': "She keeps the dragon egg."}]})
+        outline = StoriesOutline.model_validate({'chapters': [{'chapter_number': 1, 'chapter_title': "One"}]})
+        with mock.patch('core.story_generation.get_chat_model', lambda **kwargs: FakeChatModel(responses=[""])):
+            generator = StoryGenerator("Fantasy", "A dragon egg", outline, [], characters)
+        self.assertIn(character_source("Mira"), [p.source for p in generator.continuity.passages])
+
+
+def written_chapter(number, sentences=6):
+    return f"## Chapter {number}\n\n" + " ".join(
+        f"In chapter {number} the hero does thing number {i} on the long road." for i in range(sentences))
+
+
+class StoryMemoryTests(SimpleTestCase):
+    def test_synopsis_stays_within_its_budget(self):
+        memory = StoryMemory()
+        for number in range(1, 21):
+            memory.save_context({'human_input': "Write"}, {'story': written_chapter(number)})
+            for budget in range(20, 200, 3):
+                memory.synopsis_max_tokens = budget
+                self.assertLessEqual(count_tokens(memory.synopsis()), budget)
+
+    def test_tail_keeps_the_end_of_the_last_chapter(self):
+        memory = StoryMemory(tail_max_tokens=20)
+        chapter = written_chapter(1, sentences=30)
+        memory.save_context({'human_input': "Write"}, {'story': chapter})
+        self.assertLessEqual(count_tokens(memory.tail), 20)
+        self.assertTrue(memory.tail and chapter.endswith(memory.tail))
+
+    def test_older_digests_are_shortened_then_dropped(self):
+        memory = StoryMemory()
+        for number in range(1, 6):
+            memory.save_context({'human_input': "Write"}, {'story': written_chapter(number)})
+        # Room for the newest chapter's full digest and the one before's short one
+        (_, _, _, short), (_, full, _, _) = memory.digests[-2:]
+        memory.synopsis_max_tokens = count_tokens(story_memory.OMITTED) + full + short + 3
+        synopsis = memory.synopsis()
+        lines = synopsis.splitlines()
+        # The newest chapter in full, from its first to its last sentence
+        self.assertIn("Chapter 5: In chapter 5 the hero does thing number 0", lines[-1])
+        self.assertIn("... In chapter 5 the hero does thing number 5", lines[-1])
+        # Older ones by their first sentence, and the oldest not at all
+        self.assertIn("Chapter 4: In chapter 4 the hero does thing number 0 on the long road.", lines)
+        self.assertNotIn("Chapter 1", synopsis)
+        self.assertEqual(lines[0], story_memory.OMITTED)
+
+    def test_no_summarizer_makes_no_model_calls(self):
+        with mock.patch('core.story_generation.get_chat_model') as get_model:
+            memory = build_story_memory()
+            memory.save_context({'human_input': "Write"}, {'story': written_chapter(1)})
+        get_model.assert_not_called()
+        self.assertIsNone(memory.summarizer)
+        self.assertIn("Chapter 1", memory.synopsis())
+
+
+class TokenCountTests(SimpleTestCase):
+    def test_counts_are_cached_by_digest(self):
+        text = written_chapter(1, sentences=50)
+        count = count_tokens(text)
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        self.assertEqual(tokens._counts[key], count)
+        self.assertNotIn(text, tokens._counts)
+        self.assertEqual(count_tokens(text), count)
+        # And the same as counting it afresh
+        del tokens._counts[key]
+        self.assertEqual(count_tokens(text), count)
+
+
+class PromptCompilerTests(SimpleTestCase):
+    def compiler(self, max_tokens=None):
+        # The sections of a story's context, as build_story_context adds them
+        return (
+            PromptCompiler(max_tokens=max_tokens)
+            .add("Outline", "\n".join(f"{i}. The hero reaches place number {i}" for i in range(1, 16)), priority=2)
+            .add("Characters", "\n".join(f"- Hero {i}: brave, tall and kind" for i in range(1, 16)), priority=1)
+            .add("Interview insights", "\n".join(f"Q: Question {i}? A: Answer {i}." for i in range(1, 16)))
+        )
+
+    def fitted(self, max_tokens):
+        compiler = self.compiler(max_tokens)
+        compiled = compiler.compile()
+        self.assertEqual(compiler.tokens, count_tokens(compiled))
+        self.assertLessEqual(compiler.tokens, max_tokens)
+        return {section.title: section.text for section in compiler._fit()}
+
+    def test_everything_is_kept_within_the_budget(self):
+        compiler = self.compiler()
+        total = sum(section.tokens for section in compiler.sections)
+        self.assertEqual(self.fitted(total), {s.title: s.text for s in compiler.sections})
+
+    def test_interview_is_cut_first(self):
+        full = {section.title: section for section in self.compiler().sections}
+        total = sum(section.tokens for section in full.values())
+        sections = self.fitted(total - 20)
+        self.assertTrue(sections["Interview insights"].endswith(TRUNCATED))
+        self.assertEqual(sections["Characters"], full["Characters"].text)
+        self.assertEqual(sections["Outline"], full["Outline"].text)
+
+    def test_then_the_characters_then_the_outline(self):
+        full = {section.title: section for section in self.compiler().sections}
+        sections = self.fitted(full["Outline"].tokens + full["Characters"].tokens - 20)
+        self.assertNotIn("Interview insights", sections)
+        self.assertTrue(sections["Characters"].endswith(TRUNCATED))
+        self.assertEqual(sections["Outline"], full["Outline"].text)
+
+        sections = self.fitted(full["Outline"].tokens - 20)
+        self.assertEqual(list(sections), ["Outline"])
+        self.assertTrue(sections["Outline"].endswith(TRUNCATED))
+
+    def test_sections_too_short_to_keep_are_dropped(self):
+        full = {section.title: section for section in self.compiler().sections}
+        # Less than MIN_SECTION_TOKENS of the characters would be left
+        sections = self.fitted(full["Outline"].tokens + MIN_SECTION_TOKENS // 2)
+        self.assertEqual(sections, {"Outline": full["Outline"].text})
+
+    def test_compiled_block_is_kept_until_a_section_is_added(self):
+        compiler = self.compiler()
+        compiled = compiler.compile()
+        self.assertIs(compiler.compile(), compiled)
+        compiler.add("Setting", "A city of bridges")
+        self.assertTrue(compiler.compile().endswith("### Setting:\nA city of bridges"))
+        self.assertEqual(compiler.tokens, count_tokens(compiler.compile()))
+
+    def test_story_context_uses_the_setting(self):
+        characters = Characters.model_validate({'characters': [
+            {'name': "Mira", 'appearance': "A tall girl", 'biography': "She keeps the dragon egg. " * 30}]})
+        outline = StoriesOutline.model_validate({'chapters': [{'chapter_number': 1, 'chapter_title': "One"}]})
+        interview = [f"Q: Question {i}?\nA: Answer {i}." for i in range(30)]
+        with override_settings(STORY_PROMPT={'CONTEXT_MAX_TOKENS': 150}):
+            context = build_story_context(outline, interview, characters)
+        compiled = context.compile()
+        self.assertLessEqual(context.tokens, 150)
+        self.assertIn("### Outline:\n1. One", compiled)
+        self.assertNotIn("Interview insights", compiled)
+
+
+class ParallelGenerationTests(SimpleTestCase):
+    TITLES = ["The call", "The road", "The return"]
+
+    def generator(self):
+        outline = StoriesOutline.model_validate({'chapters': [
+            {'chapter_number': number, 'chapter_title': title}
+            for number, title in enumerate(self.TITLES, start=1)]})
+        # Each chapter's text names the chapter its prompt asked for
+        model = FakeChatModel(responses=["Unexpected prompt"], latency=0.05, routes=[
+            (f"- Chapter {number}: {title}", f"Text of {title}")
+            for number, title in enumerate(self.TITLES, start=1)])
+        with mock.patch('core.story_generation.get_chat_model', lambda **kwargs: model):
+            return StoryGenerator("Fantasy", "A journey", outline, [], None)
+
+    @override_settings(STORY_GENERATION={'PARALLEL_MAX_CONCURRENCY': 2})
+    def test_chapters_come_back_in_outline_order(self):
+        generator = self.generator()
+        self.assertEqual(generator.max_concurrency, 2)
+        expected = [f"Text of {title}" for title in self.TITLES]
+        self.assertEqual(generator.generate_stories(mode=PARALLEL), expected)
+        self.assertEqual(asyncio.run(generator.agenerate_stories(mode=PARALLEL)), expected)
+
+    def test_each_chapter_gets_its_neighbours_as_continuity_notes(self):
+        first, middle, last = [inputs['human_input'] for inputs in self.generator()._parallel_inputs()]
+        self.assertIn("This is the opening chapter", first)
+        self.assertIn("The next chapter is Chapter 2: The road", first)
+        self.assertIn("The previous chapter, Chapter 1: The call", middle)
+        self.assertIn("The next chapter is Chapter 3: The return", middle)
+        self.assertIn("The previous chapter, Chapter 2: The road", last)
+        self.assertIn("This is the final chapter", last)
+
+
+def acts_outline(*counts):
+    return ActsOutline.model_validate({'acts': [
+        {'act_number': number, 'act_title': f"Act {number}", 'summary': "Things happen.", 'chapter_count': count}
+        for number, count in enumerate(counts, start=1)]})
+
+
+class FakeActExpander:
+    """Plans each act's chapters without a model, recording what it was asked."""
+
+    def __init__(self, **kwargs):
+        self.expanded = []
+
+    def expand(self, act, first_chapter, synopsis=""):
+        self.expanded.append((act.act_number, first_chapter, synopsis))
+        return [
+            ChapterPlan(chapter_number=number, chapter_title=f"Chapter {number}",
+                        plot_points=[f"Event of chapter {number}."], characters=[])
+            for number in range(first_chapter, first_chapter + act.chapter_count)
+        ]
+
+
+class LongStoryGeneratorTests(SimpleTestCase):
+    def test_act_chapter_counts_add_up_to_the_chapters_asked_for(self):
+        for counts in [(3, 3, 3), (20, 1, 0, 5), (1, 1, 1, 1, 1, 1)]:
+            for chapters in range(1, 51):
+                fitted = fit_chapter_counts(acts_outline(*counts), chapters)
+                self.assertEqual(sum(act.chapter_count for act in fitted.acts), chapters)
+                self.assertTrue(all(act.chapter_count >= 1 for act in fitted.acts))
+                self.assertEqual([act.act_number for act in fitted.acts], list(range(1, len(fitted.acts) + 1)))
+
+    def test_outline_of_a_long_story_is_fitted(self):
+        model = FakeChatModel(responses=[acts_outline(10, 10, 10).model_dump_json()])
+        clear_registry()
+        self.addCleanup(clear_registry)
+        with mock.patch('core.structured_output.get_chat_model', lambda **kwargs: model):
+            outline = StoryOutlineGenerator("A journey", "Fantasy", [], chapters=20).generate_outline()
+        self.assertIsInstance(outline, ActsOutline)
+        self.assertEqual([act.chapter_count for act in outline.acts], [6, 7, 7])
+
+    def test_acts_are_expanded_when_reached(self):
+        model = FakeChatModel(responses=["The hero went on. Then the hero rested."])
+        with mock.patch('core.story_generation.get_chat_model', lambda **kwargs: model), \
+                mock.patch('core.story_generation.ActExpander', FakeActExpander):
+            generator = LongStoryGenerator("Fantasy", "A journey", acts_outline(2, 3, 1), [], None)
+        events = generator.stream_stories()
+        first = next(event for event in events if event['event'] == 'chapter')
+        self.assertEqual(first['chapter'], 1)
+        # Only the first act is planned before its chapters are written
+        self.assertEqual([act for act, _, _ in generator.expander.expanded], [1])
+        chapters = [first['chapter']] + [event['chapter'] for event in events if event['event'] == 'chapter']
+        self.assertEqual(chapters, [1, 2, 3, 4, 5, 6])
+        expanded = generator.expander.expanded
+        self.assertEqual([(act, first_chapter) for act, first_chapter, _ in expanded], [(1, 1), (2, 3), (3, 6)])
+        # Each later act is planned from the story written so far
+        self.assertEqual(expanded[0][2], "")
+        self.assertIn("The hero went on", expanded[1][2])
+        self.assertEqual([c.chapter_number for c in generator.outline.chapters], chapters)
 
-# Create your tests here.
@@ -1,9 +1,9 @@
 from dotenv import load_dotenv
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.output_parsers import PydanticOutputParser
 from langchain_core.prompts.chat import ChatPromptTemplate, SystemMessagePromptTemplate
 from typing import List, Any
-from pydantic.v1 import BaseModel
+from pydantic import BaseModel
+from .llm import get_chain
+from .structured_output import StructuredChain
 
 
 class TitleCandidates(BaseModel):
@@ -16,39 +16,36 @@ class TitleCandidates(BaseModel):
 load_dotenv()
 
 
-class TitleGenerator:
-    def __init__(self, summary: str):
-        self.summary = summary
+TITLE_PROMPT = """
+        Based on the following summary of the story, generate a list of 5 potential title candidates.
+        The titles should reflect the key themes and essence of the story.
 
-        # Create a prompt
-        prompt_content = """
-            Based on the following summary of the story, generate a list of 5 potential title candidates.
-            The titles should reflect the key themes and essence of the story.
+        Summary: {summary}
+        ---
+        Output format: {format_instructions}
+    """
 
-            Summary: {summary}
-            ---
-            Output format: {format_instructions}
-        """
 
-        system_message_prompt = SystemMessagePromptTemplate.from_template(
-            prompt_content
-        )
-        self.chat_prompt = ChatPromptTemplate.from_messages(
-            [system_message_prompt])
+def build_title_candidates_chain():
+    system_message_prompt = SystemMessagePromptTemplate.from_template(
+        TITLE_PROMPT
+    )
+    chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt])
+    return StructuredChain(chat_prompt, TitleCandidates, model="gpt-4o", temperature=0)
 
-        # Create an output parser
-        self.parser = PydanticOutputParser(pydantic_object=TitleCandidates)
 
-        # Set up the chain
-        self.title_chain = self.chat_prompt | ChatOpenAI(
-            temperature=0, model="gpt-4o") | self.parser
+class TitleGenerator:
+    def __init__(self, summary: str):
+        self.summary = summary
+
+        # The prompt, parser and model are shared by every request
+        self.title_chain = get_chain("title_candidates", build_title_candidates_chain)
 
     def generate_titles(self) -> Any:
         print("Generating potential titles for the story...\n---")
         result = self.title_chain.invoke(
             {
                 "summary": self.summary,
-                "format_instructions": self.parser.get_format_instructions(),
             }
         )
         print("Finished generating the title candidates!\n---")
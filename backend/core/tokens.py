@@ -0,0 +1,72 @@
+import hashlib
+import logging
+import math
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Token counting for prompt budgets. Uses the tokenizer of the OpenAI chat
+# models; where it cannot be loaded (tiktoken downloads it on first use, so
+# offline machines fail) counts fall back to about four characters a token.
+
+ENCODING = "cl100k_base"
+CHARS_PER_TOKEN = 4
+# Counts remembered, keyed by a digest of the text so that long texts
+# (whole chapters) are not kept in memory
+COUNT_CACHE_MAX_ENTRIES = 4096
+
+_lock = threading.Lock()
+_encoding: Any = None
+_loaded = False
+_counts: "OrderedDict[bytes, int]" = OrderedDict()
+
+
+def get_encoding() -> Optional[Any]:
+    global _encoding, _loaded
+    with _lock:
+        if not _loaded:
+            try:
+                _encoding = tiktoken.get_encoding(ENCODING)
+            except Exception:
+                logger.warning("Could not load the %s tokenizer, estimating token counts", ENCODING)
+                _encoding = None
+            _loaded = True
+        return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Tokens in ``text``; repeated texts (e.g. prompt sections) are counted once."""
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _lock:
+        count = _counts.get(key)
+        if count is not None:
+            _counts.move_to_end(key)
+            return count
+    encoding = get_encoding()
+    if encoding is None:
+        count = math.ceil(len(text) / CHARS_PER_TOKEN)
+    else:
+        count = len(encoding.encode(text))
+    with _lock:
+        _counts[key] = count
+        if len(_counts) > COUNT_CACHE_MAX_ENTRIES:
+            _counts.popitem(last=False)
+    return count
+
+
+def truncate_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """The first (or with ``keep_end``, the last) ``max_tokens`` tokens of ``text``."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        return text[-max_chars:] if keep_end else text[:max_chars]
+    tokens = encoding.encode(text)
+    return encoding.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
@@ -0,0 +1,190 @@
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from uuid import UUID
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from .metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+# Tracing of the model and image calls made while generating a story.
+#
+# Pipeline steps run inside ``trace_step(story_id, step)``, which makes the
+# story and step known to everything called from there (including other
+# threads started with a copied context, as LangChain's batch does). Every
+# chat model from core.llm reports to ``LLMTracingHandler`` and every image
+# call goes through ``trace_image_call``. Each call is written as a JSON log
+# line on the ``core.tracing`` logger, with the story, and added to the
+# Prometheus metrics, by step only, to keep the number of series bounded.
+
+UNKNOWN = 'unknown'
+
+_scope: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar(
+    'generation_trace_scope', default={'story_id': None, 'step': UNKNOWN})
+
+LLM_REQUESTS = counter(
+    'llm_requests_total', 'Chat model calls.', ['model', 'step', 'status'])
+LLM_TOKENS = counter(
+    'llm_tokens_total', 'Tokens used by chat model calls.', ['model', 'step', 'kind'])
+LLM_LATENCY = histogram(
+    'llm_request_duration_seconds', 'Latency of chat model calls.', ['model', 'step'])
+LLM_RETRIES = counter(
+    'llm_retries_total', 'Chat model calls retried by a LangChain retry.', ['step'])
+HTTP_RETRYABLE = counter(
+    'llm_http_retryable_responses_total',
+    'OpenAI API responses the client retries (429, 5xx, ...).', ['step', 'status'])
+IMAGE_REQUESTS = counter(
+    'image_requests_total', 'Image generation calls.', ['model', 'step', 'status'])
+IMAGE_LATENCY = histogram(
+    'image_request_duration_seconds', 'Latency of image generation calls.', ['model', 'step'])
+STEP_LATENCY = histogram(
+    'generation_step_duration_seconds', 'Latency of story generation steps.', ['step', 'status'])
+
+# Response statuses the OpenAI client retries on its own
+RETRYABLE_STATUSES = {408, 409, 429}
+
+
+def current_scope() -> Dict[str, Any]:
+    return _scope.get()
+
+
+def log_event(event: str, **fields: Any) -> None:
+    scope = current_scope()
+    logger.info(json.dumps({
+        'event': event, 'story_id': scope['story_id'], 'step': scope['step'], **fields
+    }, default=str))
+
+
+@contextmanager
+def tracing_scope(story_id: Optional[int], step: str) -> Iterator[None]:
+    """Attribute the calls made inside the block to ``story_id`` and ``step``."""
+    previous = _scope.get()
+    _scope.set({'story_id': story_id, 'step': step})
+    try:
+        yield
+    finally:
+        # Restore by value: streamed responses leave the block from a later frame
+        _scope.set(previous)
+
+
+@contextmanager
+def trace_step(story_id: Optional[int], step: str) -> Iterator[None]:
+    """``tracing_scope`` that also records how long the whole step took."""
+    started = time.perf_counter()
+    status = 'ok'
+    with tracing_scope(story_id, step):
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            STEP_LATENCY.observe(elapsed, step=step, status=status)
+            log_event('generation_step', status=status, latency_ms=round(elapsed * 1000, 1))
+
+
+def _token_usage(response: LLMResult) -> Dict[str, int]:
+    # Streaming and non-streaming calls report usage in different places
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+            if usage:
+                return {'prompt': usage.get('input_tokens', 0), 'completion': usage.get('output_tokens', 0)}
+    usage = (response.llm_output or {}).get('token_usage') or {}
+    return {'prompt': usage.get('prompt_tokens', 0), 'completion': usage.get('completion_tokens', 0)}
+
+
+class LLMTracingHandler(BaseCallbackHandler):
+    """Records model, tokens, latency and retries of every chat model call."""
+
+    # Run in the caller's thread and context so the trace scope is visible
+    run_inline = True
+
+    def __init__(self, model: str):
+        self.model = model
+        self._runs: Dict[UUID, Dict[str, Any]] = {}
+
+    def _start(self, run_id: UUID) -> None:
+        self._runs[run_id] = {'started': time.perf_counter(), 'retries': 0, 'scope': current_scope()}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_retry(self, retry_state, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.get(run_id)
+        if run is not None:
+            run['retries'] += 1
+        LLM_RETRIES.inc(step=current_scope()['step'])
+
+    def _finish(self, run_id: UUID, status: str, usage: Dict[str, int], model: str, **fields: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        elapsed = time.perf_counter() - run['started']
+        step = run['scope']['step']
+        LLM_REQUESTS.inc(model=model, step=step, status=status)
+        LLM_LATENCY.observe(elapsed, model=model, step=step)
+        for kind, tokens in usage.items():
+            if tokens:
+                LLM_TOKENS.inc(tokens, model=model, step=step, kind=kind)
+        logger.info(json.dumps({
+            'event': 'llm_call', 'story_id': run['scope']['story_id'], 'step': step,
+            'model': model, 'status': status, 'latency_ms': round(elapsed * 1000, 1),
+            'prompt_tokens': usage.get('prompt', 0), 'completion_tokens': usage.get('completion', 0),
+            'retries': run['retries'], **fields,
+        }, default=str))
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        model = (response.llm_output or {}).get('model_name') or self.model
+        cached = any(
+            (generation.generation_info or {}).get('cached')
+            for generations in response.generations for generation in generations
+        )
+        if cached:
+            # Served by the LLM cache (core.llm_cache), no tokens were spent
+            self._finish(run_id, 'cached', {}, model)
+        else:
+            self._finish(run_id, 'ok', _token_usage(response), model)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id, 'error', {}, self.model, error=type(error).__name__)
+
+
+def record_http_response(response: httpx.Response) -> None:
+    """httpx response hook counting the API responses that will be retried."""
+    if response.status_code in RETRYABLE_STATUSES or response.status_code >= 500:
+        step = current_scope()['step']
+        HTTP_RETRYABLE.inc(step=step, status=str(response.status_code))
+        log_event('llm_http_retryable', status=response.status_code, url=str(response.request.url))
+
+
+async def arecord_http_response(response: httpx.Response) -> None:
+    record_http_response(response)
+
+
+@contextmanager
+def trace_image_call(model: str) -> Iterator[None]:
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        step = current_scope()['step']
+        IMAGE_REQUESTS.inc(model=model, step=step, status=status)
+        IMAGE_LATENCY.observe(elapsed, model=model, step=step)
+        log_event('image_call', model=model, status=status, latency_ms=round(elapsed * 1000, 1))
@@ -1,6 +1,8 @@
 from django.urls import path
 from .views import RegisterView, LoginView, LogoutView, UserStoriesView, UserStoryDetailView, \
-    ChapterStoryView, ChracterView, GenerateStoryImageView, GenerateCharacterImageView, ChapterDetailView, CharacterDetailView, StoryGenerationView
+    ChapterStoryView, ChracterView, GenerateStoryImageView, GenerateCharacterImageView, ChapterDetailView, CharacterDetailView, StoryGenerationView, \
+    StoryStreamView, AsyncStoryGenerationView, AsyncGenerateStoryImageView, AsyncGenerateCharacterImageView, \
+    GenerationJobView, GenerationJobDetailView, GenerationJobResultView, LLMCacheStatsView, MetricsView, SearchView
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
@@ -22,6 +24,22 @@ urlpatterns = [
     path('characters/<int:pk>/generate-image/',
          GenerateCharacterImageView.as_view(), name='generate-character-image'),
     path('chat/', StoryGenerationView.as_view(), name='chat'),
+    path('chat/stream/', StoryStreamView.as_view(), name='chat-stream'),
+    path('jobs/', GenerationJobView.as_view(), name='generation-jobs'),
+    path('jobs/<int:pk>/', GenerationJobDetailView.as_view(),
+         name='generation-job-detail'),
+    path('jobs/<int:pk>/result/', GenerationJobResultView.as_view(),
+         name='generation-job-result'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('llm-cache/stats/', LLMCacheStatsView.as_view(), name='llm-cache-stats'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+
+    # Async variants, served without blocking a worker when run under ASGI
+    path('async/chat/', AsyncStoryGenerationView.as_view(), name='async-chat'),
+    path('async/stories/<int:pk>/generate-image/',
+         AsyncGenerateStoryImageView.as_view(), name='async-generate-image'),
+    path('async/characters/<int:pk>/generate-image/',
+         AsyncGenerateCharacterImageView.as_view(), name='async-generate-character-image'),
 
     # path('user/<int:user_id>/stories-list/',
     #      views.stories_list, name='stories-list'),
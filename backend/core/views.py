@@ -1,26 +1,45 @@
+import json
 import logging
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import User, Story, Chapter, Character
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.utils.encoders import JSONEncoder
+from .models import User, Story, Chapter, Character, GenerationJob
 from .serializers import UserSerializer, StorySerializer, ChapterSerializer, ComplexCharacterSerializer
-from django.utils.crypto import get_random_string
+from django.utils import timezone
 import hashlib
-from .authentication import TokenAuthentication
+import hmac
+from .authentication import TokenAuthentication, token_cache
 from .permission import IsAuthenticatedCustom
-from openai import OpenAI
 from dotenv import load_dotenv
 import os
-import requests
-from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from django.db.models import Count, Max
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from langchain_openai.chat_models import ChatOpenAI
 from langchain.output_parsers import PydanticOutputParser
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from .expert_interview_chain import InterviewChain
-from .characters_generation import CharacterGenerator
-from .story_generation import StoryGenerator
-from .summary_chain import StorySummarizer
-from .title_selection_chain import TitleGenerator
-from .story_outline_generation import StoryOutlineGenerator
+from .story_generation import create_story_generator, SEQUENTIAL, PARALLEL
+from .story_outline_generation import DEFAULT_CHAPTERS, MAX_CHAPTERS
+from .pipeline import interview_data_from_answers, run_interview_step, run_outline_step, run_character_step, run_chapter_step
+from .pipeline import stream_outline_step, stream_character_step, run_summary_step, run_title_step
+from .pipeline import arun_interview_step, arun_outline_step, arun_character_step, arun_chapter_step
+from .generation_session import load_state
+from .jobs import JOB_STEPS, enqueue_job
+from .persistence import save_chapter
+from .llm_cache import get_llm_cache
+from .pagination import KeysetPagination
+from .image_generation import generate_image, agenerate_image, save_image
+from .metrics import render_metrics
+from . import search
+from .tracing import trace_step
+from .single_flight import asingle_flight, single_flight
+from .story_summary import deferred_summary_update
 
 
 load_dotenv()  # Load the .env file
@@ -30,6 +49,74 @@ api_key = os.getenv('OPENAI_API_KEY')
 logger = logging.getLogger(__name__)
 
 
+def requested_fields(request):
+    """Field names from a ``?fields=id,title`` sparse fieldset, or None."""
+    fields = request.query_params.get('fields')
+    if not fields:
+        return None
+    return [name.strip() for name in fields.split(',') if name.strip()]
+
+
+def requested_chapters(request):
+    """Number of chapters asked for in step 2, or None if it is not valid."""
+    try:
+        chapters = int(request.data.get('chapters', DEFAULT_CHAPTERS))
+    except (TypeError, ValueError):
+        return None
+    return chapters if 1 <= chapters <= MAX_CHAPTERS else None
+
+
+def only_model_fields(queryset, fields, required=('id',)):
+    # Skip loading large columns (e.g. Chapter.content) nobody asked for
+    if fields is None:
+        return queryset
+    model_fields = {field.name for field in queryset.model._meta.concrete_fields}
+    fields = set(fields)
+    if fields & {'image_thumbnail', 'image_medium'}:
+        # The rendition URLs are built from these columns
+        fields |= {'image', 'image_renditions'}
+    return queryset.only(*(fields & model_fields | set(required)))
+
+
+def not_modified(request, last_modified, *validators):
+    """
+    Conditional GET support. Returns a 304 response when the client's
+    If-None-Match / If-Modified-Since still match, otherwise None, and
+    the ETag and Last-Modified headers to send with the full response.
+    """
+    tag = hashlib.sha256(
+        '|'.join(str(v) for v in (request.get_full_path(), last_modified, *validators)).encode()
+    ).hexdigest()[:32]
+    etag = quote_etag(tag)
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    headers = {'ETag': etag}
+    if timestamp is not None:
+        headers['Last-Modified'] = http_date(timestamp)
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        for header, value in headers.items():
+            response[header] = value
+    return response, headers
+
+
+def respond_with_headers(data, headers):
+    response = Response(data)
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+async def run_off_thread(step, story):
+    # Many model calls in a row: keep them off the thread the async views
+    # share for their ORM calls, and close the worker thread's connection
+    def run():
+        try:
+            return step(story)
+        finally:
+            close_old_connections()
+    return await sync_to_async(run, thread_sensitive=False)()
+
+
 class RegisterView(APIView):
     authentication_classes = []
     permission_classes = []
@@ -65,9 +152,9 @@ class LoginView(APIView):
 
         hashed_password = hashlib.sha256(raw_password.encode()).hexdigest()
         if user.password == hashed_password:
-            token = get_random_string(64)
-            user.token = token
-            user.save()
+            # One token per device; drop this user's expired ones while here
+            user.auth_tokens.filter(expires_at__lte=timezone.now()).delete()
+            token = user.generate_token(name=request.data.get('device', ''))
             return Response({'token': token})
         return Response({'error': 'Invalid credentials'}, status=400)
 
@@ -79,10 +166,14 @@ class LogoutView(APIView):
     def post(self, request):
         # Get the current user from the request
         user = request.user
-        print(user)
-        # Clear the user's token
-        user.token = None
-        user.save()
+        if request.data.get('all'):
+            # Log out every device
+            user.auth_tokens.all().delete()
+            token_cache.invalidate_user(user.id)
+        else:
+            # Revoke only the token this request used
+            request.auth.delete()
+            token_cache.invalidate(request.auth.key_hash)
 
         return Response({'message': 'Successfully logged out'})
 
@@ -95,8 +186,21 @@ class UserStoriesView(APIView):
 
     def get(self, request):
         stories = Story.objects.filter(author=request.user)
-        serializer = StorySerializer(stories, many=True)
-        return Response(serializer.data)
+        state = stories.aggregate(last_update=Max('last_update'), count=Count('id'))
+        response, headers = not_modified(request, state['last_update'], state['count'])
+        if response is not None:
+            return response
+
+        fields = requested_fields(request)
+        stories = only_model_fields(stories, fields, required=('id', 'last_update', 'author'))
+        if KeysetPagination.is_requested(request):
+            paginator = KeysetPagination(ordering=('-last_update', '-id'))
+            stories, next_url = paginator.paginate_queryset(stories, request)
+            serializer = StorySerializer(stories, many=True, fields=fields)
+            return respond_with_headers({'results': serializer.data, 'next': next_url}, headers)
+
+        serializer = StorySerializer(stories, many=True, fields=fields)
+        return respond_with_headers(serializer.data, headers)
 
     def post(self, request):
         title = request.data.get('title')
@@ -116,8 +220,11 @@ class UserStoryDetailView(APIView):
             story = Story.objects.get(author=request.user, id=pk)
         except Story.DoesNotExist:
             return Response({'error': 'Story not found'}, status=404)
-        serializer = StorySerializer(story)
-        return Response(serializer.data)
+        response, headers = not_modified(request, story.last_update)
+        if response is not None:
+            return response
+        serializer = StorySerializer(story, fields=requested_fields(request))
+        return respond_with_headers(serializer.data, headers)
 
     def delete(self, request, pk):
         try:
@@ -156,11 +263,22 @@ class ChapterStoryView(APIView):
         except Story.DoesNotExist:
             return Response({'error': 'Story not found'}, status=404)
 
-        chapters = story.chapters.all()
+        # Chapter changes bump story.last_update (see signals.py)
+        response, headers = not_modified(request, story.last_update)
+        if response is not None:
+            return response
+
+        fields = requested_fields(request)
+        chapters = only_model_fields(story.chapters.all(), fields, required=('id', 'position', 'story'))
+        if KeysetPagination.is_requested(request):
+            paginator = KeysetPagination(ordering=('position', 'id'))
+            chapters, next_url = paginator.paginate_queryset(chapters, request)
+            serializer = ChapterSerializer(chapters, many=True, fields=fields)
+            return respond_with_headers({'results': serializer.data, 'next': next_url}, headers)
+
         # Use the ChapterSerializer
-        serializer = ChapterSerializer(chapters, many=True)
-        print(serializer.data)
-        return Response(serializer.data)
+        serializer = ChapterSerializer(chapters, many=True, fields=fields)
+        return respond_with_headers(serializer.data, headers)
 
     def post(self, request, pk):
         try:
@@ -314,31 +432,21 @@ class GenerateStoryImageView(APIView):
         summary = request.data.get('summary', story.summary)
         prompt = f"""Create an image of a {genre} story titled "{name}" with the following summary: "{summary}" """
 
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-        )
-
-        image_url = response.data[0].url
-
-        # Download the image
-        image_data = requests.get(image_url).content
-        # You can adjust the name and extension
-        image_name = f"{story.title}_image.png"
+        def generate():
+            with trace_step(story.pk, 'story_image'):
+                image_file = generate_image(prompt)
+            # You can adjust the name and extension
+            image_name = f"{story.title}_image.png"
 
-        # Save the image as a file using ImageField
-        story.image.save(image_name, ContentFile(image_data), save=True)
+            # Stream the image into storage and save the story once
+            save_image(story, image_name, image_file, update_fields=['last_update'])
 
-        # Save the story object with the new image
-        story.save()
+            # Serializer
+            serializer = StorySerializer(story)
+            return serializer.data
 
-        # Serializer
-        serializer = StorySerializer(story)
-        return Response(serializer.data)
+        # A double click waits for the image already being made
+        return Response(single_flight(story.pk, 'story_image', prompt, generate))
 
 
 class GenerateCharacterImageView(APIView):
@@ -347,7 +455,7 @@ class GenerateCharacterImageView(APIView):
 
     def post(self, request, pk):
         try:
-            character = Character.objects.get(id=pk)
+            character = Character.objects.get(id=pk, story__author=request.user)
         except Character.DoesNotExist:
             return Response({'error': 'Character not found'}, status=404)
 
@@ -356,37 +464,27 @@ class GenerateCharacterImageView(APIView):
         biography = request.data.get('biography', character.biography)
         prompt = f"""Create an image of a character named "{name}" with the following appearance: "{appearance}" and biography: "{biography}" """
 
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-        )
-
-        image_url = response.data[0].url
+        def generate():
+            with trace_step(character.story_id, 'character_image'):
+                image_file = generate_image(prompt)
+            # You can adjust the name and extension
+            image_name = f"{name}_image.png"
 
-        # Download the image
-        image_data = requests.get(image_url).content
-        # You can adjust the name and extension
-        image_name = f"{name}_image.png"
+            # Update the character instance with the new image
+            character.name = name
+            character.appearance = appearance
+            character.biography = biography
 
-        # Update the character instance with the new image
-        character.name = name
-        character.appearance = appearance
-        character.biography = biography
+            # Stream the image into storage and save the character once
+            save_image(character, image_name, image_file,
+                       update_fields=['name', 'appearance', 'biography'])
 
-        # Save the image as a file using ImageField
-        character.image.save(image_name, ContentFile(image_data), save=True)
+            # Serializer
+            serializer = ComplexCharacterSerializer(character)
+            return serializer.data
 
-        # Save the character object with the new image
-        character.save()
-
-        # Serializer
-        serializer = ComplexCharacterSerializer(character)
-
-        return Response(serializer.data)
+        return Response(single_flight(
+            character.story_id, 'character_image', [character.pk, prompt], generate))
 
 
 class StoryGenerationView(APIView):
@@ -396,130 +494,440 @@ class StoryGenerationView(APIView):
     def post(self, request):
         step = int(request.data.get('step', 1))
         input_message = request.data.get('message')
-        topic = request.data.get('topic', '')
-        interview_questions = request.data.get('interview_questions', [])
-        outline_result = request.data.get('outline_result', '')
-        character_result = request.data.get('character_result', '')
         story_id = request.data.get('storyId', None)
         # find the story
-        story = Story.objects.get(id=story_id)
-        # get the genre of the story
-        genre = story.genre
-        print(f"Step: {step}")
-        print(f"Genre: {genre}")
-        print(f"Input Message: {input_message}")
-        print(f"Topic: {topic}")
-        print(f"Interview Questions: {interview_questions}")
-        print(f"Outline Result: {outline_result}")
-        print(f"Character Result: {character_result}")
+        try:
+            story = Story.objects.get(author=request.user, id=story_id)
+        except Story.DoesNotExist:
+            return Response({'error': 'Story not found'}, status=404)
+        logger.debug("Story %s, step %s", story.pk, step)
 
         if step == 1:
             # Step 1: Interview Chain
-            interview_chain = InterviewChain(topic=input_message, genre=genre)
-            interview_questions_obj = interview_chain()
-            interview_questions = [
-                q.question for q in interview_questions_obj.questions
-            ]
-            return Response({
-                'step': 2,
-                'interview_questions': interview_questions,
-                'topic': input_message
-            })
-
-        elif step == 2:
+            # Identical requests in flight (double clicks, retries) share one run
+            return Response(single_flight(
+                story.pk, 'interview', input_message, lambda: run_interview_step(story, input_message)))
+
+        # Results of the earlier steps, from the story's generation session
+        state = load_state(story, request.data, author=request.user)
+
+        if step == 2:
             # Step 2: Collect answers from user
             answers = request.data.get('answers', '').split("\n")
-            print(f"Answers: {answers}")
-            if not interview_questions:
+            if not state.questions:
                 return Response({'error': 'Interview questions are missing.'}, status=400)
-            if len(answers) != len(interview_questions):
+            if len(answers) != len(state.questions):
                 return Response({'error': 'The number of answers does not match the number of questions.'}, status=400)
 
-            interview_data = [
-                f"Q: {q}\nA: {a}" for q, a in zip(interview_questions, answers)
-            ]
-            print(interview_data)
-            outline_generator = StoryOutlineGenerator(
-                input=topic, genre=genre, interview_questions_and_answers=interview_data
-            )
-            outline_result = outline_generator.generate_outline()
-            return Response({
-                'step': 3,
-                'outline_result': outline_result,
-                'interview_questions': interview_data,
-                'topic': topic,
-            })
+            chapters = requested_chapters(request)
+            if chapters is None:
+                return Response({'error': f'The number of chapters must be between 1 and {MAX_CHAPTERS}.'}, status=400)
+
+            interview_data = interview_data_from_answers(
+                state.questions, answers)
+            return Response(single_flight(
+                story.pk, 'outline', [state.topic, interview_data, chapters],
+                lambda: run_outline_step(story, state.topic, interview_data, chapters)))
+
         elif step == 3:
             # Step 3: Character Generation
-            character_generator = CharacterGenerator(
-                input=topic, genre=genre, interview_questions_and_answers=interview_questions
-            )
-            character_result = character_generator.generate_character()
-            print(type(character_result))
-            # find the story
-            story = Story.objects.get(id=story_id)
-
-            for character in character_result.characters:
-                character_info = {
-                    'name': character.name,
-                    'appearance': character.appearance,
-                    'biography': character.biography
-                }
-
-                # Create and save the character for the current story
-                character_to_save = Character(
-                    story=story,
-                    name=character_info['name'],
-                    appearance=character_info['appearance'],
-                    biography=character_info['biography']
-                )
-                character_to_save.save()
-            return Response({
-                'step': 4,
-                'character_result': character_result,
-                'outline_result': outline_result,
-                'topic': topic
-            })
+            if not state.outline:
+                return Response({'error': 'The story outline is missing.'}, status=400)
+            return Response(single_flight(
+                story.pk, 'characters', [state.topic, state.interview_data, state.outline],
+                lambda: run_character_step(story, state.topic, state.interview_data, state.outline)))
 
         elif step == 4:
             # Step 4: Story Generation
-            print(outline_result)
-            story_gen = StoryGenerator(
-                topic=topic, outline=outline_result,
-                questions_and_answers=interview_questions, characters=character_result, genre=genre
-            )
-            stories = story_gen.generate_stories()
-            # save the title and content and position to the database
-            storyid = Story.objects.get(id=story_id)
-            for index, story in enumerate(stories):
-                chapters = outline_result[0][1]  # Get the list of chapters
-                # Avoid reusing the name `chapter`
-                for i, chapter_data in enumerate(chapters):
-                    if i != index:
-                        continue
-                    title = chapter_data[1][1]
-                content = story
-                position = index + 1
-                new_chapter = Chapter(title=title, content=content,  # Use a new variable name
-                                      story=storyid, position=position)
-                new_chapter.save()
-            return Response({'step': 5, 'stories': stories})
-
-        # elif step == 5:
-        #     stories = request.session.get('stories')
-        #     summarizer = StorySummarizer(story=stories)
-        #     story_summary = summarizer.summarize_story()
-        #     request.session['story_summary'] = story_summary
-        #     request.session['step'] = 6
-        #     return Response({'summary': request.session.get('story_summary')})
-
-        # elif step == 6:
-        #     # Step 7: Title Generation
-        #     stories = request.session.get('stories')
-        #     title_generator = TitleGenerator(summary=stories)
-        #     candidate_titles = title_generator.generate_titles()
-        #     request.session['candidate_titles'] = candidate_titles
-        #     request.session['step'] = 1  # Reset for next process
-        #     return Response({'titles': request.session.get('candidate_titles').titles})
+            generation_mode = request.data.get('generation_mode', SEQUENTIAL)
+            if generation_mode not in (SEQUENTIAL, PARALLEL):
+                return Response({'error': 'Invalid generation mode.'}, status=400)
+            if not state.outline:
+                return Response({'error': 'The story outline is missing.'}, status=400)
+            return Response(single_flight(
+                story.pk, 'chapters',
+                [state.topic, state.interview_data, state.outline, state.characters, generation_mode],
+                lambda: run_chapter_step(
+                    story, state.topic, state.interview_data, state.outline, state.characters,
+                    mode=generation_mode)))
+
+        elif step == 5:
+            # Step 5: Story Summary, from the saved chapters
+            return Response(single_flight(
+                story.pk, 'summary', story.last_update, lambda: run_summary_step(story)))
+
+        elif step == 6:
+            # Step 6: Title Generation
+            return Response(single_flight(
+                story.pk, 'titles', story.last_update, lambda: run_title_step(story)))
 
         return Response({'error': 'Invalid step or action'}, status=400)
+
+
+class StoryStreamView(APIView):
+    """
+    Streaming variant of steps 2-4 of ``StoryGenerationView``, sent as
+    newline-delimited JSON.
+
+    Step 2 sends each chapter of the outline, and step 3 each character, as
+    soon as the model has written it, then a ``done`` event with the step's
+    usual response. Step 4 (the default) sends the chapter text while the
+    model writes it, and each ``Chapter`` row is saved as soon as its section
+    is finished.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticatedCustom]
+
+    def post(self, request):
+        step = int(request.data.get('step', 4))
+        story_id = request.data.get('storyId', None)
+        try:
+            story = Story.objects.get(author=request.user, id=story_id)
+        except Story.DoesNotExist:
+            return Response({'error': 'Story not found'}, status=404)
+        state = load_state(story, request.data, author=request.user)
+
+        if step == 2:
+            answers = request.data.get('answers', '').split("\n")
+            if not state.questions:
+                return Response({'error': 'Interview questions are missing.'}, status=400)
+            if len(answers) != len(state.questions):
+                return Response({'error': 'The number of answers does not match the number of questions.'}, status=400)
+            chapters = requested_chapters(request)
+            if chapters is None:
+                return Response({'error': f'The number of chapters must be between 1 and {MAX_CHAPTERS}.'}, status=400)
+            events = stream_outline_step(
+                story, state.topic, interview_data_from_answers(state.questions, answers), chapters)
+        elif step == 3:
+            if not state.outline:
+                return Response({'error': 'The story outline is missing.'}, status=400)
+            events = stream_character_step(story, state.topic, state.interview_data, state.outline)
+        elif step == 4:
+            if not state.outline:
+                return Response({'error': 'The story outline is missing.'}, status=400)
+            events = self.chapter_events(story, state)
+        else:
+            return Response({'error': 'Invalid step or action'}, status=400)
+
+        response = StreamingHttpResponse(
+            (json.dumps(event, cls=JSONEncoder) + "\n" for event in events),
+            content_type='application/x-ndjson')
+        # Stop reverse proxies from buffering the stream
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def chapter_events(self, story, state):
+        story_gen = create_story_generator(
+            topic=state.topic, outline=state.outline,
+            questions_and_answers=state.interview_data, characters=state.characters, genre=story.genre
+        )
+        # One summary update for the whole story, not one a chapter
+        with trace_step(story.pk, 'chapters'), deferred_summary_update(story.pk):
+            for event in story_gen.stream_stories():
+                if event['event'] == 'chapter':
+                    chapter = save_chapter(
+                        story, event['chapter'], event['title'], event['content'])
+                    event['id'] = chapter.id
+                yield event
+        yield {'event': 'done', 'step': 5}
+
+
+class GenerationJobView(APIView):
+    """
+    Queue steps 2-4 of the story generation chat as a background job.
+
+    Takes the same body as ``StoryGenerationView`` and returns straight away
+    with the job id; the work is done by ``manage.py run_generation_worker``.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticatedCustom]
+
+    def post(self, request):
+        step = int(request.data.get('step', 2))
+        story_id = request.data.get('storyId', None)
+        if step not in JOB_STEPS:
+            return Response({'error': 'Invalid step or action'}, status=400)
+        try:
+            story = Story.objects.get(author=request.user, id=story_id)
+        except Story.DoesNotExist:
+            return Response({'error': 'Story not found'}, status=404)
+
+        # Earlier results are read from the generation session when the job
+        # runs; the payload only carries this step's input (and the fields
+        # older clients still send)
+        payload = {
+            key: request.data[key]
+            for key in ('topic', 'interview_questions', 'outline_result', 'character_result')
+            if key in request.data
+        }
+        if step == 2:
+            state = load_state(story, request.data, author=request.user)
+            answers = request.data.get('answers', '').split("\n")
+            if not state.questions:
+                return Response({'error': 'Interview questions are missing.'}, status=400)
+            if len(answers) != len(state.questions):
+                return Response({'error': 'The number of answers does not match the number of questions.'}, status=400)
+            chapters = requested_chapters(request)
+            if chapters is None:
+                return Response({'error': f'The number of chapters must be between 1 and {MAX_CHAPTERS}.'}, status=400)
+            payload['interview_data'] = interview_data_from_answers(
+                state.questions, answers)
+            payload['chapters'] = chapters
+        else:
+            payload['generation_mode'] = request.data.get('generation_mode', SEQUENTIAL)
+            if payload['generation_mode'] not in (SEQUENTIAL, PARALLEL):
+                return Response({'error': 'Invalid generation mode.'}, status=400)
+
+        job = enqueue_job(story, JOB_STEPS[step], payload, requested_by=request.user)
+        return Response({'job_id': job.id, 'status': job.status}, status=202)
+
+
+class GenerationJobDetailView(APIView):
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request, pk):
+        try:
+            job = GenerationJob.objects.get(id=pk, story__author=request.user)
+        except GenerationJob.DoesNotExist:
+            return Response({'error': 'Job not found'}, status=404)
+        return Response({
+            'job_id': job.id,
+            'story': job.story_id,
+            'step': job.step,
+            'status': job.status,
+            'attempts': job.attempts,
+            'error': job.error,
+            'created_at': job.created_at,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+        })
+
+
+class GenerationJobResultView(APIView):
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request, pk):
+        try:
+            job = GenerationJob.objects.get(id=pk, story__author=request.user)
+        except GenerationJob.DoesNotExist:
+            return Response({'error': 'Job not found'}, status=404)
+        if job.status == GenerationJob.STATUS_FAILED:
+            return Response({'error': 'Job failed', 'status': job.status}, status=500)
+        if job.status != GenerationJob.STATUS_SUCCEEDED:
+            return Response({'status': job.status}, status=202)
+        return Response(job.result)
+
+
+class SearchView(APIView):
+    """
+    Full-text search of the user's stories, chapters and characters:
+    ``?q=<words>``, optionally ``&kind=story|chapter|character`` and
+    ``&limit=<n>``. Results are ranked best first, with the matched words
+    in ``<mark>`` tags.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'The search query is missing.'}, status=400)
+        kind = request.query_params.get('kind')
+        if kind is not None and kind not in search.KINDS:
+            return Response({'error': 'Invalid kind.'}, status=400)
+        try:
+            limit = int(request.query_params.get('limit', 0)) or None
+        except ValueError:
+            return Response({'error': 'Invalid limit.'}, status=400)
+        return Response({'results': search.search(request.user.id, query, kind=kind, limit=limit)})
+
+
+class LLMCacheStatsView(APIView):
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticatedCustom]
+
+    def get(self, request):
+        llm_cache = get_llm_cache()
+        if llm_cache is None:
+            return Response({'enabled': False})
+        return Response({'enabled': True, **llm_cache.stats()})
+
+
+class MetricsView(View):
+    """
+    Prometheus scrape endpoint for the generation metrics (see core.tracing),
+    for scrapers holding the METRICS_TOKEN as a bearer token.
+    """
+
+    def get(self, request):
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        if not token:
+            raise Http404
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(given.encode(), token.encode()):
+            return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Async views
+#
+# These mirror the synchronous views above but await the model, image and
+# HTTP calls, so a single ASGI worker (see stories/asgi.py) can keep many
+# generations in flight instead of pinning a thread per request.
+
+
+class AsyncAPIView(View):
+    """
+    Minimal async counterpart of ``APIView`` for the generation endpoints:
+    token authentication, JSON request bodies and JSON responses.
+    """
+    authentication = TokenAuthentication()
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authentication only, like APIView, so CSRF does not apply
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            user_auth = await self.authentication.aauthenticate(request)
+        except AuthenticationFailed as exc:
+            return JsonResponse({'detail': str(exc.detail)}, status=403)
+        if user_auth is None:
+            return JsonResponse(
+                {'detail': 'Authentication credentials were not provided.'}, status=403)
+        request.user, request.auth = user_auth
+
+        try:
+            request.data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'detail': 'JSON parse error'}, status=400)
+
+        return await super().dispatch(request, *args, **kwargs)
+
+    def respond(self, data, status=200):
+        # Use DRF's encoder so responses match the synchronous views
+        return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+class AsyncGenerateStoryImageView(AsyncAPIView):
+    async def post(self, request, pk):
+        try:
+            story = await Story.objects.aget(author=request.user, id=pk)
+        except Story.DoesNotExist:
+            return self.respond({'error': 'Story not found'}, status=404)
+
+        name = request.data.get('name', story.title)
+        genre = request.data.get('genre', story.genre)
+        summary = request.data.get('summary', story.summary)
+        prompt = f"""Create an image of a {genre} story titled "{name}" with the following summary: "{summary}" """
+
+        async def generate():
+            with trace_step(story.pk, 'story_image'):
+                image_file = await agenerate_image(prompt)
+            image_name = f"{story.title}_image.png"
+            await sync_to_async(save_image)(
+                story, image_name, image_file, update_fields=['last_update'])
+
+            serializer = StorySerializer(story)
+            return serializer.data
+
+        return self.respond(await asingle_flight(story.pk, 'story_image', prompt, generate))
+
+
+class AsyncGenerateCharacterImageView(AsyncAPIView):
+    async def post(self, request, pk):
+        try:
+            character = await Character.objects.aget(id=pk, story__author=request.user)
+        except Character.DoesNotExist:
+            return self.respond({'error': 'Character not found'}, status=404)
+
+        name = request.data.get('name', character.name)
+        appearance = request.data.get('appearance', character.appearance)
+        biography = request.data.get('biography', character.biography)
+        prompt = f"""Create an image of a character named "{name}" with the following appearance: "{appearance}" and biography: "{biography}" """
+
+        async def generate():
+            with trace_step(character.story_id, 'character_image'):
+                image_file = await agenerate_image(prompt)
+            image_name = f"{name}_image.png"
+
+            character.name = name
+            character.appearance = appearance
+            character.biography = biography
+            await sync_to_async(save_image)(
+                character, image_name, image_file,
+                update_fields=['name', 'appearance', 'biography'])
+
+            serializer = ComplexCharacterSerializer(character)
+            return serializer.data
+
+        return self.respond(await asingle_flight(
+            character.story_id, 'character_image', [character.pk, prompt], generate))
+
+
+class AsyncStoryGenerationView(AsyncAPIView):
+    async def post(self, request):
+        step = int(request.data.get('step', 1))
+        input_message = request.data.get('message')
+        story_id = request.data.get('storyId', None)
+        try:
+            story = await Story.objects.aget(author=request.user, id=story_id)
+        except Story.DoesNotExist:
+            return self.respond({'error': 'Story not found'}, status=404)
+
+        if step == 1:
+            # Identical requests in flight (double clicks, retries) share one run
+            return self.respond(await asingle_flight(
+                story.pk, 'interview', input_message, lambda: arun_interview_step(story, input_message)))
+
+        state = await sync_to_async(load_state)(story, request.data, author=request.user)
+
+        if step == 2:
+            answers = request.data.get('answers', '').split("\n")
+            if not state.questions:
+                return self.respond({'error': 'Interview questions are missing.'}, status=400)
+            if len(answers) != len(state.questions):
+                return self.respond({'error': 'The number of answers does not match the number of questions.'}, status=400)
+
+            chapters = requested_chapters(request)
+            if chapters is None:
+                return self.respond({'error': f'The number of chapters must be between 1 and {MAX_CHAPTERS}.'}, status=400)
+
+            interview_data = interview_data_from_answers(state.questions, answers)
+            return self.respond(await asingle_flight(
+                story.pk, 'outline', [state.topic, interview_data, chapters],
+                lambda: arun_outline_step(story, state.topic, interview_data, chapters)))
+
+        elif step == 3:
+            if not state.outline:
+                return self.respond({'error': 'The story outline is missing.'}, status=400)
+            return self.respond(await asingle_flight(
+                story.pk, 'characters', [state.topic, state.interview_data, state.outline],
+                lambda: arun_character_step(story, state.topic, state.interview_data, state.outline)))
+
+        elif step == 4:
+            generation_mode = request.data.get('generation_mode', SEQUENTIAL)
+            if generation_mode not in (SEQUENTIAL, PARALLEL):
+                return self.respond({'error': 'Invalid generation mode.'}, status=400)
+            if not state.outline:
+                return self.respond({'error': 'The story outline is missing.'}, status=400)
+            return self.respond(await asingle_flight(
+                story.pk, 'chapters',
+                [state.topic, state.interview_data, state.outline, state.characters, generation_mode],
+                lambda: arun_chapter_step(
+                    story, state.topic, state.interview_data, state.outline, state.characters,
+                    mode=generation_mode)))
+
+        elif step == 5:
+            return self.respond(await asingle_flight(
+                story.pk, 'summary', story.last_update, lambda: run_off_thread(run_summary_step, story)))
+
+        elif step == 6:
+            return self.respond(await asingle_flight(
+                story.pk, 'titles', story.last_update, lambda: run_off_thread(run_title_step, story)))
+
+        return self.respond({'error': 'Invalid step or action'}, status=400)
@@ -3,6 +3,9 @@ ASGI config for stories project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The async generation endpoints under ``/async/`` only avoid tying up a worker
+per request when served from here, e.g. ``uvicorn stories.asgi:application``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
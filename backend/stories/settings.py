@@ -41,6 +41,174 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Login tokens (see core/authentication.py)
+AUTH_TOKEN_TTL = 30 * 24 * 60 * 60  # seconds a login token stays valid
+AUTH_TOKEN_CACHE_TTL = 60  # seconds a resolved token is cached in-process
+AUTH_TOKEN_CACHE_MAX_ENTRIES = 10000
+
+# Response cache for the generation chains (see core/llm_cache.py). Only
+# temperature=0 calls are cached.
+LLM_CACHE = {
+    'ENABLED': True,
+    'MEMORY_MAX_ENTRIES': 512,
+    'DATABASE': True,
+    'DATABASE_MAX_ENTRIES': 10000,
+    'TTL': 7 * 24 * 60 * 60,  # seconds
+}
+
+# Connection pool shared by every OpenAI client in the process (see core/llm.py)
+LLM_HTTP_POOL = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,  # seconds
+    'TIMEOUT': 600.0,  # seconds
+}
+
+# Scheduler every OpenAI API call waits in (see core/llm_scheduler.py): at
+# most MAX_CONCURRENCY calls at a time, requests and tokens per minute per
+# model (set them to the account's limits), user-facing steps before
+# generation jobs, and jittered retries of 429s and 5xx.
+LLM_SCHEDULER = {
+    'ENABLED': True,
+    'MAX_CONCURRENCY': 16,
+    'MAX_RETRIES': 5,
+    'LIMITS': {
+        'gpt-4o': {'RPM': 500, 'TPM': 30000},
+        'gpt-3.5-turbo': {'RPM': 3500, 'TPM': 200000},
+        'gpt-3.5-turbo-16k': {'RPM': 3500, 'TPM': 200000},
+        'dall-e-3': {'RPM': 7},
+    },
+}
+
+# JSON answers of the chat models (see core/structured_output.py): the schema
+# goes in the request's response format for the models that take one, and
+# replies are repaired here before the model is asked again.
+STRUCTURED_OUTPUT = {
+    'RESPONSE_FORMAT': True,
+    'JSON_SCHEMA_MODELS': ['gpt-4o', 'gpt-4o-mini'],
+    'MAX_REPROMPTS': 1,
+}
+
+# Story summaries (see core/summary_chain.py): chapters are summarized in
+# chunks of CHUNK_TOKENS, MAX_CONCURRENCY calls at a time, and the summaries
+# combined REDUCE_FANOUT at a time until they fit in REDUCE_TOKENS.
+SUMMARIZATION = {
+    'CHUNK_TOKENS': 2000,
+    'MAX_CONCURRENCY': 8,
+    'REDUCE_TOKENS': 3000,
+    'REDUCE_FANOUT': 8,
+}
+
+# Identical generation requests in flight at once (double clicks, client
+# retries) run once and share the result (see core/single_flight.py), also
+# across web workers. RESULT_TTL > 0 also hands a finished result to the
+# identical requests of the next RESULT_TTL seconds.
+SINGLE_FLIGHT = {
+    'ENABLED': True,
+    'RESULT_TTL': 0,
+    'STALE_AFTER': 30 * 60,
+}
+
+# Generation jobs run by `manage.py run_generation_worker` (see core/jobs.py).
+# A running job's worker refreshes its heartbeat every HEARTBEAT_INTERVAL
+# seconds; a job without one for STALE_AFTER seconds is requeued, or failed
+# once it has been claimed MAX_ATTEMPTS times.
+GENERATION_JOBS = {
+    'HEARTBEAT_INTERVAL': 30,
+    'STALE_AFTER': 5 * 60,
+    'MAX_ATTEMPTS': 3,
+}
+
+# Where the chat models come from (see core/llm.py): 'openai', or 'llama_cpp'
+# to run a GGUF export of the fine-tuned Llama 3.1 8B on the CPU (needs
+# llama-cpp-python). MODELS limits the backend to those model names, e.g.
+# ['gpt-3.5-turbo-16k'] writes the chapters locally and leaves the JSON
+# steps on gpt-4o.
+LLM_PROVIDER = {
+    'BACKEND': 'openai',
+    'MODELS': None,
+}
+
+# The local model (see core/local_llm.py), loaded once per process
+LOCAL_LLM = {
+    'MODEL_PATH': None,  # e.g. BASE_DIR / 'models' / 'story-llama-3.1-8b.Q4_K_M.gguf'
+    'N_CTX': 8192,
+    'N_THREADS': None,
+    'MAX_TOKENS': 2048,
+}
+
+# Speculative prefetch of the next generation step (see core/prefetch.py).
+# Opt-in: a prefetched step the user never asks for is a wasted API call.
+GENERATION_PREFETCH = {
+    'ENABLED': False,
+    'MAX_WORKERS': 2,
+    'MAX_ENTRIES': 64,
+    'TTL': 15 * 60,  # seconds an unclaimed result is kept
+}
+
+# What StoryGenerator keeps of the chapters already written (see
+# core/story_memory.py). SUMMARIZER_MODEL (e.g. "gpt-3.5-turbo") has a model
+# rewrite the synopsis after each chapter, in the background by default.
+STORY_MEMORY = {
+    'SYNOPSIS_MAX_TOKENS': 400,
+    'TAIL_MAX_TOKENS': 300,
+    'SUMMARIZER_MODEL': None,
+    'BACKGROUND': True,
+}
+
+# Chapters StoryGenerator drafts at once in the "parallel" generation mode;
+# each is one chat call, so mind the LLM_SCHEDULER limits.
+STORY_GENERATION = {
+    'PARALLEL_MAX_CONCURRENCY': 3,
+}
+
+# Token budget for the story context StoryGenerator sends with every chapter
+# (see core/prompt_compiler.py). Over budget, the interview is cut first,
+# then the characters, then the outline.
+STORY_PROMPT = {
+    'CONTEXT_MAX_TOKENS': 1500,
+}
+
+# Passages of the chapters already written (and the characters) that
+# StoryGenerator recalls into each new chapter's prompt, found by similarity
+# of hashed word and character n-grams (see core/continuity_index.py).
+CONTINUITY_INDEX = {
+    'ENABLED': True,
+    'TOP_K': 4,
+    'MAX_TOKENS': 600,
+}
+
+# Full-text search (see core/search.py). MySQL searches its own FULLTEXT
+# indexes; other engines use an SQLite FTS5 file at PATH, filled for existing
+# content with `manage.py rebuild_search_index`.
+SEARCH_INDEX = {
+    'ENABLED': True,
+    'PATH': BASE_DIR / 'search_index.sqlite3',
+    'MAX_RESULTS': 50,
+}
+
+# Per-call traces of the model and image calls are logged as JSON lines on
+# the core.tracing logger (see core/tracing.py); metrics are at /metrics/,
+# for scrapers that send "Authorization: Bearer <METRICS_TOKEN>". Without a
+# token the endpoint is off.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'tracing': {'class': 'logging.StreamHandler', 'formatter': 'message'},
+    },
+    'loggers': {
+        'core.tracing': {'handlers': ['tracing'], 'level': 'INFO', 'propagate': False},
+        # Replies that did not fit their schema and were asked for again
+        'core.structured_output': {'handlers': ['tracing'], 'level': 'WARNING', 'propagate': False},
+    },
+}
+
 
 # Application definition
 
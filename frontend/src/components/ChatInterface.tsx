@@ -30,9 +30,6 @@ const ChatInterface = ({
   // State for backend steps
   const [step, setStep] = useState(1);
   const [topic, setTopic] = useState("");
-  const [interviewQuestions, setInterviewQuestions] = useState<string[]>([]);
-  const [outlineResult, setOutlineResult] = useState("");
-  const [characterResult, setCharacterResult] = useState("");
   const [stories, setStories] = useState<string[]>([]);
 
   // Auto-scroll to bottom when new messages arrive
@@ -73,9 +70,6 @@ const ChatInterface = ({
           step,
           message: inputMessage,
           topic,
-          interview_questions: interviewQuestions,
-          outline_result: outlineResult,
-          character_result: characterResult,
           answers: inputMessage, // In step 2, this would be the user's answers
           storyId,
         },
@@ -91,7 +85,6 @@ const ChatInterface = ({
 
       // Handle the backend response and update state
       if (data.step === 2) {
-        setInterviewQuestions(data.interview_questions || []);
         setTopic(data.topic);
         setMessages((prev) => [
           ...prev,
@@ -103,10 +96,11 @@ const ChatInterface = ({
         ]);
       } else if (data.step === 3) {
         console.log(data.outline_result);
-        setOutlineResult(data.outline_result || "");
+        // Long stories are outlined as acts, which are expanded while writing
+        const part = data.outline_result[0][0] === "acts" ? "Act" : "Chapter";
         const formattedOutline = data.outline_result[0][1]
           .map((chapter) => {
-            return `Chapter ${chapter[0][1]}: ${chapter[1][1]}`;
+            return `${part} ${chapter[0][1]}: ${chapter[1][1]}`;
           })
           .join("\n");
 
@@ -118,12 +112,9 @@ const ChatInterface = ({
             timestamp: new Date(),
           },
         ]);
-        setInterviewQuestions(data.interview_questions || []);
       } else if (data.step === 4) {
         setActiveTab("Character");
         console.log(data.character_result);
-        setCharacterResult(data.character_result || "");
-        setCharacterResult(data.character_result || "");
         const characterResultString = data.character_result[0][1] // Access the characters array
           .map((character) => {
             const name = character[0][1] ? character[0][1] : "Unknown Name";
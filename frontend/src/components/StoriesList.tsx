@@ -20,6 +20,7 @@ interface Story {
   genre: string;
   summary: string;
   image: string;
+  image_medium: string | null;
 }
 
 const StoriesList = () => {
@@ -129,7 +130,13 @@ const StoriesList = () => {
       // Update the story with the new image (whether it was a new or regenerated image)
       setStories((prev) =>
         prev.map((s) =>
-          s.id === story.id ? { ...s, image: response.data.image } : s
+          s.id === story.id
+            ? {
+                ...s,
+                image: response.data.image,
+                image_medium: response.data.image_medium,
+              }
+            : s
         )
       );
     } catch (error) {
@@ -291,7 +298,7 @@ const StoriesList = () => {
                   {story.image ? (
                     <>
                       <img
-                        src={`http://127.0.0.1:8000${story.image}`}
+                        src={`http://127.0.0.1:8000${story.image_medium || story.image}`}
                         alt={story.title}
                         className="w-full h-full object-cover"
                         onError={handleImageError}